@@ -1,10 +1,15 @@
 from sonzo.telnet import TelnetServer, TelnetProtocol
+from sonzo.command import CommandRouter
+from sonzo.log import setup_logging
 import logging
-import time
+import sys
 
 LMAGENTA = chr(27) + "[1;35m"
 WHITE    = chr(27) + "[37m"
 LGREEN   = chr(27) + "[1;32m"
+CHANNEL  = "chat"
+HANDOFF  = "/tmp/sonzo-chat.sock"
+ADMIN    = "/tmp/sonzo-chat-admin.sock"
 LOGIN    = "\n\r\n\r\n\r                             {}Welcome to Sonzo Chat!\n\r\n\r{}"
 
 
@@ -23,19 +28,18 @@ class ChatClient(TelnetProtocol):
         # Overridden medthod    
         logging.info(" {} has connected.".format(self.addrport()))
 
-        for user in USERLIST:
-            systemMessage(user, "{} has joined the chat!\n\r".format(self.addrport()))
-        USERLIST.append(self)        
+        self._server.channels.publish(CHANNEL, "{} has joined the chat!\n\r".format(self.addrport()))
+        self._server.channels.join(self, CHANNEL)
         systemMessage(self, LOGIN.format(LMAGENTA, WHITE))
+        # Catch up on what was said before we got here.
+        self._server.channels.replay(CHANNEL, self)
     
     
     def onDisconnect(self):
         # Over-ridden medthod 
         logging.info(" {} disconnecting.".format(self.addrport()))     
-        USERLIST.remove(self)
-        for user in USERLIST:
-            if user is not self:
-                systemMessage(user, "{} logged off.\n\r".format(self.addrport()))
+        self._server.channels.leave(self, CHANNEL)
+        self._server.channels.publish(CHANNEL, "{} logged off.\n\r".format(self.addrport()))
 
     def dataRecieved(self, data):
         """
@@ -49,8 +53,7 @@ class ChatClient(TelnetProtocol):
         Disconnect user.
         """
         systemMessage(self, "Goodbye!\n\r")
-        self._new_messages = False
-        self._connected = False
+        TelnetProtocol.disconnect(self)
 
 
 def color(c, color):
@@ -60,33 +63,51 @@ def color(c, color):
         return ""
         
 
-def chat(client, msg):
-    #Check to see if someone issues a command.
-    if msg.startswith("=a".lower()):
-        client.setANSIMode()
-        systemMessage(client, "ANSI: {}\n\r".format(client._ansi))
-        logging.info(" {} changing ANSI to: {}.".format(client.addrport(), client._ansi))
-        return
-    if msg.startswith("/quit".lower()):
-        client.disconnect()
-        return
-    if msg.startswith("~".lower()):
-        logging.info(" {} changing character mode to: {}.".format(client.addrport(), client._character_mode))
-        client.setCharacterMode()
-        client.systemMessage("Character Mode is now: {}\n\r".format(client._character_mode))
-        return
-    if msg.startswith("/runlater".lower()):
-        chatsrvr.callLater("Ran 2 seconds later.", func=print, runtime=2)   
-    if msg.startswith("/install".lower()):
-        chatsrvr.install("Fart!", func=print)
+def say(client, msg):
     # If no command, say it in the chat room.
-    for c in USERLIST:
-        sendMessage(client, c, msg)
+    sendMessage(client, msg)
+
+
+commands = CommandRouter(default=say)
+
+
+@commands.command("=a")
+def ansi(client, args):
+    client.setANSIMode()
+    systemMessage(client, "ANSI: {}\n\r".format(client._ansi))
+    logging.info(" {} changing ANSI to: {}.".format(client.addrport(), client._ansi))
+
+
+@commands.command("/quit", abbreviate=False)
+def quit(client, args):
+    client.disconnect()
+
+
+@commands.command("~")
+def charmode(client, args):
+    logging.info(" {} changing character mode to: {}.".format(client.addrport(), client._character_mode))
+    client.setCharacterMode()
+    systemMessage(client, "Character Mode is now: {}\n\r".format(client._character_mode))
+
+
+@commands.command("/runlater")
+def runlater(client, args):
+    chatsrvr.callLater("Ran 2 seconds later.", func=print, runtime=2)
+
+
+@commands.command("/install")
+def install(client, args):
+    chatsrvr.install("Fart!", func=print)
+
+
+def chat(client, msg):
+    commands.dispatch(client, msg)
 
   
-def sendMessage(sender, client, message):
-    message = "{}{} says, {}{}".format(color(sender, LGREEN), sender.addrport(), color(client, WHITE), message)
-    client.send(message)
+def sendMessage(sender, message):
+    # Encoded once per variant and shared by every member of the channel.
+    said = "{}{} says, ".format(color(sender, LGREEN), sender.addrport())
+    chatsrvr.channels.publish(CHANNEL, said + WHITE + message, plain=said + message)
 
 def systemMessage(client, message):
     client.send(message)
@@ -95,13 +116,26 @@ def systemMessage(client, message):
     
 if __name__ == '__main__':
     logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
-    USERLIST = []
+    # Server internals log through a background writer; sample negotiation
+    # chatter and keep any one connection from flooding the log.
+    log_writer = setup_logging(level=logging.DEBUG, sample=10, rate=50)
     chatclient = ChatClient
-    chatsrvr = TelnetServer(clientclass=chatclient, address='', port=23)
+    # Start a new build with --takeover to replace a running server without
+    # dropping anyone.
+    takeover = HANDOFF if '--takeover' in sys.argv else None
+    chatsrvr = TelnetServer(clientclass=chatclient, address='', port=23, takeover=takeover)
+    chatsrvr.channels.setScrollback(CHANNEL, lines=20)
+    chatsrvr.listenForHandoff(HANDOFF)
+    # 'socat - UNIX-CONNECT:/tmp/sonzo-chat-admin.sock' for the admin console.
+    chatsrvr.listenAdmin(ADMIN)
     logging.info(" Sonzo Chat Server starting up...")
     # Example of adding a looping call.
     tensecondloop = chatsrvr.loopingCall("Looping at 10 seconds", func=print)
     tensecondloop.start(10)
      
     
-    chatsrvr.run()
\ No newline at end of file
+    try:
+        chatsrvr.run()
+    finally:
+        # Flush whatever the server logged on its way out.
+        log_writer.stop()
\ No newline at end of file
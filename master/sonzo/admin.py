@@ -0,0 +1,403 @@
+import logging
+import os
+import socket
+import time
+
+log = logging.getLogger(__name__)
+
+
+#--[ Admin Console ]-----------------------------------------------------------
+
+## Longest command line an admin connection may send
+MAX_ADMIN_LINE = 4096
+## Bytes of replies queued for an admin connection that is not reading
+## before it is closed
+MAX_ADMIN_OUTPUT = 1048576
+## Clients shown by top when no count is given
+TOP_COUNT = 10
+
+
+class AdminConsole(object):
+    """
+    Line based console on a local Unix socket for looking into a running
+    TelnetServer and acting on its connections.
+
+    Connect with any plain socket tool, e.g. 'socat - UNIX-CONNECT:path' or
+    'nc -U path', and type 'help'.  Admin connections share the server's
+    selector but are not telnet clients: no negotiation, no lanes, and
+    commands run as soon as their line arrives.
+
+        server.listenAdmin('/tmp/sonzo-admin.sock')
+    """
+
+    def __init__(self, server, path):
+        """
+        Initialize admin console and start listening on path.
+        """
+        self.path = path
+        self._server = server
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        os.chmod(path, 0o600)
+        self.socket.listen(5)
+        self.socket.setblocking(False)
+        # fileno -> [socket, input buffer, {(fileno, connect time): (time, sent,
+        # received, commands)}, output buffer]
+        self._conns = {}
+        self._commands = {
+            'help': self._help,
+            'stats': self._stats,
+            'list': self._list,
+            'show': self._show,
+            'top': self._top,
+            'ticks': self._ticks,
+            'memory': self._memory,
+            'latency': self._latency,
+            'kick': self._kick,
+            'throttle': self._throttle,
+            'mirror': self._mirror,
+            'quit': self._quit,
+            }
+        server._watch(self.socket, self._accept)
+
+
+    def close(self, unlink=True):
+        """
+        Close every admin connection and the listening socket.
+
+        unlink: Remove the socket file, left alone when a process taking
+                over may already have bound the path again.
+        """
+        for fileno in list(self._conns):
+            self._close(fileno)
+        self._server._unwatch(self.socket)
+        self.socket.close()
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+    def _accept(self):
+        """
+        Accept an admin connection.
+        """
+        try:
+            conn, addr = self.socket.accept()
+        except OSError:
+            return
+        conn.setblocking(False)
+        fileno = conn.fileno()
+        entry = [conn, b'', {}, bytearray()]
+        self._conns[fileno] = entry
+        self._server._watch(conn, lambda: self._read(fileno), lambda: self._flush(fileno))
+        self._write(entry, "sonzo admin, {} clients.  Type 'help'.\n> ".format(
+            len(self._server._clients)))
+
+
+    def _close(self, fileno):
+        """
+        Close an admin connection.
+        """
+        entry = self._conns.pop(fileno, None)
+        if entry is not None:
+            self._server._unwatch(entry[0])
+            entry[0].close()
+
+
+    def _write(self, entry, text):
+        """
+        Queue text for an admin connection and send what the socket takes.
+        The rest goes out when it is writable, the main loop never waits.
+        """
+        entry[3] += text.encode('utf-8', 'replace')
+        if len(entry[3]) > MAX_ADMIN_OUTPUT:
+            log.warning("Admin connection not reading its output, closing it.")
+            self._close(entry[0].fileno())
+            return
+        self._flush(entry[0].fileno())
+
+
+    def _flush(self, fileno):
+        """
+        Send queued output to an admin connection.
+        """
+        entry = self._conns.get(fileno)
+        if entry is None:
+            return
+        try:
+            sent = entry[0].send(entry[3]) if entry[3] else 0
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._close(fileno)
+            return
+        del entry[3][:sent]
+        self._server._watchWrite(entry[0], bool(entry[3]))
+
+
+    def _read(self, fileno):
+        """
+        Run every complete command line from an admin connection.
+        """
+        entry = self._conns.get(fileno)
+        if entry is None:
+            return
+        conn = entry[0]
+        try:
+            data = conn.recv(MAX_ADMIN_LINE)
+        except OSError:
+            data = b''
+        if not data:
+            self._close(fileno)
+            return
+        entry[1] += data
+        while fileno in self._conns:
+            mark = entry[1].find(b'\n')
+            if mark == -1:
+                if len(entry[1]) > MAX_ADMIN_LINE:
+                    self._close(fileno)
+                return
+            line = entry[1][:mark].decode('utf-8', 'replace').strip()
+            entry[1] = entry[1][mark + 1:]
+            self._run(entry, line)
+
+
+    def _run(self, entry, line):
+        """
+        Run one command line and write its output and a new prompt.
+        """
+        words = line.split()
+        if not words:
+            self._write(entry, "> ")
+            return
+        command = self._commands.get(words[0].lower())
+        if command is None:
+            output = "Unknown command '{}', try 'help'.".format(words[0])
+        else:
+            try:
+                output = command(entry, words[1:])
+            except (ValueError, IndexError) as err:
+                output = "Error: {}".format(err)
+            except Exception as err:
+                # A failing command must not take the server's main loop down.
+                log.exception("Admin command '%s' failed.", line)
+                output = "Error: {}: {}".format(err.__class__.__name__, err)
+        if entry[0].fileno() in self._conns:
+            self._write(entry, (output + "\n> ") if output else "> ")
+
+
+    def _find(self, name):
+        """
+        Return the client with fileno or addr:port name.
+        """
+        clients = self._server._clients
+        if name.isdigit() and int(name) in clients:
+            return clients[int(name)]
+        for client in clients.values():
+            if client.addrport() == name:
+                return client
+        raise ValueError("No client '{}'.".format(name))
+
+
+    #---[ Commands ]-----------------------------------------------------------
+
+    def _help(self, entry, args):
+        return "\n".join((
+            "stats                    Server totals.",
+            "list                     Every connection.",
+            "show <client>            One connection in detail.",
+            "top [count]              Busiest connections since the last top.",
+            "ticks                    Main loop timing.",
+            "memory [count]           Memory by subsystem, growth and biggest clients.",
+            "latency [count]          Input and output latency, slowest clients.",
+            "kick <client> [message]  Disconnect a client.",
+            "throttle <client> <bytes/sec|off>",
+            "                         Limit a client's output rate.",
+            "mirror <observer> <client|off>",
+            "                         Show a client's output to another client.",
+            "quit                     Close this console.",
+            "<client> is the id from list or addr:port.",
+            ))
+
+
+    def _stats(self, entry, args):
+        server = self._server
+        clients = list(server._clients.values())
+        counts = {}
+        for client in clients:
+            counts[client._state] = counts.get(client._state, 0) + 1
+        states = ", ".join("{} {}".format(count, state) for state, count in sorted(counts.items()))
+        return "\n".join((
+            "clients:   {} ({})".format(len(clients), states or "none"),
+            "detached:  {}".format(len(server.sessions)),
+            "listeners: {}".format(", ".join(str(listener.key()[1:]) for listener in server.listeners())),
+            "sent:      {} bytes".format(sum(client._bytes_sent for client in clients)),
+            "received:  {} bytes".format(sum(client._bytes_received for client in clients)),
+            "queued:    {} bytes".format(sum(len(client._send_buffer) for client in clients)),
+            "tls:       {handshakes} handshakes, {resumed} resumed, {failures} failed".format(**server.tls_stats),
+            "content:   {} files, {} bytes, {} hits, {} loads".format(
+                len(server.content), server.content.size(), server.content.hits, server.content.loads),
+            ))
+
+
+    def _list(self, entry, args):
+        lines = ["{:>5} {:<22} {:<11} {:<12} {:>9} {:>7} {:>21} {:>10} {:>10} {:>6}".format(
+            'id', 'address', 'state', 'terminal', 'speed', 'size',
+            'queued i/n/b', 'sent', 'received', 'idle')]
+        for fileno, client in sorted(self._server._clients.items()):
+            stats = client.connectionStats()
+            lines.append("{:>5} {:<22} {:<11} {:<12} {:>9} {:>7} {:>21} {:>10} {:>10} {:>6.0f}".format(
+                fileno, stats['address'], stats['state'], stats['terminal_type'][:12],
+                stats['terminal_speed'][:9], "{}x{}".format(stats['columns'], stats['rows']),
+                "/".join(str(size) for size in stats['queued']),
+                stats['bytes_sent'], stats['bytes_received'], stats['idle']))
+        return "\n".join(lines)
+
+
+    def _show(self, entry, args):
+        stats = self._find(args[0]).connectionStats()
+        return "\n".join("{:<16} {}".format(name + ':', value) for name, value in sorted(stats.items()))
+
+
+    def _top(self, entry, args):
+        count = int(args[0]) if args else TOP_COUNT
+        now = time.time()
+        previous = entry[2]
+        current = {}
+        rows = []
+        for client in self._server._clients.values():
+            if not client._connected:
+                continue
+            sample = (now, client._bytes_sent, client._bytes_received, client._commands_received)
+            # Keyed by descriptor and connect time, not the client, so dropped
+            # clients are not kept alive and reused descriptors start afresh.
+            key = (client.getSocket(), client._connect_time)
+            current[key] = sample
+            since = previous.get(key, (client._connect_time, 0, 0, 0))
+            elapsed = max(now - since[0], 0.001)
+            rates = [(sample[index] - since[index]) / elapsed for index in (1, 2, 3)]
+            rows.append((rates[0] + rates[1], rates, client))
+        entry[2] = current
+        rows.sort(key=lambda row: row[0], reverse=True)
+        lines = ["{:>5} {:<22} {:>12} {:>12} {:>10} {:>10}".format(
+            'id', 'address', 'out B/s', 'in B/s', 'cmds/s', 'throttle')]
+        for total, rates, client in rows[:count]:
+            lines.append("{:>5} {:<22} {:>12.0f} {:>12.0f} {:>10.1f} {:>10}".format(
+                client.getSocket(), client.addrport(), rates[0], rates[1], rates[2],
+                client._throttle or '-'))
+        return "\n".join(lines)
+
+
+    def _ticks(self, entry, args):
+        stats = self._server.tickStats()
+        if not stats['ticks']:
+            return "No ticks timed yet."
+        lines = ["{} ticks, times in ms".format(stats['ticks']),
+                 "{:<10} {:>9} {:>9} {:>9} {:>9}".format('phase', 'last', 'mean', 'p99', 'max')]
+        for phase in ('io', 'timers', 'dispatch', 'total'):
+            times = stats[phase]
+            lines.append("{:<10} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+                phase, times['last'] * 1000, times['mean'] * 1000,
+                times['p99'] * 1000, times['max'] * 1000))
+        return "\n".join(lines)
+
+
+    def _memory(self, entry, args):
+        count = int(args[0]) if args else TOP_COUNT
+        server = self._server
+        monitor = server.memory
+        # Growth figures need samples, taken from now on.
+        server.watchMemory()
+        figures = server.objectCounts()
+        figures.update(server.memoryUsage())
+        growth = monitor.growth()
+        suspects = monitor.suspects()
+        budget = "none" if monitor.budget is None else "{} bytes{}".format(
+            monitor.budget, ", OVER" if monitor.over_budget else "")
+        lines = ["budget: {}, {} bytes shed, {} connections refused".format(
+                     budget, monitor.shed, monitor.refused),
+                 "{:<20} {:>12} {:>14}".format('', 'now', 'per hour')]
+        for name in sorted(figures):
+            lines.append("{:<20} {:>12} {:>+14.0f}{}".format(
+                name, figures[name], growth.get(name, 0), "  leak?" if name in suspects else ""))
+        clients = sorted(server._clients.values(),
+                         key=lambda client: sum(client.memoryUsage().values()), reverse=True)
+        lines.append("{:>5} {:<22} {:>10} {:>10} {:>10} {:>10}".format(
+            'id', 'address', 'total', 'send', 'recv', 'scrollback'))
+        for client in clients[:count]:
+            usage = client.memoryUsage()
+            lines.append("{:>5} {:<22} {:>10} {:>10} {:>10} {:>10}".format(
+                client.getSocket(), client.addrport(), sum(usage.values()),
+                usage['send'], usage['recv'], usage['scrollback']))
+        return "\n".join(lines)
+
+
+    def _latency(self, entry, args):
+        count = int(args[0]) if args else TOP_COUNT
+        stats = self._server.latencyStats()
+        lines = ["times in ms        count      mean       p50       p90       p99     p99.9       max"]
+        row = "{:<12} {:>10} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}"
+        for name in ('input', 'output'):
+            times = stats[name]
+            lines.append(row.format(name, times['count'], times['mean'] * 1000, times['p50'] * 1000,
+                                    times['p90'] * 1000, times['p99'] * 1000,
+                                    times['p99.9'] * 1000, times['max'] * 1000))
+        clients = []
+        for client in self._server._clients.values():
+            client_stats = client.latencyStats()
+            if client_stats is not None:
+                clients.append((client_stats['output']['p99'], client_stats, client))
+        if not clients:
+            lines.append("Clients are not timed, see TelnetServer.enableLatency().")
+            return "\n".join(lines)
+        clients.sort(key=lambda row: row[0], reverse=True)
+        lines.append("{:>5} {:<22} {:>10} {:>10} {:>10} {:>10}".format(
+            'id', 'address', 'in p99', 'in max', 'out p99', 'out max'))
+        for worst, client_stats, client in clients[:count]:
+            lines.append("{:>5} {:<22} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                client.getSocket(), client.addrport(),
+                client_stats['input']['p99'] * 1000, client_stats['input']['max'] * 1000,
+                client_stats['output']['p99'] * 1000, client_stats['output']['max'] * 1000))
+        return "\n".join(lines)
+
+
+    def _kick(self, entry, args):
+        client = self._find(args[0])
+        message = " ".join(args[1:])
+        client.kick(message + "\r\n" if message else None)
+        log.info("Admin kicked %s.", client.addrport())
+        return "Kicked {}.".format(client.addrport())
+
+
+    def _throttle(self, entry, args):
+        client = self._find(args[0])
+        rate = None if args[1].lower() == 'off' else int(args[1])
+        client.throttle(rate)
+        log.info("Admin throttled %s to %s bytes/sec.", client.addrport(), rate)
+        if rate is None:
+            return "{} unthrottled.".format(client.addrport())
+        return "{} limited to {} bytes/sec.".format(client.addrport(), rate)
+
+
+    def _mirror(self, entry, args):
+        observer = self._find(args[0])
+        if args[1].lower() == 'off':
+            if observer.observing() is None:
+                return "{} is not observing anyone.".format(observer.addrport())
+            observer.observing().removeObserver(observer)
+            return "{} stopped observing.".format(observer.addrport())
+        client = self._find(args[1])
+        client.addObserver(observer)
+        log.info("Admin mirrored %s to %s.", client.addrport(), observer.addrport())
+        return "{} now observes {}.".format(observer.addrport(), client.addrport())
+
+
+    def _quit(self, entry, args):
+        self._write(entry, "Bye.\n")
+        self._close(entry[0].fileno())
@@ -0,0 +1,163 @@
+from sonzo.output import LANE_NORMAL
+from sonzo.scrollback import Scrollback, SCROLLBACK_LINES, SCROLLBACK_BYTES
+
+
+#=======================================================================
+# Channel Manager Class
+#=======================================================================
+
+class ChannelManager(object):
+    """
+    Channel (room, topic) subscriptions for targeted fan-out.
+
+    Keeps topic -> members and client -> topics maps so joining, leaving and
+    dropping a client from every channel it is in are all O(1) per channel,
+    and publishing only touches the members of one channel.  A published
+    message is encoded once and the same bytes object is queued for every
+    member.
+    """
+
+    def __init__(self):
+        """
+        Initialize channel manager.
+        """
+        # topic -> {client: None}, dicts used as insertion ordered sets
+        self._members = {}
+        # client -> {topic: None}
+        self._subscriptions = {}
+        # topic -> Scrollback, for topics that keep history
+        self._scrollback = {}
+
+
+    def join(self, client, topic):
+        """
+        Subscribe a client to a topic.
+        """
+        self._members.setdefault(topic, {})[client] = None
+        self._subscriptions.setdefault(client, {})[topic] = None
+
+
+    def leave(self, client, topic):
+        """
+        Unsubscribe a client from a topic.
+        """
+        members = self._members.get(topic)
+        if members is not None:
+            members.pop(client, None)
+            if not members:
+                del self._members[topic]
+        topics = self._subscriptions.get(client)
+        if topics is not None:
+            topics.pop(topic, None)
+            if not topics:
+                del self._subscriptions[client]
+
+
+    def leaveAll(self, client):
+        """
+        Remove a client from every topic it is subscribed to.  Returns the
+        topics it left.
+        """
+        topics = self._subscriptions.pop(client, {})
+        for topic in topics:
+            members = self._members[topic]
+            del members[client]
+            if not members:
+                del self._members[topic]
+        return list(topics)
+
+
+    def members(self, topic):
+        """
+        Return the clients subscribed to a topic.
+        """
+        return list(self._members.get(topic, ()))
+
+
+    def memberCount(self, topic):
+        """
+        Return the number of clients subscribed to a topic.
+        """
+        return len(self._members.get(topic, ()))
+
+
+    def subscriptions(self, client):
+        """
+        Return the topics a client is subscribed to.
+        """
+        return list(self._subscriptions.get(client, ()))
+
+
+    def isMember(self, client, topic):
+        """
+        Is the client subscribed to the topic?
+        """
+        return client in self._members.get(topic, ())
+
+
+    def topics(self):
+        """
+        Return every topic with at least one member.
+        """
+        return list(self._members)
+
+
+    def setScrollback(self, topic, lines=SCROLLBACK_LINES, max_bytes=SCROLLBACK_BYTES):
+        """
+        Keep the last lines published to a topic for replay().  Set lines
+        to 0 to stop keeping history.
+        """
+        if not lines:
+            self._scrollback.pop(topic, None)
+            return
+        self._scrollback[topic] = Scrollback(lines, max_bytes)
+
+
+    def scrollback(self, topic):
+        """
+        Return a topic's Scrollback, or None.
+        """
+        return self._scrollback.get(topic)
+
+
+    def scrollbackTopics(self):
+        """
+        Return every topic that keeps history.
+        """
+        return list(self._scrollback)
+
+
+    def replay(self, topic, client):
+        """
+        Catch a client up on a topic's history with one write.
+        """
+        history = self._scrollback.get(topic)
+        if history is not None:
+            history.replay(client)
+
+
+    def publish(self, topic, message, plain=None, exclude=None, lane=LANE_NORMAL):
+        """
+        Send a message to every member of a topic.  Returns the number of
+        clients it was queued for.
+
+        plain: Variant of the message for clients with ANSI turned off.
+        exclude: A client that should not get the message, e.g. the sender.
+        """
+        members = self._members.get(topic)
+        history = self._scrollback.get(topic)
+        if not members and history is None:
+            return 0
+        data = bytes(message, "cp1252")
+        plain_data = data if plain is None else bytes(plain, "cp1252")
+        if history is not None:
+            history.append(data, plain_data)
+        if not members:
+            return 0
+        count = 0
+        for client in members:
+            if client is exclude:
+                continue
+            client.sendEncoded(data if client._ansi else plain_data, lane)
+            count += 1
+        return count
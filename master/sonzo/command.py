@@ -0,0 +1,322 @@
+import logging
+import shlex
+import string
+import time
+
+log = logging.getLogger(__name__)
+
+
+#=======================================================================
+# Command Class
+#=======================================================================
+
+class Command(object):
+    """
+    A registered command and its timing stats.
+    """
+    __slots__ = ('name', 'func', 'priority', 'order', 'help', 'abbreviate', 'words',
+                 'calls', 'total_time', 'max_time')
+
+    def __init__(self, name, func, priority=0, order=0, help=None, abbreviate=True):
+        """
+        Initialize command.
+        """
+        self.name = name
+        self.func = func
+        self.priority = priority
+        self.order = order              # Registration order, breaks ties
+        self.help = help or func.__doc__
+        self.abbreviate = abbreviate
+        self.words = []                 # Folded words it is registered under
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def _outranks(self, other):
+        """
+        Should this command win an abbreviation shared with other?
+        """
+        if other is None:
+            return True
+        if self.priority != other.priority:
+            return self.priority > other.priority
+        return self.order < other.order
+
+
+#=======================================================================
+# Arguments Class
+#=======================================================================
+
+class Arguments(object):
+    """
+    Arguments passed to a command handler.
+
+    command: The word the user typed, e.g. "l" for "look".
+    text: Everything after the command word, stripped.
+    argv: text split into words, honoring quotes.
+    """
+    __slots__ = ('command', 'text', '_argv')
+
+    def __init__(self, command, text):
+        self.command = command
+        self.text = text
+        self._argv = None
+
+    @property
+    def argv(self):
+        """
+        Return the arguments split into words, parsed on first use.
+        """
+        if self._argv is None:
+            try:
+                self._argv = shlex.split(self.text)
+            except ValueError:
+                # Unbalanced quotes, fall back to plain words.
+                self._argv = self.text.split()
+        return self._argv
+
+    def __len__(self):
+        return len(self.argv)
+
+    def __getitem__(self, index):
+        return self.argv[index]
+
+
+#=======================================================================
+# Command Router Class
+#=======================================================================
+
+class _TrieNode(object):
+    """
+    Node in the command prefix trie.
+    """
+    __slots__ = ('children', 'exact', 'best')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = None               # Command whose full name ends here
+        self.best = None                # Command an abbreviation ending here picks
+
+
+class CommandRouter(object):
+    """
+    Routes command lines to registered handlers.
+
+    Commands are kept in a prefix trie where every node remembers which
+    command its prefix abbreviates, so a lookup costs one step per character
+    typed no matter how many commands are registered.  An exact name always
+    wins; otherwise the highest priority command with that prefix wins, and
+    between equals the one registered first ("l" -> "look" if look was
+    registered before list).  An abbreviation needs min_abbreviation
+    characters after any leading punctuation, so a bare "/" or "@" is not
+    taken for the first command that starts with it.
+
+        router = CommandRouter(default=say)
+
+        @router.command('look', aliases=('examine',))
+        def look(client, args):
+            ...
+
+        router.dispatch(client, line)
+    """
+
+    def __init__(self, default=None, case_sensitive=False, min_abbreviation=1):
+        """
+        Initialize command router.
+
+        default: Called as default(client, line) for lines that are not a
+                 known command.
+        case_sensitive: Match command words case sensitively.
+        min_abbreviation: Characters an abbreviation needs after leading
+                          punctuation.
+        """
+        self._root = _TrieNode()
+        self._commands = {}
+        self._order = 0
+        self._default = default
+        self._case_sensitive = case_sensitive
+        self._min_abbreviation = min_abbreviation
+
+
+    def command(self, name, aliases=(), priority=0, help=None, abbreviate=True):
+        """
+        Decorator that registers a function as a command handler.
+        """
+        def decorator(func):
+            self.register(name, func, aliases=aliases, priority=priority,
+                          help=help, abbreviate=abbreviate)
+            return func
+        return decorator
+
+
+    def register(self, name, func, aliases=(), priority=0, help=None, abbreviate=True):
+        """
+        Register func(client, args) under name and any aliases.
+
+        abbreviate: Set to False for commands that must be typed in full.
+
+        Registering a name again replaces the earlier command and all of its
+        aliases.
+        """
+        if name in self._commands:
+            log.warning("Command '%s' registered again, replacing it.", name)
+            self.unregister(name)
+        command = Command(name, func, priority, self._order, help, abbreviate)
+        self._order += 1
+        for word in (name,) + tuple(aliases):
+            self._insert(self._fold(word), command)
+        self._commands[name] = command
+        return command
+
+
+    def unregister(self, name):
+        """
+        Remove a command and its aliases.  Returns the Command, or None if
+        no command has that name.
+        """
+        command = self._commands.pop(name, None)
+        if command is None:
+            return None
+        for word in command.words:
+            node = self._find(word)
+            if node is not None and node.exact is command:
+                node.exact = None
+                self._repair(word)
+        return command
+
+
+    def _insert(self, word, command):
+        """
+        Add a command word to the trie.
+        """
+        node = self._root
+        for char in word:
+            node = node.children.setdefault(char, _TrieNode())
+            if command.abbreviate and command._outranks(node.best):
+                node.best = command
+        replaced = node.exact
+        node.exact = command
+        command.words.append(word)
+        if replaced is not None and replaced is not command:
+            log.warning("Command '%s' replaces '%s'.", command.name, replaced.name)
+            replaced.words.remove(word)
+            if replaced.abbreviate:
+                self._repair(word)
+
+
+    def _repair(self, word):
+        """
+        Work out again which command each prefix of word abbreviates, after
+        the command ending at word changed.
+        """
+        path = [self._root]
+        for char in word:
+            path.append(path[-1].children[char])
+        # Deepest first, so each node can start from its children's choices.
+        for node in reversed(path[1:]):
+            best = node.exact if node.exact is not None and node.exact.abbreviate else None
+            for child in node.children.values():
+                if child.best is not None and child.best._outranks(best):
+                    best = child.best
+            node.best = best
+
+
+    def _find(self, word):
+        """
+        Return the trie node for a folded word, or None.
+        """
+        node = self._root
+        for char in word:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+
+    def _fold(self, word):
+        """
+        Normalize a command word for matching.
+        """
+        return word if self._case_sensitive else word.lower()
+
+
+    def lookup(self, word):
+        """
+        Return the Command a (possibly abbreviated) word refers to, or None.
+        """
+        node = self._find(self._fold(word))
+        if node is None:
+            return None
+        if node.exact is not None:
+            return node.exact
+        if len(word.lstrip(string.punctuation)) < self._min_abbreviation:
+            return None
+        return node.best
+
+
+    def complete(self, prefix):
+        """
+        Return the sorted command words that start with prefix.
+        """
+        node = self._root
+        prefix = self._fold(prefix)
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return []
+        words = []
+        stack = [(node, prefix)]
+        while stack:
+            node, word = stack.pop()
+            if node.exact is not None:
+                words.append(word)
+            for char, child in node.children.items():
+                stack.append((child, word + char))
+        return sorted(words)
+
+
+    def commands(self):
+        """
+        Return the registered commands.
+        """
+        return list(self._commands.values())
+
+
+    def dispatch(self, client, line):
+        """
+        Run the handler for a command line.  Returns True if a command or
+        the default handler took the line.
+        """
+        text = line.strip()
+        if not text:
+            return False
+        parts = text.split(None, 1)
+        word = parts[0]
+        command = self.lookup(word)
+        if command is None:
+            if self._default is not None:
+                self._default(client, line)
+                return True
+            return False
+
+        args = Arguments(word, parts[1] if len(parts) > 1 else '')
+        start = time.perf_counter()
+        try:
+            command.func(client, args)
+        finally:
+            elapsed = time.perf_counter() - start
+            command.calls += 1
+            command.total_time += elapsed
+            if elapsed > command.max_time:
+                command.max_time = elapsed
+        return True
+
+
+    def stats(self):
+        """
+        Return (name, calls, total_time, max_time) for every command, most
+        time consuming first.
+        """
+        rows = [(c.name, c.calls, c.total_time, c.max_time) for c in self._commands.values()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows
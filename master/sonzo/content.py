@@ -0,0 +1,189 @@
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+from sonzo.output import FileChunk
+
+log = logging.getLogger(__name__)
+
+
+#--[ Content Cache ]-----------------------------------------------------------
+
+## Seconds between checks of a cached file's modification time
+CHECK_INTERVAL = 1.0
+## Files at least this large are sent with os.sendfile() when no transform
+## is needed
+SENDFILE_SIZE = 65536
+## Bytes of rendered content kept before the least recently used file is
+## dropped
+CONTENT_CACHE_BYTES = 16777216
+
+HAVE_SENDFILE = hasattr(os, 'sendfile')
+
+## Line endings of any flavour, rendered as telnet's CR LF
+_NEWLINE = re.compile(rb'\r?\n\r?')
+## ANSI escape sequences, removed for the plain variant
+_ANSI = re.compile(rb'\x1b(?:\[[0-9;?]*[ -/]*[@-~]|[@-Z\\-_])')
+
+
+def render(raw):
+    """
+    Return file contents as telnet output: CR LF line endings and IAC
+    bytes doubled.
+    """
+    return _NEWLINE.sub(b'\r\n', raw).replace(b'\xff', b'\xff\xff')
+
+
+def strip_ansi(data):
+    """
+    Return data without ANSI escape sequences.
+    """
+    return _ANSI.sub(b'', data)
+
+
+class CachedFile(object):
+    """
+    A file read once and rendered for ANSI and plain clients.
+
+    When a variant comes out byte for byte the same as the file and the file
+    is at least SENDFILE_SIZE, that variant is queued as a FileChunk so
+    plain TCP clients get it with os.sendfile().  Otherwise the rendered
+    bytes are queued, one object shared by every client.
+    """
+    __slots__ = ('path', 'mtime', 'size', 'inode', 'checked', 'ansi', 'plain')
+
+    def __init__(self, path, sendfile_size=SENDFILE_SIZE):
+        """
+        Initialize cached file, reading and rendering it.
+        """
+        self.path = path
+        content_file = open(path, 'rb')
+        try:
+            stat = os.fstat(content_file.fileno())
+            raw = content_file.read()
+        except OSError:
+            content_file.close()
+            raise
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.inode = stat.st_ino
+        self.checked = time.time()
+        ansi = render(raw)
+        plain = strip_ansi(ansi)
+        if HAVE_SENDFILE and len(raw) >= sendfile_size and (ansi == raw or plain == raw):
+            # Queued chunks keep the file open, so a file replaced on disk
+            # is still sent whole to clients already sending it.
+            chunk = FileChunk(raw, content_file)
+            ansi = chunk if ansi == raw else ansi
+            plain = chunk if plain == raw else plain
+        else:
+            content_file.close()
+        self.ansi = ansi
+        self.plain = plain
+
+
+    def __len__(self):
+        """
+        Return the bytes held for the file's variants.
+        """
+        if self.ansi is self.plain:
+            return len(self.ansi)
+        return len(self.ansi) + len(self.plain)
+
+
+    def variant(self, ansi=True):
+        """
+        Return the bytes or FileChunk to queue for an ANSI or a plain client.
+        """
+        return self.ansi if ansi else self.plain
+
+
+    def changed(self):
+        """
+        Has the file been modified, replaced or removed since it was read?
+        """
+        self.checked = time.time()
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return (stat.st_mtime != self.mtime or stat.st_size != self.size or
+                stat.st_ino != self.inode)
+
+
+class ContentCache(object):
+    """
+    Static content such as login banners, help files and ASCII art, read
+    once and shared by every client that is sent it.
+
+    Each file is checked for changes at most once every check_interval
+    seconds, so a login storm costs no more than one stat() a second per
+    file, and an edited file is picked up on the next check.
+
+        server.content.get('text/motd.txt')
+        client.sendFile('text/motd.txt')
+    """
+
+    def __init__(self, check_interval=CHECK_INTERVAL, sendfile_size=SENDFILE_SIZE,
+                 max_bytes=CONTENT_CACHE_BYTES):
+        """
+        Initialize content cache.
+        """
+        self.check_interval = check_interval
+        self.sendfile_size = sendfile_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.loads = 0
+        self._size = 0
+        # Path -> CachedFile, least recently used first
+        self._files = OrderedDict()
+
+
+    def __len__(self):
+        """
+        Return the number of files cached.
+        """
+        return len(self._files)
+
+
+    def size(self):
+        """
+        Return the bytes held for cached files.
+        """
+        return self._size
+
+
+    def get(self, path):
+        """
+        Return the CachedFile for path, reading it if it is not cached or
+        has changed.  Raises OSError if the file cannot be read.
+        """
+        cached = self._files.get(path)
+        if cached is not None:
+            if time.time() - cached.checked < self.check_interval or not cached.changed():
+                self._files.move_to_end(path)
+                self.hits += 1
+                return cached
+            log.debug("Reloading changed file %s.", path)
+            self.invalidate(path)
+        cached = CachedFile(path, self.sendfile_size)
+        self.loads += 1
+        self._files[path] = cached
+        self._size += len(cached)
+        while self._size > self.max_bytes and len(self._files) > 1:
+            self.invalidate(next(iter(self._files)))
+        return cached
+
+
+    def invalidate(self, path=None):
+        """
+        Forget a cached file, or every file.  Output already queued keeps
+        the old contents.
+        """
+        paths = list(self._files) if path is None else [path]
+        for path in paths:
+            cached = self._files.pop(path, None)
+            if cached is not None:
+                self._size -= len(cached)
@@ -0,0 +1,127 @@
+import array
+import json
+import socket
+import struct
+import time
+
+
+#--[ Process Handoff ]---------------------------------------------------------
+
+## Bumped whenever the layout of the handoff state changes
+HANDOFF_VERSION = 1
+## File descriptors passed per message, under the kernel's SCM_MAX_FD
+MAX_FDS_PER_MESSAGE = 250
+## Seconds either side waits on the other before giving up, for the whole
+## exchange rather than each read or write
+HANDOFF_TIMEOUT = 10
+
+_HEADER = struct.Struct('!I')
+_ACK = b'K'
+
+
+class HandoffError(Exception):
+    """
+    Raised when a handoff between processes fails.
+    """
+
+
+def encode_bytes(data):
+    """
+    Return bytes as a str that survives JSON.
+    """
+    return bytes(data).decode('latin-1')
+
+
+def decode_bytes(text):
+    """
+    Reverse encode_bytes().
+    """
+    return text.encode('latin-1')
+
+
+def send_handoff(sock, state, fds, timeout=HANDOFF_TIMEOUT):
+    """
+    Send the handoff state and the file descriptors it refers to over a
+    connected Unix socket, then wait for the receiver to acknowledge.
+
+    state: JSON serializable dict.
+    fds: File descriptors, passed with SCM_RIGHTS in batches.
+    timeout: Seconds the whole exchange may take.
+    """
+    state = dict(state, version=HANDOFF_VERSION, fd_count=len(fds))
+    payload = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    deadline = time.monotonic() + timeout
+    try:
+        _settimeout(sock, deadline)
+        sock.sendall(_HEADER.pack(len(payload)) + payload)
+        for start in range(0, len(fds), MAX_FDS_PER_MESSAGE):
+            batch = array.array('i', fds[start:start + MAX_FDS_PER_MESSAGE])
+            _settimeout(sock, deadline)
+            sock.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, batch)])
+        if _recv_exactly(sock, 1, deadline) != _ACK:
+            raise HandoffError("Receiver did not acknowledge the handoff.")
+    except OSError as err:
+        raise HandoffError("Handoff failed: {}".format(err))
+
+
+def recv_handoff(path):
+    """
+    Connect to a running server's handoff socket and take over its state.
+    Returns (state, fds).
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    deadline = time.monotonic() + HANDOFF_TIMEOUT
+    fds = []
+    try:
+        _settimeout(sock, deadline)
+        sock.connect(path)
+        size = _HEADER.unpack(_recv_exactly(sock, _HEADER.size, deadline))[0]
+        state = json.loads(_recv_exactly(sock, size, deadline).decode('utf-8'))
+        if state.get('version') != HANDOFF_VERSION:
+            raise HandoffError("Handoff version {} is not supported.".format(state.get('version')))
+        space = socket.CMSG_SPACE(MAX_FDS_PER_MESSAGE * array.array('i').itemsize)
+        while len(fds) < state['fd_count']:
+            _settimeout(sock, deadline)
+            data, ancdata, flags, addr = sock.recvmsg(1, space)
+            if not data:
+                raise HandoffError("Sender closed the handoff socket.")
+            for level, kind, cmsg in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    batch = array.array('i')
+                    batch.frombytes(cmsg[:len(cmsg) - len(cmsg) % batch.itemsize])
+                    fds.extend(batch)
+        sock.sendall(_ACK)
+    except Exception as err:
+        # Nobody else will close what was received before the failure.
+        for fd in fds:
+            socket.close(fd)
+        if isinstance(err, HandoffError):
+            raise
+        raise HandoffError("Handoff failed: {}".format(err))
+    finally:
+        sock.close()
+    return state, fds
+
+
+def _settimeout(sock, deadline):
+    """
+    Give the next socket operation whatever time is left before deadline.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("timed out")
+    sock.settimeout(remaining)
+
+
+def _recv_exactly(sock, size, deadline):
+    """
+    Read exactly size bytes from a blocking socket before deadline.
+    """
+    data = b''
+    while len(data) < size:
+        _settimeout(sock, deadline)
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise HandoffError("Handoff socket closed early.")
+        data += chunk
+    return data
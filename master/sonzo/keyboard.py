@@ -0,0 +1,169 @@
+from sonzo import keyboard_map
+
+
+#--[ Key Decoding ]------------------------------------------------------------
+
+## Seconds to wait for the rest of an escape sequence before treating a lone
+## ESC as the escape key.
+ESC_TIMEOUT = 0.05
+
+## Common variants of keyboard_map sequences sent by other terminals.
+ALTERNATES = {
+    keyboard_map.ESC + 'OA': 'UPARROW',
+    keyboard_map.ESC + 'OB': 'DOWNARROW',
+    keyboard_map.ESC + 'OC': 'RIGHTARROW',
+    keyboard_map.ESC + 'OD': 'LEFTARROW',
+    keyboard_map.ESC + '[H': 'HOME',
+    keyboard_map.ESC + '[F': 'END',
+    keyboard_map.ESC + 'OH': 'HOME',
+    keyboard_map.ESC + 'OF': 'END',
+    keyboard_map.ESC + '[3~': 'DELETE',
+    keyboard_map.ESC + '[15~': 'F5',
+    }
+
+## Single characters reported as named keys instead of text.
+CONTROL_KEYS = {
+    keyboard_map.BACKSPACE: 'BACKSPACE',
+    keyboard_map.DELETE: 'DELETE',
+    keyboard_map.TAB: 'TAB',
+    }
+
+ENTER = 'ENTER'
+_END = ''      # Trie key holding the name of a complete sequence
+
+
+def compile_keymap(extra=ALTERNATES):
+    """
+    Build the escape sequence trie from every multi-character ESC sequence
+    in keyboard_map, plus any extra {sequence: name} entries.
+
+    Each node is a dict of next character -> node; a complete sequence
+    stores its key name under the '' key.
+    """
+    sequences = {}
+    for name, value in vars(keyboard_map).items():
+        if (name.isupper() and isinstance(value, str) and len(value) > 1 and
+                value[0] == keyboard_map.ESC):
+            sequences[value] = name
+    sequences.update(extra)
+
+    root = {}
+    for sequence, name in sequences.items():
+        node = root
+        for char in sequence[1:]:
+            node = node.setdefault(char, {})
+        node[_END] = name
+    return root
+
+
+_KEYMAP = compile_keymap()
+
+
+class KeyDecoder(object):
+    """
+    Incremental decoder that turns a character mode input stream into key
+    events.
+
+    feed() returns a list of (key, data) tuples.  key is a keyboard_map name
+    such as 'UPARROW' or 'F1', 'ENTER', a CONTROL_KEYS name, or None for a run
+    of plain text in data.  Escape sequences may be split across reads; a
+    partial sequence is held until the next feed() or until flush() is called
+    after ESC_TIMEOUT.
+    """
+    __slots__ = ('_root', '_node', '_pending', '_cr')
+
+    def __init__(self, keymap=None):
+        """
+        Initialize key decoder.
+        """
+        self._root = keymap if keymap is not None else _KEYMAP
+        self._node = None               # Trie node while inside a sequence
+        self._pending = ''              # Characters of the partial sequence
+        self._cr = False                # Last character was a carriage return
+
+
+    def pending(self):
+        """
+        Is a partial escape sequence waiting for more input?
+        """
+        return self._node is not None
+
+
+    def feed(self, data):
+        """
+        Decode data and return the completed key events.
+        """
+        events = []
+        text = []
+        for char in data:
+            node = self._node
+            if node is not None:
+                node = node.get(char)
+                if node is not None:
+                    self._pending += char
+                    if len(node) == 1 and _END in node:
+                        events.append((node[_END], self._pending))
+                        self._node = None
+                        self._pending = ''
+                    else:
+                        self._node = node
+                    continue
+                # Not a known sequence, give up on it and decode char normally.
+                self._emit_pending(events, text)
+
+            if self._cr:
+                self._cr = False
+                if char == '\n' or char == '\0':
+                    continue
+
+            if char == keyboard_map.ESC:
+                self._flush_text(text, events)
+                self._node = self._root
+                self._pending = char
+            elif char == '\r' or char == '\n':
+                self._flush_text(text, events)
+                events.append((ENTER, char))
+                self._cr = char == '\r'
+            elif char in CONTROL_KEYS:
+                self._flush_text(text, events)
+                events.append((CONTROL_KEYS[char], char))
+            else:
+                text.append(char)
+        self._flush_text(text, events)
+        return events
+
+
+    def flush(self):
+        """
+        Give up waiting on a partial escape sequence and return its events.
+        """
+        events = []
+        text = []
+        if self._node is not None:
+            self._emit_pending(events, text)
+            self._flush_text(text, events)
+        return events
+
+
+    def _emit_pending(self, events, text):
+        """
+        Turn a partial sequence into events: the key it completes if any,
+        otherwise ESC followed by plain text.
+        """
+        name = self._node.get(_END)
+        if name is not None:
+            events.append((name, self._pending))
+        else:
+            events.append(('ESC', keyboard_map.ESC))
+            text.extend(self._pending[1:])
+        self._node = None
+        self._pending = ''
+
+
+    def _flush_text(self, text, events):
+        """
+        Emit collected plain characters as one event.
+        """
+        if text:
+            events.append((None, ''.join(text)))
+            del text[:]
@@ -85,7 +85,7 @@ L_F = chr(102)
 U_F = chr(70)
 L_G = chr(103)
 U_G = chr(71)
-L_H = chr(104
+L_H = chr(104)
 U_H = chr(72)
 L_J = chr(106)
 U_J = chr(74)
@@ -128,7 +128,7 @@ HOME = chr(27) + chr(91) + chr(49) + chr(126)
 PAGEUP = chr(27) + chr(91) + chr(53) + chr(126)
 DELETE = chr(127)
 END = chr(27) + chr(91) + chr(52) + chr(126)
-PAGEDOWN = = chr(27) + chr(91) + chr(54) + chr(126)
+PAGEDOWN = chr(27) + chr(91) + chr(54) + chr(126)
 UPARROW = chr(27) + chr(91) + chr(65)
 DOWNARROW = chr(27) + chr(91) + chr(66)
 RIGHTARROW = chr(27) + chr(91) + chr(67)
@@ -0,0 +1,214 @@
+import time
+from collections import deque
+
+
+#--[ Latency Histograms ]------------------------------------------------------
+
+## Each power of two is split into 2**SUB_BITS buckets, so a recorded value
+## is off by at most 1 / 2**SUB_BITS (12.5%)
+SUB_BITS = 3
+_SUB = 1 << SUB_BITS
+## Percentiles reported by summary()
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def bucket_index(micros):
+    """
+    Return the bucket for a value in microseconds.  Values below 2 * _SUB
+    get a bucket each, above that the buckets widen with the value.
+    """
+    if micros < 2 * _SUB:
+        return micros if micros > 0 else 0
+    shift = micros.bit_length() - SUB_BITS - 1
+    return shift * _SUB + (micros >> shift)
+
+
+def bucket_bound(index):
+    """
+    Return the largest value in microseconds that falls in a bucket.
+    """
+    if index < 2 * _SUB:
+        return index
+    shift = index // _SUB - 1
+    return (((index % _SUB) + _SUB + 1) << shift) - 1
+
+
+class LatencyHistogram(object):
+    """
+    Log bucketed histogram of durations, in the style of HdrHistogram: a
+    constant relative error at any scale, O(1) recording and a few hundred
+    bytes of counts.  Buckets are only allocated up to the largest value
+    seen.
+    """
+    __slots__ = ('_counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        """
+        Initialize an empty histogram.
+        """
+        self._counts = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def record(self, seconds):
+        """
+        Add a duration.
+        """
+        index = bucket_index(int(seconds * 1000000))
+        counts = self._counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+
+    def merge(self, other):
+        """
+        Add another histogram's counts to this one.
+        """
+        counts = self._counts
+        if len(other._counts) > len(counts):
+            counts.extend([0] * (len(other._counts) - len(counts)))
+        for index, count in enumerate(other._counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+
+    def percentile(self, percent):
+        """
+        Return the duration in seconds that percent of the recorded values
+        are at or below, rounded up to its bucket's bound.
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bucket_bound(index) / 1000000.0, self.max)
+        return self.max
+
+
+    def summary(self):
+        """
+        Return a dict of count, mean, max and the PERCENTILES ('p50' ...)
+        in seconds.
+        """
+        stats = {'count': self.count, 'max': self.max,
+                 'mean': self.total / self.count if self.count else 0.0}
+        for percent in PERCENTILES:
+            stats['p{:g}'.format(percent)] = self.percentile(percent)
+        return stats
+
+
+class ConnectionLatency(object):
+    """
+    Latency histograms of one connection.
+
+    input: From a command completing in _recv() to its dispatch to the
+           application.
+    output: From send() queueing a message to the last of its bytes being
+            written to the socket.  Echo is timed from the keystrokes being
+            read, as the round trip a typist feels.
+
+    Queued output is matched to socket writes by byte offsets within each
+    lane, so lanes overtaking each other are timed correctly.  Output
+    dropped from the bulk lane is timed as leaving when it is dropped.
+    """
+    __slots__ = ('input', 'output', '_commands', '_stamps', '_added', '_echo')
+
+    def __init__(self):
+        """
+        Initialize connection latency.
+        """
+        self.input = LatencyHistogram()
+        self.output = LatencyHistogram()
+        # Queue times of the newest commands waiting for dispatch
+        self._commands = deque()
+        # Per lane (byte offset the message ends at, queue time)
+        self._stamps = (deque(), deque(), deque())
+        # Bytes ever queued per lane, for matching writes to messages
+        self._added = [0, 0, 0]
+        # Time the oldest keystroke still waiting to be echoed was read
+        self._echo = None
+
+
+    def reset(self, queue):
+        """
+        Forget pending timings, for a client whose queues were filled by
+        something other than send() and its own input.
+        """
+        self._commands.clear()
+        self._echo = None
+        for lane in range(3):
+            self._stamps[lane].clear()
+            self._added[lane] = queue.laneSize(lane)
+
+
+    def commandQueued(self):
+        """
+        Note the time a command was queued.
+        """
+        self._commands.append(time.perf_counter())
+
+
+    def commandDispatched(self, waiting):
+        """
+        Time a command taken off the queue, with waiting commands still
+        queued behind it.  Commands queued without a time are skipped.
+        """
+        if len(self._commands) > waiting:
+            self.input.record(time.perf_counter() - self._commands.popleft())
+
+
+    def echoPending(self):
+        """
+        Note that keystrokes read now are waiting to be echoed.
+        """
+        if self._echo is None:
+            self._echo = time.perf_counter()
+
+
+    def echoQueued(self, size):
+        """
+        Note size bytes of echo queued on the interactive lane, timed from
+        the keystrokes being read.
+        """
+        stamp = self._echo if self._echo is not None else True
+        self._echo = None
+        self.queued(0, size, stamp)
+
+
+    def queued(self, lane, size, stamp=True):
+        """
+        Note size bytes queued on a lane, timed from now, from stamp if it is
+        a perf_counter() time, or not at all if it is False.
+        """
+        self._added[lane] += size
+        if stamp:
+            self._stamps[lane].append((self._added[lane], time.perf_counter() if stamp is True else stamp))
+
+
+    def sent(self, queue):
+        """
+        Time every message that has completely left an OutputQueue.
+        """
+        now = None
+        for lane in range(3):
+            stamps = self._stamps[lane]
+            if not stamps:
+                continue
+            removed = self._added[lane] - queue.laneSize(lane)
+            while stamps and stamps[0][0] <= removed:
+                if now is None:
+                    now = time.perf_counter()
+                self.output.record(now - stamps.popleft()[1])
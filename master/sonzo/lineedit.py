@@ -0,0 +1,264 @@
+from collections import deque
+
+
+#--[ Line Editing ]------------------------------------------------------------
+
+ESC = chr(27)
+## Number of lines kept in each client's history ring
+HISTORY_SIZE = 50
+## Ctrl-U, erase the whole line
+KILL_LINE = chr(21)
+
+
+def _move_left(count):
+    """
+    Return the shortest sequence that moves the cursor left count columns.
+    """
+    if count <= 0:
+        return ''
+    sequence = "{}[{}D".format(ESC, count)
+    return '\b' * count if count <= len(sequence) else sequence
+
+
+class LineEditor(object):
+    """
+    Server side line editor for clients that send a character at a time.
+
+    Takes KeyDecoder events and returns the echo needed to show the change.
+    Every edit is drawn as a minimal diff of the line on screen: typing at
+    the end echoes just the character, moving the cursor uses backspaces or
+    re-echoed characters when those are shorter than an escape sequence, and
+    recalling history only rewrites the part that differs.
+    """
+    __slots__ = ('_line', '_cursor', '_history', '_history_pos', '_draft',
+                 'password', 'completer')
+
+    def __init__(self, history_size=HISTORY_SIZE, completer=None):
+        """
+        Initialize line editor.
+
+        completer: Called as completer(line) on TAB, returns a list of
+                   candidate lines.
+        """
+        self._line = ''
+        self._cursor = 0
+        self._history = deque(maxlen=history_size)
+        self._history_pos = None        # Index into history while browsing
+        self._draft = ''                # Line being typed before browsing
+        self.password = False           # Echo '*' instead of the text
+        self.completer = completer
+
+
+    def __len__(self):
+        """
+        Return the length of the line being edited.
+        """
+        return len(self._line)
+
+
+    def line(self):
+        """
+        Return the line being edited.
+        """
+        return self._line
+
+
+    def history(self):
+        """
+        Return the history, oldest first.
+        """
+        return list(self._history)
+
+
+    def snapshot(self):
+        """
+        Return (line, cursor, history) for restore().
+        """
+        return self._line, self._cursor, list(self._history)
+
+
+    def restore(self, line, cursor, history):
+        """
+        Restore the state returned by snapshot().
+        """
+        self._line = line
+        self._cursor = max(0, min(cursor, len(line)))
+        self._history.clear()
+        self._history.extend(history)
+        self._history_pos = None
+        self._draft = ''
+
+
+    def key(self, key, data):
+        """
+        Apply one key event.  Returns (echo, line) where line is the
+        finished line when ENTER was pressed, otherwise None.
+        """
+        if key is None:
+            return self._insert(data), None
+        if key == 'ENTER':
+            return self._enter()
+        if key == 'BACKSPACE' or (key == 'DELETE' and data == chr(127)):
+            return self._backspace(), None
+        if key == 'DELETE':
+            return self._delete(), None
+        if key == 'LEFTARROW':
+            return self._move(self._cursor - 1), None
+        if key == 'RIGHTARROW':
+            return self._move(self._cursor + 1), None
+        if key == 'HOME':
+            return self._move(0), None
+        if key == 'END':
+            return self._move(len(self._line)), None
+        if key == 'UPARROW':
+            return self._browse(-1), None
+        if key == 'DOWNARROW':
+            return self._browse(1), None
+        if key == 'TAB':
+            return self._complete(), None
+        return '', None
+
+
+    def _show(self, text):
+        """
+        Return text as it should be echoed.
+        """
+        return '*' * len(text) if self.password else text
+
+
+    def _insert(self, text):
+        """
+        Insert typed text at the cursor.
+        """
+        if KILL_LINE in text:
+            text = text[text.rindex(KILL_LINE) + 1:]
+            echo = self._replace('')
+        else:
+            echo = ''
+        # Drop control characters the decoder passed through as text.
+        text = ''.join(char for char in text if char >= ' ')
+        if not text:
+            return echo
+        tail = self._line[self._cursor:]
+        self._line = self._line[:self._cursor] + text + tail
+        self._cursor += len(text)
+        if not tail:
+            return echo + self._show(text)
+        return echo + self._show(text + tail) + _move_left(len(tail))
+
+
+    def _backspace(self):
+        """
+        Erase the character left of the cursor.
+        """
+        if not self._cursor:
+            return ''
+        tail = self._line[self._cursor:]
+        self._line = self._line[:self._cursor - 1] + tail
+        self._cursor -= 1
+        return '\b' + self._show(tail) + ' ' + _move_left(len(tail) + 1)
+
+
+    def _delete(self):
+        """
+        Erase the character under the cursor.
+        """
+        if self._cursor == len(self._line):
+            return ''
+        tail = self._line[self._cursor + 1:]
+        self._line = self._line[:self._cursor] + tail
+        return self._show(tail) + ' ' + _move_left(len(tail) + 1)
+
+
+    def _move(self, position):
+        """
+        Move the cursor to position.
+        """
+        position = max(0, min(position, len(self._line)))
+        if position < self._cursor:
+            echo = _move_left(self._cursor - position)
+        else:
+            # Re-echoing the characters is usually shorter than ESC[nC.
+            skipped = self._show(self._line[self._cursor:position])
+            sequence = "{}[{}C".format(ESC, position - self._cursor)
+            echo = skipped if len(skipped) <= len(sequence) else sequence
+        self._cursor = position
+        return echo
+
+
+    def _replace(self, line):
+        """
+        Replace the whole line, redrawing only what changed, and leave the
+        cursor at the end.
+        """
+        old = self._line
+        same = 0
+        limit = min(len(old), len(line))
+        while same < limit and old[same] == line[same]:
+            same += 1
+        echo = self._move(same)
+        echo += self._show(line[same:])
+        if len(old) > len(line):
+            echo += "{}[K".format(ESC)
+        self._line = line
+        self._cursor = len(line)
+        return echo
+
+
+    def _browse(self, step):
+        """
+        Step through the history, -1 for older and 1 for newer.
+        """
+        if self.password or not self._history:
+            return ''
+        if self._history_pos is None:
+            if step > 0:
+                return ''
+            self._draft = self._line
+            position = len(self._history) - 1
+        else:
+            position = self._history_pos + step
+            if position < 0:
+                return ''
+        if position >= len(self._history):
+            self._history_pos = None
+            return self._replace(self._draft)
+        self._history_pos = position
+        return self._replace(self._history[position])
+
+
+    def _complete(self):
+        """
+        Ask the completer for candidates.  One candidate replaces the line;
+        several extend it to their common prefix, or are listed below it.
+        """
+        if self.completer is None or self.password:
+            return ''
+        candidates = self.completer(self._line)
+        if not candidates:
+            return ''
+        if len(candidates) == 1:
+            return self._replace(candidates[0])
+        prefix = candidates[0]
+        for candidate in candidates[1:]:
+            while not candidate.startswith(prefix):
+                prefix = prefix[:-1]
+        if len(prefix) > len(self._line) and prefix.startswith(self._line):
+            return self._replace(prefix)
+        # Nothing more to fill in, list the choices and redraw the line.
+        return ("\r\n" + "  ".join(candidates) + "\r\n" + self._show(self._line) +
+                _move_left(len(self._line) - self._cursor))
+
+
+    def _enter(self):
+        """
+        Finish the line and add it to the history.
+        """
+        line = self._line
+        if line and not self.password and (not self._history or self._history[-1] != line):
+            self._history.append(line)
+        self._line = ''
+        self._cursor = 0
+        self._history_pos = None
+        self._draft = ''
+        return "\r\n", line
@@ -0,0 +1,219 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from collections import OrderedDict
+
+
+#--[ Logging ]-----------------------------------------------------------------
+
+## Format of records written by the batch writer.  conn is the client's
+## addr:port, or '-' for records not tied to a connection.
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s [%(conn)s] %(message)s'
+## Most records written in one batch
+BATCH_SIZE = 256
+## Seconds the writer waits for a batch to fill before writing
+BATCH_INTERVAL = 0.2
+## Connections tracked by the sampling and rate limit filters
+MAX_TRACKED = 4096
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes one in every rate records at or below level for each
+    connection.  Records above level always pass.
+    """
+
+    def __init__(self, rate, level=logging.DEBUG):
+        """
+        Initialize sampling filter.
+        """
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.level = level
+        self._counts = OrderedDict()
+
+    def filter(self, record):
+        if record.levelno > self.level or self.rate <= 1:
+            return True
+        conn = getattr(record, 'conn', None)
+        count = self._counts.pop(conn, 0)
+        self._counts[conn] = count + 1
+        if len(self._counts) > MAX_TRACKED:
+            self._counts.popitem(last=False)
+        return count % self.rate == 0
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per connection: at most rate records a second, with bursts
+    of up to burst records.  The next record let through after a drop says
+    how many were suppressed.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Initialize rate limit filter.
+        """
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        # conn -> [tokens, last refill, suppressed]
+        self._buckets = OrderedDict()
+
+    def filter(self, record):
+        conn = getattr(record, 'conn', None)
+        now = record.created
+        bucket = self._buckets.pop(conn, None)
+        if bucket is None:
+            bucket = [self.burst, now, 0]
+        self._buckets[conn] = bucket
+        if len(self._buckets) > MAX_TRACKED:
+            self._buckets.popitem(last=False)
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.suppressed = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+class ConnectionFormatter(logging.Formatter):
+    """
+    Formatter that fills in conn for records without one and notes records
+    dropped by a RateLimitFilter.
+    """
+
+    def format(self, record):
+        if not hasattr(record, 'conn'):
+            record.conn = '-'
+        text = logging.Formatter.format(self, record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += " ({} similar messages suppressed)".format(suppressed)
+        return text
+
+
+class BatchQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves formatting to the writer thread.  The
+    standard QueueHandler formats every record on the calling thread;
+    here only exception tracebacks are rendered before queueing, since they
+    refer to live frames.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class BatchWriter(threading.Thread):
+    """
+    Background thread that formats queued records and writes them in
+    batches, one write and flush per batch.
+    """
+
+    def __init__(self, log_queue, stream, formatter, batch_size=BATCH_SIZE,
+                 interval=BATCH_INTERVAL):
+        """
+        Initialize batch writer.
+        """
+        threading.Thread.__init__(self, name='sonzo-log', daemon=True)
+        self._queue = log_queue
+        self._stream = stream
+        self._formatter = formatter
+        self._batch_size = batch_size
+        self._interval = interval
+        self.written = 0
+        self.batches = 0
+
+    def run(self):
+        while True:
+            try:
+                record = self._queue.get(timeout=self._interval)
+            except queue.Empty:
+                continue
+            batch = []
+            stop = False
+            while True:
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+                if len(batch) >= self._batch_size:
+                    break
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def _write(self, batch):
+        """
+        Format and write a batch of records.
+        """
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self._formatter.format(record) + '\n')
+            except Exception:
+                lines.append("Could not format log record {!r}\n".format(record.msg))
+        try:
+            self._stream.write(''.join(lines))
+            self._stream.flush()
+        except (OSError, ValueError):
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    def stop(self):
+        """
+        Write whatever is queued and end the thread.
+        """
+        self._queue.put(None)
+        self.join()
+
+
+def setup_logging(stream=None, filename=None, level=logging.INFO, sample=1,
+                  rate=None, burst=None, fmt=LOG_FORMAT, logger='sonzo'):
+    """
+    Send the sonzo loggers through a queue to a background batch writer.
+    Returns the BatchWriter; call its stop() at shutdown to flush.
+
+    stream: Stream to write to, sys.stderr by default.
+    filename: Append to this file instead of a stream.
+    level: Records below this level are skipped before any formatting.
+    sample: Keep one in every sample DEBUG records per connection.
+    rate: Limit each connection to rate records a second.
+    burst: Records a connection may log at once before rate applies.
+    """
+    if filename is not None:
+        stream = open(filename, 'a', encoding='utf-8')
+    elif stream is None:
+        stream = sys.stderr
+    log_queue = queue.SimpleQueue()
+    handler = BatchQueueHandler(log_queue)
+    if sample > 1:
+        handler.addFilter(SamplingFilter(sample))
+    if rate:
+        handler.addFilter(RateLimitFilter(rate, burst))
+    writer = BatchWriter(log_queue, stream, ConnectionFormatter(fmt))
+    writer.start()
+
+    target = logging.getLogger(logger)
+    for old in [h for h in target.handlers if isinstance(h, BatchQueueHandler)]:
+        target.removeHandler(old)
+    target.addHandler(handler)
+    target.setLevel(level)
+    target.propagate = False
+    return writer
@@ -0,0 +1,104 @@
+import time
+from collections import deque
+
+
+#--[ Memory Accounting ]-------------------------------------------------------
+
+## Seconds between memory checks, each one walks every client's buffers
+MEMORY_CHECK_INTERVAL = 5
+## Samples kept for growth figures, an hour at one check every five seconds
+MEMORY_HISTORY = 720
+## Once over budget, new connections are refused until usage is back under
+## this share of the budget
+MEMORY_RESUME_RATIO = 0.9
+## A figure whose low point rises in every one of this many consecutive
+## stretches of the history is reported as a possible leak
+LEAK_WINDOWS = 6
+
+
+class MemoryMonitor(object):
+    """
+    Keeps the memory budget and a history of TelnetServer.memoryUsage()
+    samples.
+
+    The figures are payload bytes held by each subsystem (and object counts
+    such as timers), not Python object overhead, so they show which part of
+    the server is holding on to data rather than the exact process size.
+    """
+
+    def __init__(self, budget=None, history=MEMORY_HISTORY):
+        """
+        Initialize memory monitor.
+
+        budget: Bytes the server may hold before it sheds load, None for
+                no limit.
+        """
+        self.budget = budget
+        self.over_budget = False
+        self.shed = 0                   # Bytes of bulk output dropped
+        self.refused = 0                # Connections refused while over budget
+        # (time, {name: value}) samples, oldest first
+        self._history = deque(maxlen=history)
+
+
+    def sample(self, figures):
+        """
+        Record a sample of figures by name.
+        """
+        self._history.append((time.time(), figures))
+
+
+    def latest(self):
+        """
+        Return the newest sample's figures, or an empty dict.
+        """
+        if not self._history:
+            return {}
+        return self._history[-1][1]
+
+
+    def growth(self):
+        """
+        Return how much each figure changes per hour, measured from the
+        oldest sample to the newest.
+        """
+        if len(self._history) < 2:
+            return {}
+        first_time, first = self._history[0]
+        last_time, last = self._history[-1]
+        hours = (last_time - first_time) / 3600.0 or 1.0
+        return {name: (value - first.get(name, 0)) / hours for name, value in last.items()}
+
+
+    def suspects(self):
+        """
+        Return the names of figures that look like leaks: split the history
+        into LEAK_WINDOWS stretches, and the figure's lowest value rises
+        from each stretch to the next.  Buffers that fill and drain keep
+        dropping back and are not reported.
+        """
+        size = len(self._history) // LEAK_WINDOWS
+        if size < 2:
+            return []
+        samples = list(self._history)
+        suspects = []
+        for name in samples[-1][1]:
+            lows = [min(figures.get(name, 0) for stamp, figures in samples[start:start + size])
+                    for start in range(len(samples) - size * LEAK_WINDOWS, len(samples), size)]
+            if all(low < high for low, high in zip(lows, lows[1:])):
+                suspects.append(name)
+        return sorted(suspects)
+
+
+    def isOver(self, total):
+        """
+        Update and return over_budget for a total, with hysteresis so the
+        server does not flap between refusing and accepting connections.
+        """
+        if self.budget is None:
+            self.over_budget = False
+        elif total > self.budget:
+            self.over_budget = True
+        elif total <= self.budget * MEMORY_RESUME_RATIO:
+            self.over_budget = False
+        return self.over_budget
@@ -0,0 +1,288 @@
+from collections import deque
+from itertools import islice
+
+
+#--[ Output Lanes ]------------------------------------------------------------
+
+## Lanes are sent in priority order.  Interactive output (echo, prompts and
+## telnet negotiation) always goes first and is never held back.  Normal
+## output is held in line mode while the user is typing.  Bulk output only
+## goes out once the normal lane is empty, small bulk messages are coalesced
+## into one chunk and the oldest bulk messages are dropped once the lane grows
+## past its limit.
+LANE_INTERACTIVE = 0
+LANE_NORMAL = 1
+LANE_BULK = 2
+
+## Bytes of bulk output kept per client before the oldest is dropped
+BULK_LIMIT = 262144
+## Bulk messages smaller than this are joined onto the previous bulk chunk
+COALESCE_SIZE = 512
+## Most chunks handed to one socket write (well under IOV_MAX)
+MAX_WRITE_CHUNKS = 512
+
+
+class FileChunk(object):
+    """
+    Part of a file queued for output.  Plain TCP clients are sent it
+    straight from the file with os.sendfile(); other transports write
+    view(), taken from data, the file's contents already in memory.
+    """
+    __slots__ = ('data', 'file', 'offset', 'size')
+
+    def __init__(self, data, file, offset=0, size=None):
+        """
+        Initialize file chunk.
+
+        data: The file's contents.
+        file: The open file.
+        """
+        self.data = data
+        self.file = file
+        self.offset = offset
+        self.size = len(data) - offset if size is None else size
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return bytes(self.view())
+
+    def __contains__(self, data):
+        return self.data.find(data, self.offset, self.offset + self.size) >= 0
+
+    def __getitem__(self, cut):
+        start, stop, step = cut.indices(self.size)
+        return FileChunk(self.data, self.file, self.offset + start, max(0, stop - start))
+
+    def view(self):
+        """
+        Return the chunk's bytes from memory, without copying.
+        """
+        return memoryview(self.data)[self.offset:self.offset + self.size]
+
+
+class OutputQueue(object):
+    """
+    Per client queue of encoded output chunks split into priority lanes.
+    """
+    __slots__ = ('_lanes', '_sizes', 'bulk_limit', 'dropped', 'files', 'partial')
+
+    def __init__(self, bulk_limit=BULK_LIMIT):
+        """
+        Initialize an empty output queue.
+        """
+        self._lanes = (deque(), deque(), deque())
+        self._sizes = [0, 0, 0]
+        self.bulk_limit = bulk_limit
+        self.dropped = 0                # Bulk chunks dropped so far
+        self.files = False              # FileChunks queued since the queue was last empty
+        self.partial = None             # Lane whose head chunk is partly written
+
+
+    def __len__(self):
+        """
+        Return the number of bytes queued in all lanes.
+        """
+        sizes = self._sizes
+        return sizes[0] + sizes[1] + sizes[2]
+
+
+    def laneSize(self, lane):
+        """
+        Return the number of bytes queued in a lane.
+        """
+        return self._sizes[lane]
+
+
+    def laneChunks(self, lane):
+        """
+        Return the chunks queued on a lane, oldest first.
+        """
+        return list(self._lanes[lane])
+
+
+    def pending(self, last_lane=LANE_BULK):
+        """
+        Is there data queued in any lane up to and including last_lane, or a
+        partly written chunk to finish?
+        """
+        if self.partial is not None:
+            return True
+        sizes = self._sizes
+        for lane in range(last_lane + 1):
+            if sizes[lane]:
+                return True
+        return False
+
+
+    def append(self, data, lane=LANE_NORMAL, coalesce=True):
+        """
+        Queue an encoded chunk (bytes or memoryview) on a lane.
+
+        coalesce: Allow a small bulk chunk to be joined onto the previous
+                  one, which copies it.  Off for chunks shared by reference.
+        """
+        if not len(data):
+            return
+        if data.__class__ is FileChunk:
+            self.files = True
+        chunks = self._lanes[lane]
+        self._sizes[lane] += len(data)
+        if lane != LANE_BULK:
+            chunks.append(data)
+            return
+        # A partly written chunk is finished as it is, never joined onto.
+        if (coalesce and chunks and len(data) < COALESCE_SIZE and len(chunks[-1]) < COALESCE_SIZE and
+                (self.partial != LANE_BULK or len(chunks) > 1)):
+            chunks[-1] = bytes(chunks[-1]) + data
+        else:
+            chunks.append(data)
+        if self._sizes[lane] > self.bulk_limit:
+            self._trim_bulk()
+
+
+    def prepend(self, other):
+        """
+        Move everything queued in another OutputQueue in front of this
+        queue's output, lane by lane, leaving the other queue empty.  The
+        other queue's partly written chunk, if any, is the one to finish.
+        """
+        if len(other):
+            self.partial = other.partial
+        for lane in range(3):
+            chunks = other._lanes[lane]
+            if chunks:
+                chunks.extend(self._lanes[lane])
+                self._lanes[lane].clear()
+                self._lanes[lane].extend(chunks)
+                self._sizes[lane] += other._sizes[lane]
+        self.files = self.files or other.files
+        other.clear()
+
+
+    def trim(self, limit):
+        """
+        Drop the oldest output, bulk lane first, until at most limit bytes
+        are queued.  Returns the number of bytes dropped.
+        """
+        dropped = 0
+        for lane in (LANE_BULK, LANE_NORMAL, LANE_INTERACTIVE):
+            chunks = self._lanes[lane]
+            while chunks and len(self) > limit:
+                size = len(chunks.popleft())
+                self._sizes[lane] -= size
+                dropped += size
+                if self.partial == lane:
+                    self.partial = None
+        return dropped
+
+
+    def shed(self, lane=LANE_BULK):
+        """
+        Drop everything queued on a lane except a partly written chunk,
+        which has to be finished.  Returns the number of bytes dropped.
+        """
+        chunks = self._lanes[lane]
+        keep = 1 if self.partial == lane else 0
+        dropped = 0
+        while len(chunks) > keep:
+            chunk = chunks.pop()
+            dropped += len(chunk)
+            self.dropped += 1
+        self._sizes[lane] -= dropped
+        return dropped
+
+
+    def clear(self, lane=None):
+        """
+        Drop everything queued on a lane, or on every lane.
+        """
+        lanes = range(3) if lane is None else (lane,)
+        for lane in lanes:
+            self._lanes[lane].clear()
+            self._sizes[lane] = 0
+            if self.partial == lane:
+                self.partial = None
+        if not len(self):
+            self.files = False
+
+
+    def chunks(self, last_lane=LANE_BULK):
+        """
+        Return up to MAX_WRITE_CHUNKS queued chunks in send order, taken from
+        lanes up to and including last_lane.  The rest of a partly written
+        chunk always comes first, whatever its lane, so no output is
+        spliced into the middle of an escape sequence.
+        """
+        chunks = []
+        partial = self.partial
+        if partial is not None:
+            chunks.append(self._lanes[partial][0])
+        for lane in range(last_lane + 1):
+            # The partly written chunk is already first.
+            for chunk in islice(self._lanes[lane], 1 if lane == partial else 0, None):
+                chunks.append(chunk)
+                if len(chunks) == MAX_WRITE_CHUNKS:
+                    return chunks
+        return chunks
+
+
+    def consume(self, count):
+        """
+        Remove count bytes that were written from the front of the queue.
+        A partly written chunk is kept as a memoryview (or a shorter
+        FileChunk) so nothing is copied, and is finished before anything
+        else is written.
+        """
+        partial = self.partial
+        if partial is not None and count:
+            chunks = self._lanes[partial]
+            size = len(chunks[0])
+            if size > count:
+                chunks[0] = chunks[0][count:]
+                self._sizes[partial] -= count
+                return
+            chunks.popleft()
+            self._sizes[partial] -= size
+            count -= size
+            self.partial = None
+        for lane in range(3):
+            chunks = self._lanes[lane]
+            while count and chunks:
+                size = len(chunks[0])
+                if size <= count:
+                    chunks.popleft()
+                    self._sizes[lane] -= size
+                    count -= size
+                else:
+                    chunk = chunks[0]
+                    if chunk.__class__ is FileChunk:
+                        chunks[0] = chunk[count:]
+                    else:
+                        chunks[0] = memoryview(chunk)[count:]
+                    self._sizes[lane] -= count
+                    self.partial = lane
+                    return
+            if not count:
+                break
+        if self.files and not len(self):
+            self.files = False
+
+
+    def _trim_bulk(self):
+        """
+        Drop the oldest bulk chunks until the lane fits in bulk_limit.  The
+        newest chunk is always kept.
+        """
+        chunks = self._lanes[LANE_BULK]
+        # A partly written chunk has to be finished, so start after it.
+        keep = 1 if self.partial == LANE_BULK else 0
+        while self._sizes[LANE_BULK] > self.bulk_limit and len(chunks) > keep + 1:
+            if keep:
+                chunk = chunks[1]
+                del chunks[1]
+            else:
+                chunk = chunks.popleft()
+            self._sizes[LANE_BULK] -= len(chunk)
+            self.dropped += 1
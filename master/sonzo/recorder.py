@@ -0,0 +1,113 @@
+import json
+import os
+import struct
+import time
+
+
+#--[ Session Recording ]-------------------------------------------------------
+
+## Record file magic and format version
+RECORD_MAGIC = b'SZREC\x01'
+
+## Record kinds
+REC_CONNECT = 0     # Session started, data is JSON metadata
+REC_RECV = 1        # Bytes read from the client
+REC_SEND = 2        # Bytes written to the client
+REC_CLOSE = 3       # Session ended
+
+## Microseconds since the recording started, kind, data length
+_RECORD = struct.Struct('!QBI')
+
+
+class SessionRecorder(object):
+    """
+    Writes the raw traffic of one session to a compact binary log.
+
+    Each record is a 13 byte header (microseconds since the recording
+    started, kind, length) followed by the bytes exactly as they crossed the
+    socket, so IAC sequences, paste bursts and partial writes to slow
+    readers are all kept.  Records are buffered and reach the disk in large
+    writes.
+    """
+    __slots__ = ('path', '_file', '_start', 'records', 'bytes')
+
+    def __init__(self, path, meta=None):
+        """
+        Initialize recorder and write the connect record.
+
+        meta: JSON serializable session details, e.g. the client address.
+        """
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(RECORD_MAGIC)
+        self._start = time.time()
+        self.records = 0
+        self.bytes = 0
+        meta = dict(meta or {}, start=self._start)
+        self._write(REC_CONNECT, json.dumps(meta).encode('utf-8'))
+
+
+    def _write(self, kind, data):
+        """
+        Append a record.
+        """
+        offset = int((time.time() - self._start) * 1000000)
+        self._file.write(_RECORD.pack(offset, kind, len(data)))
+        self._file.write(data)
+        self.records += 1
+        self.bytes += len(data)
+
+
+    def recv(self, data):
+        """
+        Record bytes read from the client.
+        """
+        self._write(REC_RECV, data)
+
+
+    def send(self, data):
+        """
+        Record bytes written to the client.
+        """
+        self._write(REC_SEND, data)
+
+
+    def close(self):
+        """
+        Write the close record and close the file.
+        """
+        if self._file is not None:
+            self._write(REC_CLOSE, b'')
+            self._file.close()
+            self._file = None
+
+
+def recording_path(directory, addr, port):
+    """
+    Return a unique file name for a session from addr:port.
+    """
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    name = "{}-{}-{}.rec".format(stamp, addr.replace(':', '_').replace(os.sep, '_'), port)
+    return os.path.join(directory, name)
+
+
+def read_recording(path):
+    """
+    Yield (seconds, kind, data) for every record in a recording.  The
+    connect record's data is decoded to a dict.
+    """
+    with open(path, 'rb') as record_file:
+        if record_file.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError("{} is not a session recording.".format(path))
+        while True:
+            header = record_file.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                # A session still being recorded, or a crash, ends mid record.
+                return
+            offset, kind, size = _RECORD.unpack(header)
+            data = record_file.read(size)
+            if len(data) < size:
+                return
+            if kind == REC_CONNECT:
+                data = json.loads(data.decode('utf-8'))
+            yield offset / 1000000.0, kind, data
@@ -0,0 +1,174 @@
+import argparse
+import heapq
+import logging
+import socket
+import time
+
+from sonzo.recorder import read_recording, REC_CONNECT, REC_RECV, REC_SEND, REC_CLOSE
+
+log = logging.getLogger(__name__)
+
+
+#=======================================================================
+# Replay Driver Class
+#=======================================================================
+
+class ReplayDriver(object):
+    """
+    Plays recorded sessions back against a running server.
+
+    Every recording becomes a client connection that sends the recorded
+    input at the recorded times, divided by speed.  Sessions keep their
+    original start times relative to each other, so a set of recordings
+    from one server replays the same overlapping mix of clients.
+
+    With pace_reads the driver reads server output only when and as much
+    as the original client did, so slow readers from production put the
+    same backpressure on the server.  Otherwise output is read as fast as
+    it arrives.
+
+        driver = ReplayDriver('127.0.0.1', 23, speed=10)
+        driver.add('recordings/20240101-120000-10.0.0.1-52000.rec')
+        stats = driver.run()
+    """
+
+    def __init__(self, address='127.0.0.1', port=23, speed=1.0, pace_reads=True):
+        """
+        Initialize replay driver.
+
+        speed: 1 replays in real time, 10 ten times faster.
+        pace_reads: Read output at the recorded pace instead of draining it.
+        """
+        self._address = address
+        self._port = port
+        self._speed = speed
+        self._pace_reads = pace_reads
+        # (start time, [(seconds, kind, data)]) for every recording added
+        self._sessions = []
+
+
+    def add(self, path):
+        """
+        Load a recording to replay.
+        """
+        records = list(read_recording(path))
+        if not records or records[0][1] != REC_CONNECT:
+            log.warning("Skipping %s, it has no connect record.", path)
+            return
+        self._sessions.append((records[0][2].get('start', 0.0), records))
+
+
+    def run(self):
+        """
+        Replay every added recording and return a dict of stats.
+        """
+        stats = {'sessions': len(self._sessions), 'bytes_sent': 0, 'bytes_received': 0,
+                 'bytes_recorded': 0, 'max_lag': 0.0, 'elapsed': 0.0}
+        if not self._sessions:
+            return stats
+        base = min(start for start, records in self._sessions)
+        events = []
+        for number, (start, records) in enumerate(self._sessions):
+            for order, (seconds, kind, data) in enumerate(records):
+                due = (start - base + seconds) / self._speed
+                events.append((due, number, order, kind, data))
+                if kind == REC_SEND:
+                    stats['bytes_recorded'] += len(data)
+        heapq.heapify(events)
+
+        sockets = {}
+        begin = time.time()
+        while events:
+            due, number, order, kind, data = heapq.heappop(events)
+            wait = due - (time.time() - begin)
+            if wait > 0:
+                if self._pace_reads:
+                    time.sleep(wait)
+                else:
+                    self._drain(sockets, stats, wait)
+            else:
+                stats['max_lag'] = max(stats['max_lag'], -wait)
+
+            if kind == REC_CONNECT:
+                try:
+                    sockets[number] = socket.create_connection((self._address, self._port))
+                except OSError as err:
+                    log.error("Replay connect failed: %s", err)
+                continue
+            sock = sockets.get(number)
+            if sock is None:
+                continue
+            try:
+                if kind == REC_RECV:
+                    sock.sendall(data)
+                    stats['bytes_sent'] += len(data)
+                elif kind == REC_SEND and self._pace_reads:
+                    self._read(sock, len(data), stats)
+                elif kind == REC_CLOSE:
+                    self._read(sock, 65536, stats)
+                    sock.close()
+                    del sockets[number]
+            except ConnectionError:
+                # The server hung up first.
+                sock.close()
+                del sockets[number]
+
+        for sock in sockets.values():
+            sock.close()
+        stats['elapsed'] = time.time() - begin
+        return stats
+
+
+    def _read(self, sock, size, stats):
+        """
+        Read up to size bytes that have already arrived.
+        """
+        try:
+            data = sock.recv(size, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionResetError()
+        stats['bytes_received'] += len(data)
+
+
+    def _drain(self, sockets, stats, wait):
+        """
+        Read everything that arrives on any session for wait seconds.
+        """
+        until = time.time() + wait
+        while True:
+            for number, sock in list(sockets.items()):
+                try:
+                    self._read(sock, 65536, stats)
+                except ConnectionError:
+                    sock.close()
+                    del sockets[number]
+            remaining = until - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.01))
+
+
+def main():
+    """
+    Replay recordings from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Replay recorded telnet sessions.")
+    parser.add_argument('recordings', nargs='+', help="Recording files.")
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=23)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Replay speed, e.g. 10 for ten times faster.")
+    parser.add_argument('--drain', action='store_true',
+                        help="Read output as fast as it arrives instead of at the recorded pace.")
+    args = parser.parse_args()
+    driver = ReplayDriver(args.address, args.port, args.speed, pace_reads=not args.drain)
+    for path in args.recordings:
+        driver.add(path)
+    for name, value in sorted(driver.run().items()):
+        print("{}: {}".format(name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+from collections import deque
+
+from sonzo.output import LANE_NORMAL
+
+
+#--[ Scrollback Limits ]-------------------------------------------------------
+
+SCROLLBACK_LINES = 100
+SCROLLBACK_BYTES = 65536
+
+
+class Scrollback(object):
+    """
+    Bounded ring buffer of encoded output lines.
+
+    Lines are kept as the bytes objects that were queued for clients, so
+    recording costs no copies, and the oldest lines are dropped once either
+    the line or byte limit is reached.  replay() sends the whole history to
+    a client as a single write.
+    """
+    __slots__ = ('_lines', '_size', 'max_lines', 'max_bytes')
+
+    def __init__(self, max_lines=SCROLLBACK_LINES, max_bytes=SCROLLBACK_BYTES):
+        """
+        Initialize scrollback.
+        """
+        # (data, plain) pairs, plain is data when there is no plain variant
+        self._lines = deque()
+        self._size = 0
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+
+
+    def __len__(self):
+        """
+        Return the number of lines held.
+        """
+        return len(self._lines)
+
+
+    def size(self):
+        """
+        Return the number of bytes held.
+        """
+        return self._size
+
+
+    def append(self, data, plain=None):
+        """
+        Record an encoded line, with an optional plain (non-ANSI) variant.
+        """
+        if plain is None:
+            plain = data
+        self._lines.append((data, plain))
+        self._size += len(data) if plain is data else len(data) + len(plain)
+        while self._lines and (len(self._lines) > self.max_lines or self._size > self.max_bytes):
+            data, plain = self._lines.popleft()
+            self._size -= len(data) if plain is data else len(data) + len(plain)
+
+
+    def items(self):
+        """
+        Return the held (data, plain) pairs, oldest first.
+        """
+        return list(self._lines)
+
+
+    def clear(self):
+        """
+        Drop every line.
+        """
+        self._lines.clear()
+        self._size = 0
+
+
+    def render(self, ansi=True):
+        """
+        Return the held lines joined into one bytes object.
+        """
+        index = 0 if ansi else 1
+        return b''.join(line[index] for line in self._lines)
+
+
+    def replay(self, client, lane=LANE_NORMAL):
+        """
+        Catch a client up by queueing the held lines as one write.
+        """
+        if self._lines:
+            client.sendEncoded(self.render(client._ansi), lane, record=False)
@@ -0,0 +1,77 @@
+#--[ Session Resume ]----------------------------------------------------------
+
+## Seconds a detached session waits for its owner to reconnect
+RESUME_GRACE = 120
+## Bytes of output buffered for a detached session before the oldest is dropped
+DETACHED_OUTPUT_LIMIT = 65536
+
+
+class SessionStore(object):
+    """
+    Detached sessions waiting for their owner to reconnect.
+
+    When the socket of a client with a session key drops, TelnetServer
+    detaches the client object instead of ending its session.  The object
+    keeps queueing output (up to output_limit bytes) and is re-attached to
+    the next connection that sets the same session key, or ended once the
+    grace period runs out.
+    """
+
+    def __init__(self, grace=RESUME_GRACE, output_limit=DETACHED_OUTPUT_LIMIT):
+        """
+        Initialize session store.
+
+        grace: Seconds to keep a detached session, 0 disables resuming.
+        output_limit: Bytes of output buffered while detached.
+        """
+        self.grace = grace
+        self.output_limit = output_limit
+        # Session key -> detached client
+        self._detached = {}
+
+
+    def __len__(self):
+        """
+        Return the number of detached sessions.
+        """
+        return len(self._detached)
+
+
+    def __contains__(self, key):
+        """
+        Is a session with this key detached?
+        """
+        return key in self._detached
+
+
+    def add(self, client):
+        """
+        Hold a detached client under its session key.  Returns the client
+        it displaces, another connection detached with the same key, which
+        the caller has to end, or None.
+        """
+        displaced = self._detached.get(client._session_key)
+        self._detached[client._session_key] = client
+        return displaced if displaced is not client else None
+
+
+    def take(self, key):
+        """
+        Remove and return the detached session for key, or None.
+        """
+        return self._detached.pop(key, None)
+
+
+    def remove(self, client):
+        """
+        Forget a detached client if it is still held.
+        """
+        if self._detached.get(client._session_key) is client:
+            del self._detached[client._session_key]
+
+
+    def sessions(self):
+        """
+        Return the detached clients.
+        """
+        return list(self._detached.values())
@@ -60,11 +60,26 @@ class CallLater(object):
         self.runtime = time.time() + kwargs['runtime']
         self._args = args
         self._kwargs = kwargs
+        self.cancelled = False
+
+    def __lt__(self, other):
+        """
+        Order calls by runtime so they can be kept in a heap.
+        """
+        return self.runtime < other.runtime
+
+    def cancel(self):
+        """
+        Cancel callLater.  A cancelled call is skipped when it comes due.
+        """
+        self.cancelled = True
         
     def execute(self):
         """
         Execute callLater.
         """
+        if self.cancelled:
+            return
         result = self._func(*self._args)
         return
         
@@ -90,4 +105,89 @@ class InstallFunction(object):
         Execute InstalledFunction.
         """
         self._func(*self._args)
-        return
\ No newline at end of file
+        return
+
+#=======================================================================
+# Timing Wheel Class
+#=======================================================================
+
+class TimingWheel(object):
+    """
+    Hashed timing wheel for per-client timers.
+
+    Scheduling, rescheduling and cancelling a timer are O(1) and advance()
+    only visits the slots that have come due, so thousands of idle timers
+    cost nothing per tick.
+    """
+    __slots__ = ('_resolution', '_slots', '_entries', '_tick')
+
+    def __init__(self, resolution=1.0, size=512):
+        """
+        Initialize timing wheel.
+
+        resolution: Seconds per slot.
+        size: Number of slots.
+        """
+        self._resolution = resolution
+        self._slots = [{} for i in range(size)]
+        # Timer key -> slot index
+        self._entries = {}
+        self._tick = int(time.time() / resolution)
+
+    def __len__(self):
+        """
+        Return the number of scheduled timers.
+        """
+        return len(self._entries)
+
+    def __contains__(self, key):
+        """
+        Is a timer with this key scheduled?
+        """
+        return key in self._entries
+
+    def schedule(self, key, delay, func, *args):
+        """
+        Call func(*args) in delay seconds.  Replaces any timer with the same key.
+        """
+        self.cancel(key)
+        tick = int((time.time() + delay) / self._resolution)
+        if tick <= self._tick:
+            tick = self._tick + 1
+        index = tick % len(self._slots)
+        self._slots[index][key] = (tick, func, args)
+        self._entries[key] = index
+
+    def cancel(self, key):
+        """
+        Cancel the timer with this key, if any.
+        """
+        index = self._entries.pop(key, None)
+        if index is not None:
+            del self._slots[index][key]
+
+    def advance(self, now=None):
+        """
+        Run every timer that has come due.
+        """
+        if now is None:
+            now = time.time()
+        now_tick = int(now / self._resolution)
+        size = len(self._slots)
+        # After a long stall one lap of the wheel covers every slot.
+        if now_tick - self._tick > size:
+            self._tick = now_tick - size
+        while self._tick < now_tick:
+            self._tick += 1
+            slot = self._slots[self._tick % size]
+            if not slot:
+                continue
+            due = [(key, entry) for key, entry in slot.items() if entry[0] <= self._tick]
+            for key, entry in due:
+                # An earlier callback may have cancelled or moved this one.
+                if slot.get(key) is not entry:
+                    continue
+                tick, func, args = entry
+                del slot[key]
+                del self._entries[key]
+                func(*args)
@@ -1,22 +1,81 @@
 import logging
+import os
 import socket
-import select
+import selectors
+import ssl
 import sys
 import re
 import time
-
-from sonzo.task import LoopingCall, CallLater, InstallFunction
-from collections import deque
+import heapq
+
+from sonzo.task import LoopingCall, CallLater, InstallFunction, TimingWheel
+from sonzo.output import OutputQueue, FileChunk, LANE_INTERACTIVE, LANE_NORMAL, LANE_BULK
+from sonzo.keyboard import KeyDecoder, ESC_TIMEOUT
+from sonzo.lineedit import LineEditor, HISTORY_SIZE
+from sonzo.channel import ChannelManager
+from sonzo.scrollback import Scrollback, SCROLLBACK_BYTES
+from sonzo.session import SessionStore, DETACHED_OUTPUT_LIMIT
+from sonzo.tls import TLS_HANDSHAKE_TIMEOUT
+from sonzo.websocket import WebSocketTransport, WEBSOCKET_HANDSHAKE_TIMEOUT
+from sonzo.recorder import SessionRecorder, recording_path
+from sonzo.admin import AdminConsole
+from sonzo.memory import MemoryMonitor, MEMORY_CHECK_INTERVAL
+from sonzo.latency import LatencyHistogram, ConnectionLatency
+from sonzo.content import ContentCache, CachedFile, HAVE_SENDFILE
+from sonzo.handoff import (send_handoff, recv_handoff, encode_bytes, decode_bytes,
+                           HandoffError)
+from collections import deque, OrderedDict
 
 
 #--[ Global Constants ]--------------------------------------------------------
 
+log = logging.getLogger(__name__)
+
 UNKNOWN = -1
 ## Cap sockets to 512 on Windows because winsock can only process 512 at time
 ## Cap sockets to 1000 on Linux because you can only have 1024 file descriptors
 MAX_CONNECTIONS = 512 if sys.platform == 'win32' else 1000
 PARA_BREAK = re.compile(r"(\n\s*\n)", re.MULTILINE)
 AUTOSENSE_TIMEOUT = 2
+## Number of client IP address and terminal type pairs whose auto-sensed
+## capabilities are remembered
+AUTOSENSE_CACHE_SIZE = 4096
+
+## Output flush policies.  FLUSH_IMMEDIATE sets TCP_NODELAY so every write goes
+## out at once.  FLUSH_TICK corks the socket (TCP_CORK where available) and
+## uncorks it at the end of each tick so a tick's output leaves in as few
+## packets as possible.  Character mode clients always flush immediately.
+FLUSH_IMMEDIATE = 'immediate'
+FLUSH_TICK = 'tick'
+HAVE_TCP_CORK = hasattr(socket, 'TCP_CORK')
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+## Kick a client whose held back output grows past this while they type
+MAX_HELD_OUTPUT = 8388608
+## Scrollback rings kept for sessions that have disconnected
+SCROLLBACK_SESSIONS = 1024
+## Seconds a disconnecting client gets to flush its output before it is dropped
+CLOSE_TIMEOUT = 5
+## Ticks whose timings are kept for TelnetServer.tickStats()
+TICK_HISTORY = 1024
+## Sent to connections refused by rejectNewConnections() or the memory budget
+REJECT_MESSAGE = "Sorry, no new connects at this time."
+
+## Client connection states
+STATE_NEGOTIATING = 'negotiating'   # Auto-sensing the terminal
+STATE_CONNECTED = 'connected'       # Session started, commands dispatched
+STATE_CLOSING = 'closing'           # Flushing output before closing
+STATE_CLOSED = 'closed'             # Removed from the server
+STATE_DETACHED = 'detached'         # Socket lost, session waiting for a resume
+
+## Listener protocols
+PROTOCOL_TELNET = 'telnet'
+PROTOCOL_WEBSOCKET = 'websocket'
+
+## Client TLS states, None for plain connections
+TLS_HANDSHAKE = 'handshake'         # Handshaking on a TLS listener
+TLS_FOLLOWS = 'follows'             # STARTTLS agreed, waiting for the client's FOLLOWS
+TLS_UPGRADE = 'upgrade'             # Handshaking after STARTTLS
+TLS_ACTIVE = 'active'               # Encrypted
 
 #--[ Telnet Commands ]---------------------------------------------------------
 
@@ -49,7 +108,15 @@ STATUS  = chr(  5)      # Status of Telnet Options
 TTYPE   = chr( 24)      # Terminal Type
 NAWS    = chr( 31)      # Negotiate About Window Size
 TSPEED  = chr( 32)      # Terminal Speed
+TMARK   = chr(  6)      # Timing Mark
 LINEMO  = chr( 34)      # Line Mode
+START_TLS = chr( 46)    # Telnet Start TLS
+FOLLOWS = chr(  1)      # START_TLS sub-negotiation FOLLOWS command
+
+## What a client sends right before its TLS ClientHello
+_STARTTLS_FOLLOWS = bytes(IAC + SB + START_TLS + FOLLOWS + IAC + SE, "cp1252")
+## Marks interactive output that carries telnet commands, kept from observers
+_IAC_BYTE = b'\xff'
 
 
 Telopts = {
@@ -112,12 +179,53 @@ Telopts = {
 #--[ Terminal Type enumerations - Mark Richardson Nov 2012]--------------------
 TERMINAL_TYPES = ['ANSI', 'XTERM', 'TINYFUGUE', 'zmud', 'VT100', 'IBM-3179-2']
 
+#--[ Telnet Option State Bits ]------------------------------------------------
+
+## Every option's state is packed into one byte of TelnetProtocol._telnet_opts:
+## bits 0-1 hold the local state, bits 2-3 the remote state and bit 4 is set
+## while we are waiting for a reply.
+OPT_LOCAL_MASK   = 0x03
+OPT_REMOTE_SHIFT = 2
+OPT_REMOTE_MASK  = 0x0C
+OPT_PENDING      = 0x10
+
+## 2-bit state value <-> UNKNOWN/False/True
+_OPT_DECODE = (UNKNOWN, False, True, UNKNOWN)
+_OPT_ENCODE = {UNKNOWN: 0, False: 1, True: 2}
+
 #--[ Connection Lost ]---------------------------------------------------------
 
 class ConnectionLost(Exception):
     """
     Custom exception to signal a lost connection to the Telnet Server.
     """
+
+
+
+class Listener(object):
+    """
+    A listening socket and how connections accepted on it are served.
+
+    clientclass: Class for this listener's clients, None for the server's.
+    """
+    __slots__ = ('socket', 'protocol', 'ssl_context', 'clientclass')
+
+    def __init__(self, sock, protocol=PROTOCOL_TELNET, ssl_context=None, clientclass=None):
+        self.socket = sock
+        self.protocol = protocol
+        self.ssl_context = ssl_context
+        self.clientclass = clientclass
+
+    def key(self):
+        """
+        Return [family, address, port], or [family, path] for a Unix
+        socket, identifying what the socket is bound to.
+        """
+        name = self.socket.getsockname()
+        if self.socket.family == getattr(socket, 'AF_UNIX', None):
+            return [self.socket.family, name]
+        return [self.socket.family, name[0], name[1]]
+
     
     
     
@@ -126,50 +234,383 @@ class TelnetServer(object):
     Telnet Server
     """
     
-    def __init__(self, address='', clientclass=None, port=23, timeout=0.1):
+    def __init__(self, address='', clientclass=None, port=23, timeout=0.1,
+                 ssl_context=None, takeover=None):
         """
         Initialize a new TelnetServer.
-        
+
         address: IP Address to bind too.
-        port: Port to bind too.
+        port: Port to bind too, None to only use listeners added with
+              listen() and listenUnix().
         timeout: Socket polling timeout.
+        ssl_context: Serve telnet over TLS (port 992) with this SSLContext,
+                     see sonzo.tls.server_context.
+        takeover: Path of a running server's handoff socket (see
+                  listenForHandoff).  The listening socket and every client
+                  are taken over from that process instead of binding, and
+                  the sessions carry on when run() is called.
+
+        Everything else is set up with the methods below before run(), the
+        way listen() adds listeners: setTimeouts(), configureSessions(),
+        setEarlyPromote(), setFlushPolicy(), enableStartTLS(),
+        enableLineEditing(), enableLatency(), enableBatchDispatch(),
+        setMemoryBudget() and recordConnections().
         """
         self._addr = address
         self._port = port
         self._timeout = timeout
+        # Every client by socket fileno, and an index of them by state.
         self._clients = {}
-        self._negotiating_clients = {}
-        self._deadclients = []
+        self._states = {STATE_NEGOTIATING: {}, STATE_CONNECTED: {}, STATE_CLOSING: {}}
+        # Clients whose write interest may have changed since the last poll.
+        self._write_check = set()
+        # Clients with complete commands waiting, in arrival order.
+        self._ready = deque()
         self.clientclass = clientclass
+        # Channel subscriptions, clients leave them all on disconnect.
+        self.channels = ChannelManager()
+        # Banners, help files and other static content, see sendFile().
+        self.content = ContentCache()
+        self._early_promote = False
+        self._flush_policy = FLUSH_IMMEDIATE
+        self._idle_timeout = None
+        self._login_timeout = None
+        self._keepalive = None
+        self._line_editing = False
+        self._session_scrollback = 0
+        self._record = None
+        self._ssl_context = ssl_context
+        self._starttls_context = None
+        # TLS handshake counts and timings.
+        self.tls_stats = {'handshakes': 0, 'resumed': 0, 'failures': 0,
+                          'total_time': 0.0, 'max_time': 0.0}
+        # Sessions that lost their socket, by session key.
+        self.sessions = SessionStore(0, DETACHED_OUTPUT_LIMIT)
+        # Scrollback of ended sessions by session key, oldest first.
+        self._scrollbacks = OrderedDict()
+        # Idle, login and keepalive timers for every client.
+        self._timers = TimingWheel()
+        # Auto-sensed capabilities by (client IP, terminal type), oldest first.
+        self._caps_cache = OrderedDict()
         
         # Embbed function in run() loop
         self._installedFunctions = []
         # Installed, timed looping calls.
         self._loopingCalls = []
-        # Functions to be called later.
-        self._callLater = [] 
+        # Functions to be called later, kept as a heap ordered by runtime.
+        self._callLater = []
+        # Unix socket a replacement process connects to, see listenForHandoff().
+        self._handoff_socket = None
+        # (state, client fds) taken over from another process, restored by run().
+        self._takeover = None
+        self._running = False
+        # Listening sockets by fileno.
+        self._listeners = {}
+        # Callbacks for sockets that are neither listeners nor clients, by
+        # fileno.
+        self._watched = {}
+        self._admin = None
+        # (io, timers, dispatch) seconds spent in each of the last ticks,
+        # not counting the wait for events.
+        self._tick_times = deque(maxlen=TICK_HISTORY)
+        self._tick_wait = 0.0
+        # Memory budget and usage history, sampled every MEMORY_CHECK_INTERVAL
+        # once there is a budget or someone asks, see watchMemory().
+        self.memory = MemoryMonitor()
+        # Message for new connections while rejecting them, None to accept.
+        self._reject_message = None
+        self._latency = False
+        self._batch_dispatch = False
+        self._batch_limit = None
+        # Input and output latency of clients that have gone.
+        self._latency_totals = (LatencyHistogram(), LatencyHistogram())
+        # [key, socket, Listener] for listening sockets taken over from
+        # another process, claimed by listen() calls for the same address.
+        self._inherited = []
+        self._selector = selectors.DefaultSelector()
         
-        
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if takeover is not None:
+            state, fds = recv_handoff(takeover)
+            keys = state['listeners']
+            for key, fileno in zip(keys, fds):
+                self._inherited.append([key, socket.socket(fileno=fileno), None])
+            self._takeover = (state, fds[len(keys):])
+            log.info("Took over %d listening sockets from %s.", len(keys), takeover)
+        if port is not None:
+            self.listen(address, port, ssl_context=ssl_context)
+
+
+    #---[ Options ]------------------------------------------------------------
+
+    def setTimeouts(self, idle=None, login=None, keepalive=None):
+        """
+        Set the timers started for every client that connects from now on.
+        None turns a timer off.
+
+        idle: Kick clients that send no commands for this many seconds.
+        login: Kick clients that do not call loginComplete() within this
+               many seconds of connecting.
+        keepalive: Ping clients silent for this many seconds with a telnet
+                   TIMING-MARK and drop them if they stay silent as long again.
+        """
+        self._idle_timeout = idle
+        self._login_timeout = login
+        self._keepalive = keepalive
+
+
+    def configureSessions(self, resume_grace=0, detached_output=DETACHED_OUTPUT_LIMIT,
+                          scrollback=0):
+        """
+        Set what happens to sessions tied to a session key (see
+        TelnetProtocol.setSessionKey).
+
+        resume_grace: Seconds a session outlives a lost socket, waiting for
+                      a connection that sets the same key to take it over.
+                      0 ends sessions right away.
+        detached_output: Bytes of output kept for a detached session.
+        scrollback: Lines of output kept per session so a client that
+                    reconnects under the same key can be caught up.
+        """
+        self.sessions.grace = resume_grace
+        self.sessions.output_limit = detached_output
+        self._session_scrollback = scrollback
+
+
+    def setEarlyPromote(self, early_promote=True):
+        """
+        Start sessions right away instead of waiting for auto-sensing;
+        capabilities are applied as they arrive.
+        """
+        self._early_promote = early_promote
+
+
+    def setFlushPolicy(self, policy):
+        """
+        Set FLUSH_IMMEDIATE or FLUSH_TICK for clients that connect from now
+        on.
+        """
+        self._flush_policy = policy
+
+
+    def enableStartTLS(self, context):
+        """
+        Offer plain connections STARTTLS (telnet option 46) with this
+        SSLContext, see sonzo.tls.server_context.  None stops offering it.
+        """
+        self._starttls_context = context
+
+
+    def enableLineEditing(self, enabled=True):
+        """
+        Give every new client a server side line editor with history (see
+        TelnetProtocol.enableLineEditor).
+        """
+        self._line_editing = enabled
+
+
+    def enableLatency(self, enabled=True):
+        """
+        Keep input and output latency histograms for every new client (see
+        TelnetProtocol.enableLatency and latencyStats).
+        """
+        self._latency = enabled
+
+
+    def enableBatchDispatch(self, limit=None):
+        """
+        Hand each tick's commands to processBatch() in one list instead of
+        dispatching them one at a time.
+
+        limit: Most commands a client gets into one batch, e.g. 1 for one
+               command per pulse.  The rest wait for later ticks.  None
+               for no limit.
+        """
+        self._batch_dispatch = True
+        self._batch_limit = limit
+
+
+    def setMemoryBudget(self, budget):
+        """
+        Bytes of buffered data the server may hold (see memoryUsage).  Past
+        it, bulk output is dropped, largest queues first, and new
+        connections are refused until usage falls back.  None for no budget.
+        """
+        self.memory.budget = budget
+        if budget is not None:
+            self.watchMemory()
+
+
+    def recordConnections(self, directory):
+        """
+        Record the raw traffic of every new connection to directory, for
+        replay with sonzo.replay.  None stops recording new connections.
+        """
+        self._record = directory
+
+
+    def listen(self, address='', port=23, protocol=PROTOCOL_TELNET, ssl_context=None,
+               clientclass=None):
+        """
+        Accept connections on another address and port as well.  Every
+        listener shares the server's reactor and client registry.  Returns
+        the Listener.
+
+        address: IPv4 or IPv6 address, '::' for every IPv6 address.
+        protocol: PROTOCOL_TELNET or PROTOCOL_WEBSOCKET.
+        ssl_context: Serve the listener over TLS.
+        clientclass: Class for this listener's clients instead of the
+                     server's clientclass.
+        """
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        info = socket.getaddrinfo(address or None, port, family, socket.SOCK_STREAM,
+                                  0, socket.AI_PASSIVE)[0]
+        key = [family, info[4][0], info[4][1]]
+        sock = self._claim(key)
+        if sock is None:
+            sock = self._bind(info[4], family)
+        return self._addListener(sock, protocol, ssl_context, clientclass)
+
+
+    def listenUnix(self, path, protocol=PROTOCOL_TELNET, clientclass=None):
+        """
+        Accept connections on a Unix socket, e.g. for local admin tools.
+        A stale socket file at path is replaced.  Returns the Listener.
+        """
+        sock = self._claim([socket.AF_UNIX, path])
+        if sock is None:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            sock = self._bind(path, socket.AF_UNIX)
+        return self._addListener(sock, protocol, None, clientclass)
+
+
+    def _claim(self, key):
+        """
+        Return the inherited listening socket bound to key, if any.
+        """
+        for entry in self._inherited:
+            if entry[0] == key and entry[2] is None:
+                return entry[1]
+        return None
+
+
+    def _bind(self, address, family=socket.AF_INET):
+        """
+        Return a listening socket bound to address.
+        """
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        if family != getattr(socket, 'AF_UNIX', None):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if family == socket.AF_INET6:
+            # Leave IPv4 to its own listener on the same port.
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
         
         try:
-            self._socket.bind((self._addr, self._port))
-            self._socket.listen(5)
+            sock.bind(address)
+            sock.listen(5)
         except socket.error as err:
-            logging.critical("Error: Failed to create the server socket: " + str(err))
+            log.critical("Error: Failed to create the server socket: %s", err)
+            sock.close()
             raise
-        
-        self._server_fileno = self._socket.fileno()
+        return sock
+
+
+    def _addListener(self, sock, protocol=PROTOCOL_TELNET, ssl_context=None, clientclass=None):
+        """
+        Start accepting connections on a listening socket.
+        """
+        sock.setblocking(False)
+        listener = Listener(sock, protocol, ssl_context, clientclass)
+        self._listeners[sock.fileno()] = listener
+        self._selector.register(sock.fileno(), selectors.EVENT_READ, None)
+        for entry in self._inherited:
+            if entry[1] is sock:
+                entry[2] = listener
+        return listener
+
+
+    def listeners(self):
+        """
+        Return the server's Listeners.
+        """
+        return list(self._listeners.values())
+
+
+    def listenAdmin(self, path):
+        """
+        Serve an AdminConsole on a Unix socket at path, readable and
+        writable by the server's user only.  Returns the AdminConsole.
+        """
+        if self._admin is not None:
+            self._admin.close()
+        self._admin = AdminConsole(self, path)
+        return self._admin
+
+
+    def _watch(self, sock, callback, write_callback=None):
+        """
+        Call callback() from the main loop whenever sock is readable, and
+        write_callback() whenever it is writable while _watchWrite() has
+        asked for it.
+        """
+        self._watched[sock.fileno()] = (callback, write_callback)
+        self._selector.register(sock.fileno(), selectors.EVENT_READ, None)
+
+
+    def _watchWrite(self, sock, wanted):
+        """
+        Start or stop calling a watched socket's write_callback.
+        """
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if wanted else selectors.EVENT_READ
+        if sock.fileno() in self._watched and self._selector.get_key(sock.fileno()).events != events:
+            self._selector.modify(sock.fileno(), events, None)
+
+
+    def _unwatch(self, sock):
+        """
+        Stop watching a socket passed to _watch().
+        """
+        if self._watched.pop(sock.fileno(), None) is not None:
+            self._selector.unregister(sock.fileno())
+
+
+    def tickStats(self):
+        """
+        Return the main loop timing over the last TICK_HISTORY ticks: for
+        each phase ('io', 'timers', 'dispatch' and their 'total') a dict of
+        'last', 'mean', 'p99' and 'max' seconds.  Time spent waiting for
+        events is left out.
+        """
+        ticks = list(self._tick_times)
+        stats = {'ticks': len(ticks)}
+        if not ticks:
+            return stats
+        phases = list(zip(*ticks))
+        phases.append([sum(tick) for tick in ticks])
+        for name, times in zip(('io', 'timers', 'dispatch', 'total'), phases):
+            ordered = sorted(times)
+            stats[name] = {'last': times[-1], 'mean': sum(times) / len(times),
+                           'p99': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+                           'max': ordered[-1]}
+        return stats
     
         
     def run(self):
         """
         Start Telnet Server's Main Loop.
-        
+
+        Returns once another process has taken the server over.
         """
-        while True:
+        if self._takeover is not None:
+            self._restoreHandoff()
+        self._running = True
+        clock = time.perf_counter
+        while self._running:
+            start = clock()
             self._poll()
+            polled = clock()
             
             # Execute installed functions
             for function in self._installedFunctions:
@@ -179,13 +620,16 @@ class TelnetServer(object):
             for call in self._loopingCalls:
                 call.execute()
                     
-            # Execute callLater functions then remove from self.callLater list.
-            for call in self._callLater:
-                if call.runtime <= time.time():
-                    call.execute()
-                    self._callLater.remove(call)
-
-            self._processClients()                    
+            # Execute callLater functions that are due.
+            now = time.time()
+            while self._callLater and self._callLater[0].runtime <= now:
+                heapq.heappop(self._callLater).execute()
+
+            self._timers.advance(now)
+            timed = clock()
+            self._processClients()
+            self._tick_times.append((polled - start - self._tick_wait, timed - polled,
+                                     clock() - timed))
     
         
     def onConnect(self, client):
@@ -206,12 +650,156 @@ class TelnetServer(object):
         pass
      
     
-    def rejectNewConnections(self, msg="Sorry, no new connects at this time."):
+    def onHandoff(self):
         """
-        Reject new connections.
+        Called after another process has taken over the listening socket
+        and every client.  run() returns right after.
+
+        Override with custom shutdown code.
         """
         pass
 
+
+    def processBatch(self, commands):
+        """
+        Handle one tick's commands after enableBatchDispatch().  commands is
+        a list of (client, command) in rounds: every client's first
+        command in the order they arrived, then every second command, and
+        so on, so each client's commands keep their order.  Commands are
+        lines, or (key, data) events for clients in character mode.
+
+        Override to work through a tick's commands together, e.g. to
+        resolve every movement at once.  By default each command is
+        dispatched as usual.
+        """
+        for client, msg in commands:
+            if client._state is STATE_CONNECTED:
+                client._dispatch(msg)
+
+
+    def rejectNewConnections(self, msg=REJECT_MESSAGE):
+        """
+        Reject new connections, sending them msg before hanging up.
+        """
+        self._reject_message = msg
+
+
+    def acceptNewConnections(self):
+        """
+        Accept new connections again after rejectNewConnections().
+        """
+        self._reject_message = None
+
+
+    def memoryUsage(self):
+        """
+        Return the bytes of data held by each subsystem, and their 'total'.
+        Client buffers are summed over every client (see
+        TelnetProtocol.memoryUsage), detached sessions are counted apart.
+        """
+        usage = dict.fromkeys(('send', 'echo', 'recv', 'subnegotiation', 'commands',
+                               'line_editor', 'scrollback'), 0)
+        for client in self._clients.values():
+            for name, size in client.memoryUsage().items():
+                usage[name] += size
+        detached = 0
+        for client in self.sessions.sessions():
+            detached += sum(client.memoryUsage().values())
+        usage['detached'] = detached
+        usage['session_scrollback'] = sum(scrollback.size() for scrollback in self._scrollbacks.values())
+        usage['channel_scrollback'] = sum(self.channels.scrollback(topic).size()
+                                          for topic in self.channels.scrollbackTopics())
+        usage['content'] = self.content.size()
+        usage['total'] = sum(usage.values())
+        return usage
+
+
+    def latencyStats(self):
+        """
+        Return server wide latency, every client's histograms merged with
+        those of clients that have gone: {'input': summary, 'output':
+        summary}, see LatencyHistogram.summary.
+        """
+        latency_in = LatencyHistogram()
+        latency_out = LatencyHistogram()
+        latency_in.merge(self._latency_totals[0])
+        latency_out.merge(self._latency_totals[1])
+        for client in list(self._clients.values()) + self.sessions.sessions():
+            if client._latency is not None:
+                latency_in.merge(client._latency.input)
+                latency_out.merge(client._latency.output)
+        return {'input': latency_in.summary(), 'output': latency_out.summary()}
+
+
+    def objectCounts(self):
+        """
+        Return counts of the objects the server keeps track of, to spot
+        leaks that hold no buffered data.
+        """
+        return {
+            'clients': len(self._clients),
+            'detached_sessions': len(self.sessions),
+            'timers': len(self._timers),
+            'call_later': len(self._callLater),
+            'looping_calls': len(self._loopingCalls),
+            'ready_clients': len(self._ready),
+            'session_scrollbacks': len(self._scrollbacks),
+            'caps_cache': len(self._caps_cache),
+            'channels': len(self.channels.topics()),
+            }
+
+
+    def watchMemory(self):
+        """
+        Start sampling memory usage every MEMORY_CHECK_INTERVAL seconds, for
+        the budget and the growth and leak figures.  Started by a memory
+        budget or by the admin console's 'memory' command, and left running.
+        """
+        if (self, 'memory') not in self._timers:
+            self._timers.schedule((self, 'memory'), MEMORY_CHECK_INTERVAL, self._checkMemory)
+
+
+    def _checkMemory(self):
+        """
+        Sample memory usage and shed load while it is over budget.
+        """
+        self._timers.schedule((self, 'memory'), MEMORY_CHECK_INTERVAL, self._checkMemory)
+        usage = self.memoryUsage()
+        total = usage['total']
+        budget = self.memory.budget
+        if budget is not None and total > budget:
+            total -= self._shedBulk(total - budget)
+            usage['total'] = total
+        was_over = self.memory.over_budget
+        if self.memory.isOver(total) != was_over:
+            if was_over:
+                log.info("Memory back under budget (%d of %d bytes), accepting connections.",
+                         total, budget)
+            else:
+                log.warning("Memory over budget (%d of %d bytes), refusing new connections.",
+                            total, budget)
+        figures = self.objectCounts()
+        figures.update(usage)
+        self.memory.sample(figures)
+
+
+    def _shedBulk(self, excess):
+        """
+        Drop queued bulk output, largest queues first, until excess bytes
+        are freed or no bulk output is left.  Returns the bytes freed.
+        """
+        clients = list(self._clients.values()) + self.sessions.sessions()
+        clients.sort(key=lambda client: client._send_buffer.laneSize(LANE_BULK), reverse=True)
+        freed = 0
+        for client in clients:
+            if freed >= excess or not client._send_buffer.laneSize(LANE_BULK):
+                break
+            freed += client._send_buffer.shed(LANE_BULK)
+        if freed:
+            self.memory.shed += freed
+            log.warning("Memory over budget, dropped %d bytes of bulk output.", freed)
+        return freed
+
        
     def install(self, *args, **kwargs):
         """
@@ -222,7 +810,7 @@ class TelnetServer(object):
             if newcall:
                 self._installedFunctions.append(newcall)
         else:
-            logging.error("Error: Could not install function. Required 'func' keyword missing from TelnetServer.install() call")
+            log.error("Error: Could not install function. Required 'func' keyword missing from TelnetServer.install() call")
         
         
     def loopingCall(self, *args, **kwargs):
@@ -237,7 +825,7 @@ class TelnetServer(object):
         if newcall:
             self._loopingCalls.append(newcall)
         else:
-            logging.error("Error: Could not install loopingCall function.")
+            log.error("Error: Could not install loopingCall function.")
     
         return newcall
     
@@ -245,153 +833,909 @@ class TelnetServer(object):
     def callLater(self, *args, **kwargs):
         """
         Install call later.
+
+        Returns the CallLater object, which can be cancelled.
         """
-        if kwargs['func'] and kwargs['runtime']:
+        if kwargs.get('func') and kwargs.get('runtime'):
             newcall = CallLater(*args, func=kwargs['func'], runtime=kwargs['runtime'])
-        
-        if newcall:
-            self._callLater.append(newcall)
-        else:
-            logging.error("Error: Could not install callLater function.") 
+            heapq.heappush(self._callLater, newcall)
+            return newcall
+        log.error("Error: Could not install callLater function.")
 
 
     def clientCount(self):
         """
         Return current connection count.
         """
-        return len(self._clients)
+        return len(self._states[STATE_CONNECTED])
+
+
+    def getClients(self, state=STATE_CONNECTED):
+        """
+        Return a list of the clients in a connection state.
+        """
+        return list(self._states[state].values())
 
                     
     def _processClients(self):
         """
         Process client's input.
+
+        Only clients that completed a command since the last tick are
+        visited, in the order their commands arrived.
         """
-        for client in self._clients.values():
-            while True:
+        if self._batch_dispatch:
+            self._processBatch()
+            return
+        ready = self._ready
+        while ready:
+            client = ready.popleft()
+            if client._state is not STATE_CONNECTED:
+                # Negotiating clients are queued again when promoted.
+                client._cmd_ready = False
+                continue
+            while client._state is STATE_CONNECTED:
                 msg = client._getCommand()
                 if not msg:
                     break
                 else:
-                    client.dataRecieved(msg)  
-                    
+                    client._dispatch(msg)
+
+
+    def _processBatch(self):
+        """
+        Collect the commands of every ready client, up to the batch limit each,
+        and pass them to processBatch() in one list.
+        """
+        ready = self._ready
+        limit = self._batch_limit
+        queues = []
+        waiting = []
+        while ready:
+            client = ready.popleft()
+            if client._state is not STATE_CONNECTED:
+                client._cmd_ready = False
+                continue
+            msgs = []
+            while limit is None or len(msgs) < limit:
+                msg = client._getCommand()
+                if not msg:
+                    break
+                msgs.append(msg)
+            if msgs:
+                queues.append((client, msgs))
+            if client._cmd_list:
+                # Over the limit, the rest go in the next batch.
+                waiting.append(client)
+            else:
+                client._cmd_ready = False
+        ready.extend(waiting)
+        if not queues:
+            return
+        commands = []
+        for depth in range(max(len(msgs) for client, msgs in queues)):
+            for client, msgs in queues:
+                if depth < len(msgs):
+                    commands.append((client, msgs[depth]))
+        self.processBatch(commands)
         
     def _poll(self):
         """
         Poll the server for new connections and handling OI for existing
         connections.
         """
-        recv_list = [self._server_fileno]
-        dead_list = []
-        done_negotiating = []
-        
-        for client in self._negotiating_clients.values():
-            client._check_auto_sense()
-            if client._protocol_negotiation == True:
-                self._clients[client.getSocket()] = client
-                done_negotiating.append(client.getSocket())
-                client.onConnect()
-                
-        
-        for client in self._clients.values():
-            if client.isConnected():
-                recv_list.append(client.getSocket())
-            else:
-                client.onDisconnect()
-                dead_list.append(client.getSocket())
-                
-        for client in self._negotiating_clients.values():
-            if client.isConnected():
-                recv_list.append(client.getSocket())
-            else:
-                done_negotiating.append(client.getSocket())                
-
-        send_list = []
-        for client in self._clients.values():
-            if client.sendPending() or client._echo_buffer:
-                send_list.append(client.getSocket())
-
-        for client in self._negotiating_clients.values():
-            if client.sendPending():
-                send_list.append(client.getSocket())
-                
-        try:                
-            rlist, slist, elist = select.select(recv_list, send_list, [], self._timeout)    
-        except socket.error as err:
-            logging.critical("Socket Select() error: '{}: {}'".format(err[0], err[1]))
+        self._updateWriteInterest()
+        waited = time.perf_counter()
+        try:
+            events = self._selector.select(self._timeout)
+            self._tick_wait = time.perf_counter() - waited
+        except OSError as err:
+            log.critical("Socket Select() error: '%s: %s'", err.errno, err.strerror)
             raise
-        
-        for fileno in rlist:
+
+        writers = []
+        # Clients that may have written to a corked socket this tick.  TLS
+        # handshakes and WebSocket upgrade and control frames are written
+        # straight to the socket as input is handled, not just by _send().
+        corked = set()
+        for key, mask in events:
+            client = key.data
             # Is it the server's socket for a new connection?
-            if fileno == self._server_fileno:
-                try:
-                    sock, addr = self._socket.accept()
-                except socket.error as err:
-                    logging.error("Socket error on accept(): '{}: {}'".format(err[0], err[1]))
-                    sock.close()
+            if client is None:
+                listener = self._listeners.get(key.fd)
+                if listener is not None:
+                    self._accept(listener)
                     continue
-            
-                if self.clientCount() >= MAX_CONNECTIONS:
-                    logging.warning("New connection rejected.  Maximum connection count reached.")
-                    self.rejectNewConnection()
-                    sock.close()
+                callbacks = self._watched.get(key.fd)
+                if callbacks is not None:
+                    if mask & selectors.EVENT_READ:
+                        callbacks[0]()
+                    # The read callback may have stopped watching.
+                    if mask & selectors.EVENT_WRITE and key.fd in self._watched:
+                        callbacks[1]()
                     continue
-
-                #new_client = self.newConnection(sock, addr)
-                new_client = self.clientclass(sock, addr)
-                new_client._request_will_echo()
-                new_client._detect_term_caps()
-                self._negotiating_clients[new_client.getSocket()] = new_client
+                self._handoff()
+                if not self._running:
+                    return
                 continue
-            
-            if fileno in self._clients.keys():  
-                try: 
-                    self._clients[fileno]._recv()
-                except ConnectionLost:
-                    onDisconnect()
-                    
-            elif  fileno in self._negotiating_clients.keys():            
-                try: 
-                    self._negotiating_clients[fileno]._recv()
+            if client._tls is TLS_HANDSHAKE or client._tls is TLS_UPGRADE:
+                if client._state is not STATE_CLOSED:
+                    self._handshake(client)
+                    if client._corked:
+                        corked.add(client)
+                continue
+            if mask & selectors.EVENT_READ and client._state is not STATE_CLOSED:
+                try:
+                    client._recv()
                 except ConnectionLost:
-                    done_negociating.append(fileno)
-                    
-        # Send pending buffers to client        
-        for fileno in slist:
-            if fileno in self._clients.keys():
-                self._clients[fileno]._send()
-            elif fileno in self._negotiating_clients.keys():
-                self._negotiating_clients[fileno]._send()
-        
-        # remove clients no longer connected        
-        for dead in dead_list:
-            del self._clients[dead] 
-        del dead_list            
+                    self._drop(client)
+                    continue
+                self._write_check.add(client)
+                if client._corked:
+                    corked.add(client)
+            if mask & selectors.EVENT_WRITE:
+                writers.append(client)
+
+        # Send pending buffers to client
+        for client in writers:
+            if client._state is STATE_CLOSED:
+                continue
+            if client._send() is False:
+                self._drop(client)
+                continue
+            if client._state is STATE_CLOSING and not client.sendPending():
+                self._drop(client)
+                continue
+            self._write_check.add(client)
+            if client._corked:
+                corked.add(client)
 
-                # Remove clients from negotiating list once done.
-        for dead in done_negotiating:
-            del self._negotiating_clients[dead]
-        del done_negotiating 
+        # End of tick, push out anything held back by TCP_CORK.
+        for client in corked:
+            if client._state is not STATE_CLOSED:
+                client._uncork()
+
+
+    def _accept(self, listener):
+        """
+        Accept a new connection and start negotiating with it.
+        """
+        try:
+            sock, addr = listener.socket.accept()
+        except BlockingIOError:
+            return
+        except OSError as err:
+            log.error("Socket error on accept(): '%s: %s'", err.errno, err.strerror)
+            return
+
+        if len(self._clients) >= MAX_CONNECTIONS:
+            log.warning("New connection rejected.  Maximum connection count reached.")
+            sock.close()
+            return
+
+        if self._reject_message is not None or self.memory.over_budget:
+            if self._reject_message is None:
+                self.memory.refused += 1
+            try:
+                sock.send(bytes((self._reject_message or REJECT_MESSAGE) + "\r\n", "cp1252"))
+            except OSError:
+                pass
+            sock.close()
+            return
+
+        sock.setblocking(False)
+        if listener.ssl_context is not None:
+            sock = listener.ssl_context.wrap_socket(sock, server_side=True,
+                                                    do_handshake_on_connect=False)
+        if listener.protocol == PROTOCOL_WEBSOCKET:
+            sock = WebSocketTransport(sock)
+        if not isinstance(addr, tuple):
+            # Unix socket peers have no address, go by the socket path and
+            # tell them apart by descriptor.
+            addr = (listener.socket.getsockname(), sock.fileno())
+        #new_client = self.newConnection(sock, addr)
+        new_client = (listener.clientclass or self.clientclass)(sock, addr)
+        new_client._server = self
+        new_client._listener = listener
+        new_client._set_flush_policy(self._flush_policy)
+        if self._line_editing:
+            new_client.enableLineEditor()
+        if self._latency:
+            new_client.enableLatency()
+        if self._session_scrollback:
+            new_client.enableScrollback(self._session_scrollback)
+        if self._record:
+            new_client.startRecording(recording_path(self._record, new_client._addr, new_client._port))
+        fileno = new_client.getSocket()
+        self._clients[fileno] = new_client
+        self._setState(new_client, STATE_NEGOTIATING)
+        self._selector.register(fileno, selectors.EVENT_READ, new_client)
+        self._startTimers(new_client)
+        if new_client._websocket is not None:
+            new_client._websocket.on_open = lambda telnet: self._websocketOpen(new_client, telnet)
+            self._timers.schedule((new_client, 'handshake'), WEBSOCKET_HANDSHAKE_TIMEOUT,
+                                  self._drop, new_client)
+        if listener.ssl_context is not None:
+            # Negotiation starts once the connection is encrypted.
+            new_client._tls = TLS_HANDSHAKE
+            self._startHandshake(new_client)
+            # A ClientHello already waiting is answered straight away.
+            if new_client._corked and new_client._state is not STATE_CLOSED:
+                new_client._uncork()
+        elif new_client._websocket is None:
+            self._startAutoSense(new_client)
+
+
+    def _websocketOpen(self, client, telnet):
+        """
+        Called once a WebSocket client's upgrade is done.  Clients speaking
+        telnet are auto-sensed as usual; the rest start their session right
+        away as ANSI terminals that echo locally.
+        """
+        self._timers.cancel((client, 'handshake'))
+        if telnet:
+            self._startAutoSense(client)
+            return
+        client._terminal_type = 'WEBSOCKET'
+        client._ansi = True
+        client._auto_sensing_done = True
+        client._protocol_negotiation = True
+        self._promote(client)
+
+
+    def _startHandshake(self, client):
+        """
+        Begin the TLS handshake of a client whose socket has been wrapped.
+        """
+        client._tls_started = time.time()
+        self._timers.schedule((client, 'handshake'), TLS_HANDSHAKE_TIMEOUT, self._drop, client)
+        self._handshake(client)
+
+
+    def _startTLS(self, client):
+        """
+        Switch a client that asked for STARTTLS over to TLS.  Plaintext
+        already queued is pushed out first.
+        """
+        if client._send() is False:
+            self._drop(client)
+            return
+        client._socket = self._starttls_context.wrap_socket(
+            client._socket, server_side=True, do_handshake_on_connect=False)
+        client._tls = TLS_UPGRADE
+        self._startHandshake(client)
+
+
+    def _handshake(self, client):
+        """
+        Advance a client's TLS handshake without blocking.
+        """
+        try:
+            client._socket.do_handshake()
+        except ssl.SSLWantReadError:
+            client._tls_want_write = False
+            self._write_check.add(client)
+            return
+        except ssl.SSLWantWriteError:
+            client._tls_want_write = True
+            self._write_check.add(client)
+            return
+        except (ssl.SSLError, OSError) as err:
+            log.info("TLS handshake failed: %s", err, extra=client._log_extra)
+            self.tls_stats['failures'] += 1
+            self._drop(client)
+            return
+
+        elapsed = time.time() - client._tls_started
+        client._tls_time = elapsed
+        stats = self.tls_stats
+        stats['handshakes'] += 1
+        stats['total_time'] += elapsed
+        if elapsed > stats['max_time']:
+            stats['max_time'] = elapsed
+        if client._socket.session_reused:
+            stats['resumed'] += 1
+        implicit = client._tls is TLS_HANDSHAKE
+        client._tls = TLS_ACTIVE
+        client._tls_want_write = False
+        self._timers.cancel((client, 'handshake'))
+        self._write_check.add(client)
+        log.debug("TLS handshake took %.1f ms.", elapsed * 1000, extra=client._log_extra)
+        if implicit and client._websocket is None:
+            self._startAutoSense(client)
+        client.onTLS()
+
+
+    def listenForHandoff(self, path):
+        """
+        Listen on a Unix socket for a replacement process.  When a new
+        server is started with TelnetServer(takeover=path) this server hands
+        it the listening sockets, every client socket and their protocol
+        state, then run() returns.  Clients stay connected throughout,
+        except TLS and WebSocket clients whose transport state cannot be
+        passed on.
+        """
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._handoff_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._handoff_socket.bind(path)
+        self._handoff_socket.listen(1)
+        self._handoff_socket.setblocking(False)
+        self._selector.register(self._handoff_socket.fileno(), selectors.EVENT_READ, None)
+
+
+    def _handoff(self):
+        """
+        Hand the listening socket and every client over to the process that
+        connected to the handoff socket.  Detached sessions have no socket
+        to pass on and are ended once the handoff is acknowledged, along
+        with TLS and WebSocket clients.  Until then nobody is disconnected,
+        so a failed handoff leaves this process serving everyone.
+
+        The exchange runs in the reactor and no client is served while it
+        does: the state sent has to match the sockets passed with it, so
+        input that arrives meanwhile is left in the socket buffers for the
+        new process to read.  The stall is bounded by HANDOFF_TIMEOUT for
+        the whole exchange, and a receiver that is running takes a few
+        milliseconds to read the state and acknowledge.
+        """
+        try:
+            conn, addr = self._handoff_socket.accept()
+        except OSError:
+            return
+        conn.setblocking(True)
+        listeners = list(self._listeners.values())
+        # TLS and WebSocket state live in this process and cannot be passed on.
+        clients = [client for client in self._clients.values()
+                   if client._tls is None and client._websocket is None]
+        staying = [client for client in self._clients.values()
+                   if client._tls is not None or client._websocket is not None]
+        index = {client: number for number, client in enumerate(clients)}
+        states = []
+        for client in clients:
+            state = client._handoff_state()
+            state['logged_in'] = (client, 'login') not in self._timers
+            state['listener'] = (listeners.index(client._listener)
+                                 if client._listener in listeners else None)
+            states.append(state)
+        channels = {}
+        history = {}
+        for topic in self.channels.topics():
+            channels[topic] = [index[client] for client in self.channels.members(topic)
+                               if client in index]
+        for topic in self.channels.scrollbackTopics():
+            history[topic] = [[encode_bytes(data), None if plain is data else encode_bytes(plain)]
+                              for data, plain in self.channels.scrollback(topic).items()]
+        state = {
+            'listeners': [listener.key() for listener in listeners],
+            'clients': states,
+            'channels': channels,
+            'channel_history': history,
+            'caps_cache': [[addr, ttype, list(caps)] for (addr, ttype), caps in self._caps_cache.items()],
+            }
+        fds = ([listener.socket.fileno() for listener in listeners] +
+               [client.getSocket() for client in clients])
+        try:
+            send_handoff(conn, state, fds)
+        except HandoffError as err:
+            log.error("Handoff aborted, still serving: %s", err)
+            return
+        finally:
+            conn.close()
+
+        # Dropped clients with a session key are detached, so end sessions last.
+        for client in staying:
+            self._drop(client)
+        for session in self.sessions.sessions():
+            self._timers.cancel((session, 'detach'))
+            self._expireSession(session)
+        # The other process owns the connections now, let go without
+        # closing them or running any session hooks.
+        for client in clients:
+            self._selector.unregister(client.getSocket())
+            self._cancelTimers(client)
+            for timer in (client._autosensetimeout, client._key_timer):
+                if timer is not None:
+                    timer.cancel()
+            client._state = STATE_CLOSED
+            client._connected = False
+            client._new_messages = False
+            client.stopRecording()
+            client._socket.close()
+        self._clients.clear()
+        for members in self._states.values():
+            members.clear()
+        self._write_check.clear()
+        self._ready.clear()
+        for listener in listeners:
+            self._selector.unregister(listener.socket.fileno())
+            listener.socket.close()
+        self._listeners.clear()
+        self._selector.unregister(self._handoff_socket.fileno())
+        self._handoff_socket.close()
+        self._handoff_socket = None
+        if self._admin is not None:
+            self._admin.close(unlink=False)
+            self._admin = None
+        self._running = False
+        log.info("Handed off %d clients.", len(clients))
+        self.onHandoff()
+
+
+    def _restoreHandoff(self):
+        """
+        Rebuild the clients taken over from another process.  Sessions
+        carry on where they were, without auto-sensing or onConnect().
+        """
+        state, fds = self._takeover
+        self._takeover = None
+        # Listeners this build no longer asked for stop accepting.
+        for key, sock, listener in self._inherited:
+            if listener is None:
+                log.warning("Closing inherited listener %s, nothing listens on it.", key)
+                sock.close()
+        # Map state names back to the constants, states are compared by identity.
+        states = {name: name for name in self._states}
+        clients = []
+        for fileno, client_state in zip(fds, state['clients']):
+            sock = socket.socket(fileno=fileno)
+            sock.setblocking(False)
+            number = client_state['listener']
+            listener = self._inherited[number][2] if number is not None else None
+            clientclass = listener.clientclass if listener is not None else None
+            client = (clientclass or self.clientclass)(sock, (client_state['_addr'], client_state['_port']))
+            client._server = self
+            client._listener = listener
+            if self._line_editing:
+                client.enableLineEditor()
+            if self._latency:
+                client.enableLatency()
+            client._restore_handoff(client_state)
+            client._set_flush_policy(self._flush_policy)
+            if client._key_decoder is not None and client._key_decoder.pending():
+                # A lone ESC still times out into a key.
+                client._key_timer = self.callLater(func=client._flush_keys, runtime=ESC_TIMEOUT)
+            if self._record:
+                client.startRecording(recording_path(self._record, client._addr, client._port))
+            self._clients[fileno] = client
+            self._setState(client, states[client_state['state']])
+            self._selector.register(fileno, selectors.EVENT_READ, client)
+            self._write_check.add(client)
+            if client._state is STATE_CLOSING:
+                self._timers.schedule((client, 'close'), CLOSE_TIMEOUT, self._drop, client)
+            else:
+                self._startTimers(client)
+                if client_state['logged_in']:
+                    self._timers.cancel((client, 'login'))
+            if not client._auto_sensing_done:
+                client._autosensetimeout = self.callLater(client, func=self._autoSenseTimeout,
+                                                          runtime=AUTOSENSE_TIMEOUT)
+            if client._cmd_list and client._state is STATE_CONNECTED:
+                client._cmd_ready = True
+                self._ready.append(client)
+            clients.append(client)
+
+        for topic, members in state['channels'].items():
+            for number in members:
+                self.channels.join(clients[number], topic)
+        for topic, lines in state['channel_history'].items():
+            history = self.channels.scrollback(topic)
+            if history is None:
+                self.channels.setScrollback(topic)
+                history = self.channels.scrollback(topic)
+            for data, plain in lines:
+                history.append(decode_bytes(data), None if plain is None else decode_bytes(plain))
+        for entry in state['caps_cache']:
+            # Entries without a terminal type, from older builds, are skipped.
+            if len(entry) == 3:
+                self._caps_cache[(entry[0], entry[1])] = tuple(entry[2])
+        for client, client_state in zip(clients, state['clients']):
+            client.setHandoffState(client_state['app'])
+        self._inherited = []
+        log.info("Took over %d clients.", len(clients))
+
+
+    def _setState(self, client, state):
+        """
+        Move a registered client to a new connection state.
+        """
+        fileno = client.getSocket()
+        if client._state in self._states:
+            del self._states[client._state][fileno]
+        client._state = state
+        self._states[state][fileno] = client
+
+
+    def _updateWriteInterest(self):
+        """
+        Ask the selector for write readiness only on clients with output
+        that can be sent.
+        """
+        for client in self._write_check:
+            if client._state is STATE_CLOSED or client._state is STATE_DETACHED:
+                continue
+            want = client._write_pending()
+            if want != client._want_write:
+                client._want_write = want
+                events = selectors.EVENT_READ
+                if want:
+                    events |= selectors.EVENT_WRITE
+                self._selector.modify(client.getSocket(), events, client)
+        self._write_check.clear()
+
+
+    def _closeClient(self, client):
+        """
+        Stop a client's session once its pending output has been flushed.
+        """
+        if client._state is STATE_CLOSED or client._state is STATE_CLOSING:
+            return
+        if client._state is STATE_DETACHED:
+            self._timers.cancel((client, 'detach'))
+            self._expireSession(client)
+            return
+        if not client.sendPending():
+            self._drop(client)
+            return
+        was_connected = client._state is STATE_CONNECTED
+        self._setState(client, STATE_CLOSING)
+        self._write_check.add(client)
+        self._timers.schedule((client, 'close'), CLOSE_TIMEOUT, self._drop, client)
+        if was_connected:
+            self._endSession(client)
+
+
+    def _drop(self, client):
+        """
+        Remove a client from the server and close its socket.  A connected
+        session with a session key that lost its socket is detached instead
+        of ended when configureSessions() gave it a resume grace.
+        """
+        fileno = client.getSocket()
+        if self._clients.pop(fileno, None) is None:
+            return
+        state = client._state
+        del self._states[state][fileno]
+        detach = (state is STATE_CONNECTED and self.sessions.grace and
+                  client._session_key is not None and client._new_messages and
+                  not client._kicked)
+        client._state = STATE_DETACHED if detach else STATE_CLOSED
+        client._connected = False
+        self._selector.unregister(fileno)
+        self._write_check.discard(client)
+        self._cancelTimers(client)
+        if client._autosensetimeout is not None:
+            client._autosensetimeout.cancel()
+            client._autosensetimeout = None
+        if client._key_timer is not None:
+            client._key_timer.cancel()
+            client._key_timer = None
+        client.stopRecording()
+        try:
+            client._socket.close()
+        except OSError:
+            pass
+        if detach:
+            self._detach(client)
+        elif state is STATE_CONNECTED:
+            self._endSession(client)
+
+
+    def _detach(self, client):
+        """
+        Keep a session whose socket was lost until it is resumed or its
+        grace period runs out.
+        """
+        client._want_write = False
+        client._send_buffer.trim(self.sessions.output_limit)
+        displaced = self.sessions.add(client)
+        if displaced is not None:
+            # Another connection with the same key was still detached.
+            self._timers.cancel((displaced, 'detach'))
+            self._expireSession(displaced)
+        self._timers.schedule((client, 'detach'), self.sessions.grace,
+                              self._expireSession, client)
+        log.info("Session '%s' detached.", client._session_key, extra=client._log_extra)
+        client.onDetach()
+
+
+    def _expireSession(self, client):
+        """
+        End a detached session that was not resumed in time.
+        """
+        if client._state is not STATE_DETACHED:
+            return
+        self.sessions.remove(client)
+        client._state = STATE_CLOSED
+        client._new_messages = False
+        client._send_buffer.clear()
+        log.info("Session '%s' expired.", client._session_key, extra=client._log_extra)
+        self._endSession(client)
+
+
+    def _resume(self, session, client):
+        """
+        Move a new connection into a detached session with the same key.
+        The new client object is retired without running its session hooks
+        twice; its socket, telnet state and queued input now belong to the
+        resumed session.
+        """
+        self.sessions.remove(session)
+        self._timers.cancel((session, 'detach'))
+        fileno = client.getSocket()
+        del self._states[client._state][fileno]
+        self._write_check.discard(client)
+        self._cancelTimers(client)
+        client._state = STATE_CLOSED
+        client._connected = False
+        client._new_messages = False
+
+        session._adopt_transport(client)
+        self._clients[fileno] = session
+        session._state = None
+        self._setState(session, STATE_CONNECTED)
+        self._selector.modify(fileno, selectors.EVENT_READ, session)
+        session._connected = True
+        self._startTimers(session)
+        self._timers.cancel((session, 'login'))
+        self._write_check.add(session)
+        if not client._auto_sensing_done:
+            session._autosensetimeout = self.callLater(session, func=self._autoSenseTimeout,
+                                                       runtime=AUTOSENSE_TIMEOUT)
+        log.info("Session '%s' resumed.", session._session_key, extra=session._log_extra)
+        # The connection lives on in the session, so no disconnect hooks.
+        self._cleanupSession(client)
+        session.onResume()
+        if session._cmd_list and not session._cmd_ready:
+            session._cmd_ready = True
+            self._ready.append(session)
+
+
+    def _endSession(self, client):
+        """
+        Run the disconnect hooks and clean up after a client's session.
+        """
+        client.onDisconnect()
+        self.onDisconnect(client)
+        self._cleanupSession(client)
+        if client._session_key is not None and client._scrollback is not None:
+            self._scrollbacks[client._session_key] = client._scrollback
+            self._scrollbacks.move_to_end(client._session_key)
+            if len(self._scrollbacks) > SCROLLBACK_SESSIONS:
+                self._scrollbacks.popitem(last=False)
+
+
+    def _cleanupSession(self, client):
+        """
+        Release what a client object holds on to once it is done with:
+        channel memberships, observers and its latency figures.
+        """
+        self.channels.leaveAll(client)
+        client._stop_mirroring()
+        if client._latency is not None:
+            self._latency_totals[0].merge(client._latency.input)
+            self._latency_totals[1].merge(client._latency.output)
+
+
+    def _startAutoSense(self, client):
+        """
+        Begin terminal negotiation for a new client.
+
+        Replies are checked as they arrive, so only the timeout needs a timer.
+        After setEarlyPromote() clients start their session immediately,
+        and clients whose address and terminal type are cached do so as
+        soon as their terminal type arrives (see _terminalTypeKnown).
+        """
+        if self._starttls_context is not None and client._tls is None:
+            client._request_starttls()
+        client._request_will_echo()
+        client._detect_term_caps(quiet=self._early_promote)
+        client._autosensetimeout = self.callLater(client, func=self._autoSenseTimeout,
+                                                  runtime=AUTOSENSE_TIMEOUT)
+        if self._early_promote:
+            self._promote(client)
+
+
+    def _terminalTypeKnown(self, client):
+        """
+        Called by a negotiating client once its terminal type arrives.  The
+        cache is keyed on address and terminal type, so two terminals
+        behind one NAT address are not given each other's capabilities.
+        A cached client therefore still waits for the TTYPE round trip, but
+        not for the speed and window size replies or the timeout.
+        """
+        key = (client._addr, client._terminal_type)
+        cached = self._caps_cache.get(key)
+        if cached is None:
+            return
+        self._caps_cache.move_to_end(key)
+        client._apply_cached_caps(cached)
+        self._promote(client)
+
+
+    def _autoSenseTimeout(self, client):
+        """
+        Called when a client has not answered auto-sensing in time.
+        """
+        client._autosensetimeout = None
+        if not client._auto_sensing_done:
+            client._finish_auto_sense(timed_out=True)
+
+
+    def _autoSenseDone(self, client, timed_out):
+        """
+        Called by a client once auto-sensing has finished.
+        """
+        if not timed_out:
+            key = (client._addr, client._terminal_type)
+            self._caps_cache[key] = client._cached_caps()
+            self._caps_cache.move_to_end(key)
+            if len(self._caps_cache) > AUTOSENSE_CACHE_SIZE:
+                self._caps_cache.popitem(last=False)
+        if not client._protocol_negotiation:
+            self._promote(client)
+
+
+    def _startTimers(self, client):
+        """
+        Schedule the idle, login and keepalive timers for a new client.
+        Input only updates the client's timestamps; timers that find recent
+        activity simply reschedule themselves.
+        """
+        if self._idle_timeout:
+            self._timers.schedule((client, 'idle'), self._idle_timeout,
+                                  self._idleCheck, client)
+        if self._login_timeout:
+            self._timers.schedule((client, 'login'), self._login_timeout,
+                                  self._loginExpired, client)
+        if self._keepalive:
+            self._timers.schedule((client, 'keepalive'), self._keepalive,
+                                  self._keepaliveCheck, client)
+
+
+    def _throttled(self, client):
+        """
+        Check a throttled client's output again once its allowance has
+        grown back to at least one byte.
+        """
+        delay = (1 - client._throttle_allowance) / client._throttle
+        self._timers.schedule((client, 'throttle'), delay, self._write_check.add, client)
+
+
+    def _cancelTimers(self, client):
+        """
+        Cancel every timer held for a client.
+        """
+        for kind in ('idle', 'login', 'keepalive', 'close', 'detach', 'handshake', 'throttle'):
+            self._timers.cancel((client, kind))
+
+
+    def _idleCheck(self, client):
+        """
+        Kick the client if no command arrived within idle_timeout.
+        """
+        idle = time.time() - client._last_message
+        if idle < self._idle_timeout:
+            self._timers.schedule((client, 'idle'), self._idle_timeout - idle,
+                                  self._idleCheck, client)
+            return
+        log.info("Kicking after %.0f idle seconds.", idle, extra=client._log_extra)
+        client.kick("You have been idle too long.\n\r")
+
+
+    def _loginExpired(self, client):
+        """
+        Kick the client for not logging in within login_timeout.
+        """
+        log.info("Kicking for not logging in.", extra=client._log_extra)
+        client.kick("Login timed out.\n\r")
+
+
+    def _keepaliveCheck(self, client):
+        """
+        Ping a silent client and drop it if the ping went unanswered.
+        """
+        silent = time.time() - client._last_heard
+        if silent >= 2 * self._keepalive:
+            log.info("Dropping, no reply to keepalive.", extra=client._log_extra)
+            self._drop(client)
+            return
+        if silent >= self._keepalive:
+            client._ping()
+            delay = self._keepalive
+        else:
+            delay = self._keepalive - silent
+        self._timers.schedule((client, 'keepalive'), delay, self._keepaliveCheck, client)
+
+
+    def _promote(self, client):
+        """
+        Move a client out of negotiation and start its session.
+        """
+        client._protocol_negotiation = True
+        if client._state is not STATE_NEGOTIATING:
+            return
+        self._setState(client, STATE_CONNECTED)
+        log.debug("Term Type: %s", client._terminal_type, extra=client._log_extra)
+        client.onConnect()
+        self.onConnect(client)
+        if client._cmd_list and not client._cmd_ready:
+            client._cmd_ready = True
+            self._ready.append(client)
 
 
         
 class TelnetOption(object):
     """
-    Simple class used to track the status of an extended Telnet option.
+    Snapshot of the status of an extended Telnet option, used for debug or
+    display.  The live state is kept in TelnetProtocol._telnet_opts.
     """
-    def __init__(self):
+    __slots__ = ('option', 'local_option', 'remote_option', 'reply_pending')
+
+    def __init__(self, option=None):
+        self.option = option            # Option code (single character)
         self.local_option = UNKNOWN     # Local state of an option
         self.remote_option = UNKNOWN    # Remote state of an option
         self.reply_pending = False      # Are we expecting a reply?
-        self.option_text = "Unknown"    # Friendly text for debug or display
-    
-        
-       
+
+    @property
+    def option_text(self):
+        """Friendly text for debug or display."""
+        return Telopts.get(self.option, "Unknown")
+
         
 class TelnetProtocol(object):
     """
     Telent Client Class
     """
-    
+    __slots__ = (
+        '_protocol', '_protocol_negotiation', '_connected', '_new_messages',
+        '_socket', '_fileno', '_addr', '_port', '_cmd_list', '_terminal_type',
+        '_terminal_speed', '_character_mode', '_cmd_ready', '_ansi',
+        '_columns', '_rows', '_send_pending', '_echo_buffer',
+        '_echo_buffer_count', '_send_buffer', '_recv_buffer', '_bytes_sent',
+        '_connect_time', '_autosensetimeout', '_last_message', '_kicked',
+        '_telnet_got_iac', '_telnet_got_cmd', '_telnet_got_sb',
+        '_telnet_opts', '_telnet_echo', '_telnet_echo_password',
+        '_telnet_sb_buffer', '_auto_sensing_done', '_server',
+        '_flush_policy', '_corked', '_messages_queued', '_packets_sent',
+        '_last_heard', '_state', '_want_write', '_key_decoder', '_key_timer',
+        '_line_editor', '_scrollback', '_session_key', '_recorder',
+        '_log_extra', '_tls', '_tls_want_write', '_tls_started', '_tls_time',
+        '_websocket', '_listener', '_bytes_received', '_commands_received',
+        '_throttle', '_throttle_allowance', '_throttle_time', '_latency',
+        '_observers', '_observing',
+        )
+
+    # Per connection attributes a resumed session takes from the connection
+    # that resumed it.
+    _TRANSPORT = (
+        '_socket', '_fileno', '_addr', '_port', '_terminal_type',
+        '_terminal_speed', '_ansi', '_columns', '_rows', '_echo_buffer',
+        '_echo_buffer_count', '_recv_buffer', '_last_message', '_last_heard',
+        '_telnet_got_iac', '_telnet_got_cmd', '_telnet_got_sb', '_telnet_opts',
+        '_telnet_echo', '_telnet_echo_password', '_telnet_sb_buffer',
+        '_auto_sensing_done', '_protocol_negotiation', '_key_decoder',
+        '_connect_time', '_recorder', '_log_extra', '_tls', '_tls_want_write',
+        '_tls_started', '_tls_time', '_websocket',
+        )
+
+    # Attributes carried over to a new process by a handoff, all of them
+    # JSON serializable.
+    _HANDOFF = (
+        '_addr', '_port', '_terminal_type', '_terminal_speed',
+        '_character_mode', '_ansi', '_columns', '_rows', '_echo_buffer',
+        '_echo_buffer_count', '_recv_buffer', '_connect_time',
+        '_last_message', '_last_heard', '_kicked', '_connected',
+        '_new_messages', '_protocol_negotiation', '_auto_sensing_done',
+        '_telnet_got_iac', '_telnet_got_cmd', '_telnet_got_sb',
+        '_telnet_echo', '_telnet_echo_password', '_telnet_sb_buffer',
+        '_session_key', '_bytes_sent', '_messages_queued', '_packets_sent',
+        '_bytes_received', '_commands_received',
+        )
+
     def __init__(self, socket, addr):
         """
         Initialize a new client object.
@@ -405,7 +1749,6 @@ class TelnetProtocol(object):
         self._fileno = self._socket.fileno()
         self._addr = addr[0]
         self._port = addr[1]
-        self._cmd_list = deque()
         self._terminal_type = 'UNKNOWN'
         self._terminal_speed = 'UNKNOWN'
         self._character_mode = False
@@ -417,12 +1760,21 @@ class TelnetProtocol(object):
         self._send_pending = False
         self._echo_buffer = ''
         self._echo_buffer_count = 0
-        self._send_buffer = ''
+        self._send_buffer = OutputQueue()   # Encoded output by priority lane
         self._recv_buffer = ''
+        self._bytes_sent = 0                # Total bytes written to the socket
+        self._bytes_received = 0            # Total bytes read from the socket
+        self._commands_received = 0         # Complete commands queued
+        self._messages_queued = 0           # Calls to send()
+        self._packets_sent = 0              # Socket writes
+        self._flush_policy = None
+        self._corked = False
         self._connect_time = time.time()
         self._autosensetimeout = None
         # If you want to kick for being idle too long
         self._last_message = time.time()
+        # Last time anything at all arrived, used for keepalives
+        self._last_heard = self._last_message
         # Are we kicking the client off?
         self._kicked = False
         
@@ -431,69 +1783,277 @@ class TelnetProtocol(object):
         self._telnet_got_iac = False        # Are we inside an IAC sequence?
         self._telnet_got_cmd = None         # Did we get a telnet command?
         self._telnet_got_sb = False         # Are we inside a subnegotiation?
-        self._telnet_opt_dict = {}          # Mapping for up to 256 TelnetOptions
+        self._telnet_opts = bytearray(256)  # Packed state of all 256 options
         self._telnet_echo = False           # Echo input back to the client?
         self._telnet_echo_password = False  # Echo back '*' for passwords?
         self._telnet_sb_buffer = ''         # Buffer for sub-negotiations
         self._auto_sensing_done = False     #True when all the negotiations are done    
-
-
-    def _detect_term_caps(self):
-        """
-        Send initial terminal negotiation options that we need and wait for the
-        replies so the variables can be set before moving out of the Auto-Sensing
-        phase. Added by Mark Richardson, Nov 2012.
-        """
-        self.send("Auto-Sensing...\n\r{}{}{}{}{}{}\n\r".format(chr(1), chr(1), chr(1), chr(1), chr(1), chr(1)))
+        self._server = None                 # TelnetServer that owns this client
+        self._state = None                  # Connection state on the server
+        self._want_write = False            # Registered for write readiness?
+        self._key_decoder = None            # Character mode KeyDecoder
+        self._key_timer = None              # ESC timeout CallLater
+        self._line_editor = None            # Server side LineEditor
+        self._scrollback = None             # Scrollback of this session's output
+        self._session_key = None            # Application's key for the session
+        self._recorder = None               # SessionRecorder of the raw traffic
+        # Passed with every log record so they can be filtered per connection
+        self._log_extra = {'conn': self.addrport()}
+        self._tls = None                    # TLS state, None for plaintext
+        self._tls_want_write = False        # Handshake waiting to write?
+        self._tls_started = None            # When the TLS handshake began
+        self._tls_time = None               # Seconds the TLS handshake took
+        self._listener = None               # Listener the client connected to
+        self._throttle = None               # Output limit in bytes/sec, None for none
+        self._throttle_allowance = 0.0      # Bytes the throttle lets out right now
+        self._throttle_time = 0.0           # When the allowance was last topped up
+        self._latency = None                # ConnectionLatency, None when not timed
+        self._observers = None              # Clients mirroring this session's output
+        self._observing = None              # Client whose output this one mirrors
+        # WebSocketTransport when the client came in over WebSocket
+        self._websocket = socket if socket.__class__ is WebSocketTransport else None
+
+
+    def _detect_term_caps(self, quiet=False):
+        """
+        Send initial terminal negotiation options that we need.  The replies
+        are checked by _check_auto_sense() as they arrive and the owning
+        TelnetServer times out clients that never answer.
+        Added by Mark Richardson, Nov 2012.
+
+        quiet: Skip the "Auto-Sensing..." banner when the session starts
+               without waiting for the replies.
+        """
+        if not quiet:
+            self.send("Auto-Sensing...\n\r{}{}{}{}{}{}\n\r".format(chr(1), chr(1), chr(1), chr(1), chr(1), chr(1)))
         self._request_terminal_type()
         self._request_terminal_speed()
         self._request_naws()
-        self._autosensetimeout = time.time()
        
        
     def _check_auto_sense(self):
         """
-        Checks the state of the telnet option negotiation started by detect_term_caps()
-        to see if they are all completed. If they are then the client_state should
-        be changed to allow progress. If we dont get a reply to one of these
-        a timer should allow client to proceed.
+        Checks the state of the telnet option negotiation started by detect_term_caps()
+        to see if they are all completed. Called whenever a negotiation reply
+        arrives; returns True once auto-sensing is finished.
+        """
+        if self._check_reply_pending(TTYPE) is False and \
+            self._check_reply_pending(TSPEED) is False and \
+            self._check_reply_pending(NAWS) is False:
+            self._finish_auto_sense()
+            return True
+        
+        # For megamud since it reports TTYPE=False, TSPEED=False, NAWS=True, 
+        # and a terminal type of IBM-3179-2.
+        elif self._check_reply_pending(TTYPE) is False and \
+                self._check_reply_pending(TSPEED) is False and \
+                self._check_reply_pending(NAWS) is True and \
+                self._terminal_type == 'IBM-3179-2':
+                self._finish_auto_sense()
+                return True
+                
+        return False
+
+
+    def _finish_auto_sense(self, timed_out=False):
+        """
+        Apply the auto-sensed terminal capabilities and let the server know
+        the negotiation is over.
+        """
+        self._auto_sensing_done = True
+        # On a timeout keep what we have: off, or the cached capabilities.
+        if not timed_out:
+            self._ansi = self._terminal_type in TERMINAL_TYPES
+        if self._autosensetimeout is not None:
+            self._autosensetimeout.cancel()
+            self._autosensetimeout = None
+        if self._server is not None:
+            self._server._autoSenseDone(self, timed_out)
+        else:
+            self._protocol_negotiation = True
+        self.onAutoSenseComplete()
+
+
+    def _cached_caps(self):
+        """
+        Return the auto-sensed capabilities worth remembering for reconnects.
+        """
+        return (self._terminal_type, self._terminal_speed, self._columns,
+                self._rows, self._ansi)
+
+
+    def _apply_cached_caps(self, caps):
+        """
+        Apply capabilities remembered from an earlier connection with the
+        same terminal type, leaving those already answered alone.
+        """
+        _, speed, columns, rows, self._ansi = caps
+        if self._check_reply_pending(TSPEED):
+            self._terminal_speed = speed
+        if self._check_reply_pending(NAWS):
+            self._columns, self._rows = columns, rows
+
+
+    def onAutoSenseComplete(self):
+        """
+        Called once the terminal capabilities have been auto-sensed, or the
+        auto-sense timed out.  With early promotion this may come after
+        onConnect().
+
+        Override this function.
+        """
+        pass
+        
+        
+    def getSocket(self):
+        """
+        Return client's socket id.
+        """
+        return self._fileno
+    
+    
+    def onTLS(self):
+        """
+        Called once the connection is encrypted, either on a TLS listener
+        before auto-sensing or after the client asked for STARTTLS.
+
+        Override this function.
+        """
+        pass
+
+
+    def isSecure(self):
+        """
+        Is the connection encrypted?
+        """
+        return self._tls is TLS_ACTIVE
+
+
+    def handshakeTime(self):
+        """
+        Return the seconds the TLS handshake took, or None.
+        """
+        return self._tls_time
+
+
+    def onConnect(self):
+        """
+        Called when the client's session starts.
+
+        Override this function.
+        """
+        pass
+
+
+    def onDisconnect(self):
+        """
+        Called when the client's session ends.
+
+        Override this function.
+        """
+        pass
+
+
+    def onDetach(self):
+        """
+        Called when the socket of a session with a session key is lost and
+        the session is kept for a resume.  Output sent while detached is
+        buffered up to the server's detached output limit (see
+        TelnetServer.configureSessions).
+
+        Override this function.
+        """
+        pass
+
+
+    def onResume(self):
+        """
+        Called when a new connection takes over this detached session.
+        Buffered output is sent first.
+
+        Override this function.
+        """
+        pass
+
+
+    def getHandoffState(self):
+        """
+        Return application state to carry over when the server hands its
+        clients to a new process.  Must be JSON serializable.
+
+        Override this function.
         """
-        if self._check_reply_pending(TTYPE) is False and \
-            self._check_reply_pending(TSPEED) is False and \
-            self._check_reply_pending(NAWS) is False:
-            if(self._terminal_type in TERMINAL_TYPES):
-                self._ansi = True
-            self._protocol_negotiation = True
-            logging.debug("Term Type: {}".format(self._terminal_type))
-            return
-        
-        # For megamud since it reports TTYPE=False, TSPEED=False, NAWS=True, 
-        # and a terminal type of IBM-3179-2.
-        elif self._check_reply_pending(TTYPE) is False and \
-                self._check_reply_pending(TSPEED) is False and \
-                self._check_reply_pending(NAWS) is True and \
-                self._terminal_type == 'IBM-3179-2':
-                self.__ansi = True
-                self._protocol_negotiation = True
-                logging.debug("Term Type: {}".format(self._terminal_type))
-                return
-        else:
-            if time.time() - self._autosensetimeout > AUTOSENSE_TIMEOUT:
-                self._ansi = False
-                self._protocol_negotiation = True
-                logging.debug("Term Type: {}".format(self._terminal_type))
-                return
-                
-        return
-        
-        
-    def getSocket(self):
+        return None
+
+
+    def setHandoffState(self, state):
         """
-        Return client's socket id.
+        Called in the new process with the value getHandoffState() returned
+        in the old one, once every client has been taken over.
+
+        Override this function.
         """
-        return self._fileno
-    
-    
+        pass
+
+
+    def _handoff_state(self):
+        """
+        Return this client's protocol state for a handoff.
+        """
+        state = {name: getattr(self, name) for name in self._HANDOFF}
+        state['state'] = self._state
+        state['telnet_opts'] = encode_bytes(self._telnet_opts)
+        state['output'] = [[encode_bytes(chunk) for chunk in self._send_buffer.laneChunks(lane)]
+                           for lane in (LANE_INTERACTIVE, LANE_NORMAL, LANE_BULK)]
+        state['partial'] = self._send_buffer.partial
+        state['commands'] = [list(cmd) if cmd.__class__ is tuple else cmd
+                             for cmd in self._cmd_list]
+        decoder = self._key_decoder
+        state['keys'] = decoder._pending if decoder is not None and decoder.pending() else ''
+        editor = self._line_editor
+        state['editor'] = list(editor.snapshot()) if editor is not None else None
+        history = self._scrollback
+        if history is not None:
+            state['scrollback'] = [history.max_lines, history.max_bytes,
+                                   [[encode_bytes(data), None if plain is data else encode_bytes(plain)]
+                                    for data, plain in history.items()]]
+        else:
+            state['scrollback'] = None
+        state['app'] = self.getHandoffState()
+        return state
+
+
+    def _restore_handoff(self, state):
+        """
+        Restore the protocol state saved by _handoff_state().
+        """
+        for name in self._HANDOFF:
+            setattr(self, name, state[name])
+        self._telnet_opts = bytearray(decode_bytes(state['telnet_opts']))
+        for lane, chunks in enumerate(state['output']):
+            for chunk in chunks:
+                self._send_buffer.append(decode_bytes(chunk), lane, coalesce=False)
+        self._send_buffer.partial = state.get('partial')
+        self._send_pending = bool(len(self._send_buffer))
+        for cmd in state['commands']:
+            self._cmd_list.append(tuple(cmd) if isinstance(cmd, list) else cmd)
+        if self._latency is not None:
+            self._latency.reset(self._send_buffer)
+        if state['keys']:
+            self._key_decoder = KeyDecoder()
+            self._key_decoder.feed(state['keys'])
+        if state['editor'] is not None:
+            if self._line_editor is None:
+                self.enableLineEditor()
+            self._line_editor.restore(*state['editor'])
+        if state['scrollback'] is not None:
+            lines, max_bytes, items = state['scrollback']
+            self._scrollback = Scrollback(lines, max_bytes)
+            for data, plain in items:
+                self._scrollback.append(decode_bytes(data),
+                                        None if plain is None else decode_bytes(plain))
+
+
     def dataRecieved(self, data):
         """
         Return data recived.
@@ -503,9 +2063,37 @@ class TelnetProtocol(object):
         pass
         
         
+    def keyPressed(self, key, data):
+        """
+        Called in character mode for every decoded key.  key is a
+        keyboard_map name such as 'UPARROW', 'ENTER', 'BACKSPACE', or None
+        when data is plain text.
+
+        Override this function.  By default data is passed to dataRecieved().
+        """
+        self.dataRecieved(data)
+
+
+    def _dispatch(self, msg):
+        """
+        Hand a queued command or key event to the application.
+        """
+        if msg.__class__ is tuple:
+            self.keyPressed(msg[0], msg[1])
+        else:
+            self.dataRecieved(msg)
+        if not self._connected and self._state is STATE_CONNECTED and self._server is not None:
+            # Handler cleared _connected the old way, see isConnected().
+            self._server._closeClient(self)
+        
+        
     def isConnected(self):
         """
         Is the client connected?
+
+        Clients are no longer polled.  Call disconnect() or kick() to close
+        a connection; clearing _connected only does so from a command
+        handler (dataRecieved or keyPressed).
         """
         if self._connected and not self._kicked:
             return True
@@ -519,6 +2107,33 @@ class TelnetProtocol(object):
         if len(self._send_buffer):
             return True
         return False
+
+
+    def _sendable_lane(self):
+        """
+        Return the lowest priority output lane that may be sent right now.
+        In line mode only interactive output goes out while the user types.
+        """
+        typing = self._line_editor if self._line_editor is not None else self._recv_buffer
+        if self.inCharacterMode() or not len(typing) or self._state is STATE_CLOSING:
+            return LANE_BULK
+        return LANE_INTERACTIVE
+
+
+    def _write_pending(self):
+        """
+        Is there data that can be written to the socket right now?
+        """
+        if self._tls is TLS_HANDSHAKE or self._tls is TLS_UPGRADE:
+            return self._tls_want_write
+        if self._websocket is not None and self._websocket.outputPending():
+            return True
+        if self._throttle is not None and self._throttle_allowance + (
+                time.time() - self._throttle_time) * self._throttle < 1:
+            return False
+        if self._telnet_echo and self._echo_buffer:
+            return True
+        return self._send_buffer.pending(self._sendable_lane())
         
         
     def _commandReady(self):
@@ -532,12 +2147,198 @@ class TelnetProtocol(object):
         """
         Return first command line command list.
         """
-        if self._commandReady() and len(self._cmd_list):
-            return self._cmd_list.pop()
+        if self._cmd_list:
+            msg = self._cmd_list.popleft()
+            if self._latency is not None:
+                self._latency.commandDispatched(len(self._cmd_list))
+            return msg
         else:
             self._cmd_ready = False
             return 
 
+
+    def _queue_keys(self, events):
+        """
+        Queue decoded key events and time out a partial escape sequence.
+        """
+        if self._character_mode:
+            for event in events:
+                self._queue_command(event)
+        else:
+            self._edit_keys(events)
+        if self._key_timer is not None:
+            self._key_timer.cancel()
+            self._key_timer = None
+        if self._key_decoder.pending() and self._server is not None:
+            self._key_timer = self._server.callLater(func=self._flush_keys, runtime=ESC_TIMEOUT)
+
+
+    def _flush_keys(self):
+        """
+        ESC timeout expired, deliver the partial escape sequence as keys.
+        """
+        self._key_timer = None
+        self._queue_keys(self._key_decoder.flush())
+
+
+    def enableScrollback(self, lines, max_bytes=SCROLLBACK_BYTES):
+        """
+        Keep the last lines of output sent to this session.
+        """
+        self._scrollback = Scrollback(lines, max_bytes)
+
+
+    def setSessionKey(self, key):
+        """
+        Tie this connection to an application session, e.g. an account name.
+        If an earlier connection with the same key left scrollback behind,
+        it is taken over and can be sent with replayScrollback().
+
+        If a session with the same key is detached, this connection is
+        handed over to it and it is returned; this client object is retired
+        and the application should carry on with the returned one.
+        Otherwise self is returned.
+        """
+        server = self._server
+        if server is not None and self._state is STATE_CONNECTED:
+            session = server.sessions.take(key)
+            if session is not None:
+                server._resume(session, self)
+                return session
+        self._session_key = key
+        if server is not None and self._scrollback is not None:
+            history = server._scrollbacks.pop(key, None)
+            if history is not None:
+                self._scrollback = history
+        return self
+
+
+    def _adopt_transport(self, client):
+        """
+        Take over another client's connection: its socket, terminal and
+        telnet state, unread input and unsent output.
+        """
+        for name in self._TRANSPORT:
+            setattr(self, name, getattr(client, name))
+        if client._autosensetimeout is not None:
+            client._autosensetimeout.cancel()
+            client._autosensetimeout = None
+        if client._key_timer is not None:
+            client._key_timer.cancel()
+            client._key_timer = None
+        # Negotiation replies queued for the new connection go out first.
+        self._send_buffer.prepend(client._send_buffer)
+        self._send_pending = bool(len(self._send_buffer))
+        self._want_write = False
+        self._cmd_list.extend(client._cmd_list)
+        client._cmd_list.clear()
+        if self._latency is not None:
+            self._latency.reset(self._send_buffer)
+        self._kicked = False
+        self._new_messages = True
+        self._set_flush_policy(self._flush_policy)
+
+
+    def startRecording(self, path):
+        """
+        Record this connection's raw traffic to path (see sonzo.recorder).
+        """
+        self.stopRecording()
+        try:
+            self._recorder = SessionRecorder(path, {'addr': self._addr, 'port': self._port})
+        except OSError as err:
+            log.error("Could not record: %s", err, extra=self._log_extra)
+
+
+    def stopRecording(self):
+        """
+        Stop recording and close the recording.
+        """
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+
+
+    def replayScrollback(self):
+        """
+        Send the session's scrollback to the client in one write.
+        """
+        if self._scrollback is not None:
+            self._scrollback.replay(self)
+
+
+    def enableLatency(self):
+        """
+        Keep histograms of this client's input and output latency.
+        """
+        self._latency = ConnectionLatency()
+        self._latency.reset(self._send_buffer)
+
+
+    def latencyStats(self):
+        """
+        Return {'input': summary, 'output': summary} of this client's
+        latency (see LatencyHistogram.summary), or None when not timed.
+        """
+        if self._latency is None:
+            return None
+        return {'input': self._latency.input.summary(),
+                'output': self._latency.output.summary()}
+
+
+    def enableLineEditor(self, history=HISTORY_SIZE):
+        """
+        Edit lines on the server: cursor keys, a history ring recalled with
+        the up and down arrows and TAB completion through completeLine().
+        Only used in line mode while the server echoes.
+        """
+        self._line_editor = LineEditor(history, completer=self.completeLine)
+
+
+    def completeLine(self, line):
+        """
+        Return a list of candidate lines for TAB completion of line.
+
+        Override this function.
+        """
+        return []
+
+
+    def _edit_keys(self, events):
+        """
+        Run key events through the line editor, echoing the edits and
+        queueing finished lines as commands.
+        """
+        editor = self._line_editor
+        editor.password = self._telnet_echo_password
+        echo = []
+        for key, data in events:
+            text, line = editor.key(key, data)
+            echo.append(text)
+            if line is not None:
+                self._queue_command(line.strip() + '\n\r')
+                self._last_message = self._last_heard
+        echo = ''.join(echo)
+        if echo and self._telnet_echo:
+            self._echo_buffer += echo
+            if self._server is not None:
+                self._server._write_check.add(self)
+
+
+    def _queue_command(self, cmd):
+        """
+        Add a complete command to the command list and put the client on the
+        server's ready queue if it is not already there.
+        """
+        self._cmd_list.append(cmd)
+        self._commands_received += 1
+        if self._latency is not None:
+            self._latency.commandQueued()
+        if not self._cmd_ready:
+            self._cmd_ready = True
+            if self._server is not None:
+                self._server._ready.append(self)
+
         
     def inCharacterMode(self):
         """
@@ -556,6 +2357,8 @@ class TelnetProtocol(object):
             self._character_mode = False
         else:
             self._character_mode = True
+        if self._flush_policy:
+            self._set_flush_policy(self._flush_policy)
 
     def setANSIMode(self):
         """
@@ -572,8 +2375,83 @@ class TelnetProtocol(object):
         Set client in LineMode
         """
         self._character_mode = False
+        if self._flush_policy:
+            self._set_flush_policy(self._flush_policy)
+
+
+    def _set_flush_policy(self, policy):
+        """
+        Configure the socket for FLUSH_IMMEDIATE or FLUSH_TICK.  Keystroke
+        echo in character mode is always flushed immediately.
+        """
+        self._flush_policy = policy
+        immediate = policy == FLUSH_IMMEDIATE or self._character_mode
+        try:
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(immediate))
+            if HAVE_TCP_CORK:
+                self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(not immediate))
+        except (socket.error, AttributeError):
+            # Not a TCP socket.
+            return
+        self._corked = HAVE_TCP_CORK and not immediate
+
+
+    def _uncork(self):
+        """
+        Flush data held back by TCP_CORK and cork the socket again.
+        """
+        try:
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        except socket.error:
+            self._corked = False
+
+
+    def packetsPerMessage(self):
+        """
+        Return the average number of socket writes per message sent.
+        """
+        if not self._messages_queued:
+            return 0.0
+        return self._packets_sent / self._messages_queued
         
         
+    def disconnect(self):
+        """
+        Disconnect the client once any pending output has been sent.
+        """
+        self._new_messages = False
+        self._connected = False
+        if self._server is not None:
+            self._server._closeClient(self)
+
+
+    def kick(self, message=None):
+        """
+        Disconnect the client, optionally sending a parting message.
+        """
+        if message:
+            self.send(message, LANE_INTERACTIVE)
+        self._kicked = True
+        self.disconnect()
+
+
+    def loginComplete(self):
+        """
+        Tell the server the client has logged in, stopping the login timeout.
+        """
+        if self._server is not None:
+            self._server._timers.cancel((self, 'login'))
+
+
+    def _ping(self):
+        """
+        Send a telnet TIMING-MARK request, which any live client answers.
+        """
+        self._iac_do(TMARK)
+        self._note_reply_pending(TMARK, True)
+
+
     def addrport(self):
         """
         Return the client's IP address and port number as a string.
@@ -581,75 +2459,387 @@ class TelnetProtocol(object):
         return "{}:{}".format(self._addr, self._port)        
         
         
-    def send(self, message):
+    def send(self, message, lane=LANE_NORMAL):
         """
         Add new messages to the _send_buffer if allowed.
+
+        lane: LANE_INTERACTIVE for prompts and other urgent text,
+              LANE_NORMAL, or LANE_BULK for output that may be coalesced
+              or dropped when the client falls behind.
+        """
+        if self._new_messages:
+            self.sendEncoded(bytes(message, "cp1252"), lane)
+
+
+    def sendEncoded(self, data, lane=LANE_NORMAL, record=True):
+        """
+        Queue already encoded bytes.  The object is queued as is, so one
+        encoded message can be shared by many clients.
+
+        record: Add normal and bulk output to the session scrollback.
         """
         if self._new_messages:
-            self._send_buffer = self._send_buffer + message
+            if record and self._scrollback is not None and lane != LANE_INTERACTIVE:
+                self._scrollback.append(data)
+            self._send_buffer.append(data, lane)
+            if self._latency is not None:
+                self._latency.queued(lane, len(data))
+            if self._observers and (lane != LANE_INTERACTIVE or _IAC_BYTE not in data):
+                for observer in self._observers:
+                    observer._mirror(data)
+            self._send_pending = True
+            self._messages_queued += 1
+            if self._state is STATE_DETACHED:
+                self._send_buffer.trim(self._server.sessions.output_limit)
+            elif self._server is not None:
+                self._server._write_check.add(self)
+
+
+    def addObserver(self, client):
+        """
+        Mirror this session's output to another client, e.g. an admin or a
+        stream watching a player.  The observer is sent the same encoded
+        chunks, shared by reference, on its bulk lane: an observer that
+        falls behind loses its oldest mirrored output and never holds up
+        this session.  Telnet negotiation is not mirrored.
+
+        A client observes one session at a time, observing another one
+        stops the first.
+        """
+        if client is self or client._observing is self:
+            return
+        if client._observing is not None:
+            client._observing.removeObserver(client)
+        if self._observers is None:
+            self._observers = []
+        self._observers.append(client)
+        client._observing = self
+        client.onObserve(self)
+
+
+    def removeObserver(self, client):
+        """
+        Stop mirroring this session's output to a client.
+        """
+        if self._observers and client in self._observers:
+            self._observers.remove(client)
+            client._observing = None
+            client.onObserveEnd(self)
+
+
+    def observers(self):
+        """
+        Return the clients mirroring this session's output.
+        """
+        return list(self._observers or ())
+
+
+    def observing(self):
+        """
+        Return the client whose output this client mirrors, or None.
+        """
+        return self._observing
+
+
+    def onObserve(self, client):
+        """
+        Called when this client starts mirroring client's output.
+
+        Override this function.
+        """
+        pass
+
+
+    def onObserveEnd(self, client):
+        """
+        Called when this client stops mirroring client's output, including
+        when either session ends.
+
+        Override this function.
+        """
+        pass
+
+
+    def _mirror(self, data):
+        """
+        Queue a chunk of an observed session's output without copying it.
+        """
+        if self._new_messages and self._state is not STATE_DETACHED:
+            self._send_buffer.append(data, LANE_BULK, coalesce=False)
+            if self._latency is not None:
+                self._latency.queued(LANE_BULK, len(data), stamp=False)
             self._send_pending = True
+            if self._server is not None:
+                self._server._write_check.add(self)
+
+
+    def _stop_mirroring(self):
+        """
+        Detach this client from the session it observes and from its own
+        observers.
+        """
+        if self._observing is not None:
+            self._observing.removeObserver(self)
+        for observer in self.observers():
+            self.removeObserver(observer)
+
+
+    def throttle(self, rate):
+        """
+        Limit output to rate bytes a second, None to lift the limit.  Output
+        held back by the limit stays queued and is subject to the usual
+        lane limits.
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError("Throttle rate must be positive.")
+        self._throttle = rate
+        self._throttle_allowance = float(rate or 0)
+        self._throttle_time = time.time()
+        if self._server is not None:
+            self._server._timers.cancel((self, 'throttle'))
+            self._server._write_check.add(self)
+
+
+    def _throttled(self, chunks):
+        """
+        Return as much of chunks as the throttle lets out now, without
+        copying.
+        """
+        now = time.time()
+        self._throttle_allowance = min(float(self._throttle), self._throttle_allowance +
+                                       (now - self._throttle_time) * self._throttle)
+        self._throttle_time = now
+        budget = int(self._throttle_allowance)
+        if budget < 1 and self._server is not None:
+            self._server._throttled(self)
+        cut = []
+        for data in chunks:
+            if budget <= 0:
+                break
+            if len(data) > budget:
+                data = memoryview(data)[:budget]
+            cut.append(data)
+            budget -= len(data)
+        return cut
+
+
+    def memoryUsage(self):
+        """
+        Return the bytes held in each of the client's buffers.  Strings
+        count one byte a character, as they are sent in cp1252.
+        """
+        commands = 0
+        for msg in self._cmd_list:
+            commands += len(msg) if msg.__class__ is not tuple else len(msg[1] or '')
+        line_editor = 0
+        if self._line_editor is not None:
+            line_editor = len(self._line_editor) + sum(len(line) for line in self._line_editor.history())
+        return {
+            'send': len(self._send_buffer),
+            'echo': len(self._echo_buffer),
+            'recv': len(self._recv_buffer),
+            'subnegotiation': len(self._telnet_sb_buffer),
+            'commands': commands,
+            'line_editor': line_editor,
+            'scrollback': self._scrollback.size() if self._scrollback is not None else 0,
+            }
+
+
+    def connectionStats(self):
+        """
+        Return a dict describing the connection and its traffic, for admin
+        tools.
+        """
+        now = time.time()
+        return {
+            'address': self.addrport(),
+            'state': self._state,
+            'terminal_type': self._terminal_type,
+            'terminal_speed': str(self._terminal_speed),
+            'columns': self._columns,
+            'rows': self._rows,
+            'ansi': self._ansi,
+            'character_mode': self._character_mode,
+            'queued': tuple(self._send_buffer.laneSize(lane)
+                            for lane in (LANE_INTERACTIVE, LANE_NORMAL, LANE_BULK)),
+            'commands_waiting': len(self._cmd_list),
+            'bytes_sent': self._bytes_sent,
+            'bytes_received': self._bytes_received,
+            'commands': self._commands_received,
+            'messages_queued': self._messages_queued,
+            'packets_sent': self._packets_sent,
+            'connected': now - self._connect_time,
+            'idle': now - self._last_message,
+            'tls': self._tls,
+            'websocket': self._websocket is not None,
+            'throttle': self._throttle,
+            'observers': len(self._observers or ()),
+            'observing': self._observing.addrport() if self._observing is not None else None,
+            }
+
+
+    def sendFile(self, path, lane=LANE_NORMAL):
+        """
+        Send a file through the server's ContentCache: read once, rendered
+        for ANSI or plain terminals, and shared by every client.  Large
+        files that need no rendering go out with os.sendfile() to plain TCP
+        clients.  Raises OSError if the file cannot be read.
+
+        Static content is not added to the session scrollback.
+        """
+        if self._server is not None:
+            cached = self._server.content.get(path)
+        else:
+            cached = CachedFile(path)
+        self.sendEncoded(cached.variant(self._ansi), lane, record=False)
+
+
+    def sendPrompt(self, message):
+        """
+        Send a prompt ahead of any queued normal or bulk output.
+        """
+        self.send(message, LANE_INTERACTIVE)
            
            
+    def _queue_echo(self):
+        """
+        Move the echo buffer onto the interactive lane.
+        """
+        echo = bytes(self._echo_buffer, "cp1252")
+        self._send_buffer.append(echo, LANE_INTERACTIVE)
+        if self._latency is not None:
+            self._latency.echoQueued(len(echo))
+        if self._observers:
+            for observer in self._observers:
+                observer._mirror(echo)
+        self._echo_buffer = ''
+
+
     def _send(self):
         """
         Called by TelnetServer to send data to the client.
+
+        Echo and every sendable lane are coalesced into a single socket write.
         """
-        
         if self._telnet_echo and self._echo_buffer:
-            try:
-                sent = self._socket.send(bytes(self._echo_buffer, "cp1252"))
-            except socket.error as err:
-                self._connected = False
-                return False            
-            self._echo_buffer = ''
+            self._queue_echo()
 
-            
-            
-        if self.inCharacterMode():
-            try:
-                sent = self._socket.send(bytes(self._send_buffer, "cp1252"))
-                self._bytes_sent = sent
-                self._send_buffer = self._send_buffer[sent:]
-            except socket.error as err:
-                self._connected = False
-                return False 
-        else:
-            # Is the user currently typing?
-            if not len(self._recv_buffer):
-                self._send_pending = False
+        lane = self._sendable_lane()
+        if lane == LANE_INTERACTIVE and len(self._send_buffer) > MAX_HELD_OUTPUT:
+            # Is the users send buffer getting to large while waiting for them to finish typing? Kick them!
+            self._kicked = True
+            return False
+
+        chunks = self._send_buffer.chunks(lane)
+        if chunks and self._send_buffer.files:
+            chunks = self._file_chunks(chunks)
+            if chunks.__class__ is FileChunk:
+                return self._sendfile(chunks)
+        if chunks and self._throttle is not None:
+            chunks = self._throttled(chunks)
+        if not chunks:
+            if self._websocket is not None and self._websocket.outputPending():
                 try:
-                    sent = self._socket.send(bytes(self._send_buffer, "cp1252"))
-                except socket.error as err:
+                    self._websocket.flush()
+                except socket.error:
                     self._connected = False
-                    return False            
-            
-                self._bytes_sent = sent
-                self._send_buffer = self._send_buffer[sent:]
+                    return False
+            return
+        try:
+            if len(chunks) > 1 and (self._websocket is not None or (
+                    HAVE_SENDMSG and (self._tls is None or self._tls is TLS_FOLLOWS))):
+                sent = self._socket.sendmsg(chunks)
             else:
-                # Is the users send buffer getting to large while waiting for them to finish typing? Kick them!
-                if len(self._send_buffer) > 8388608:
-                    self._kicked = True
-                    return
-                self._send_pending = True
-             
-
+                sent = self._socket.send(chunks[0] if len(chunks) == 1 else b''.join(chunks))
+        except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            return
+        except socket.error as err:
+            self._connected = False
+            return False
+        if self._recorder is not None:
+            self._recorder.send(b''.join(chunks)[:sent])
+        self._packets_sent += 1
+        self._bytes_sent += sent
+        if self._throttle is not None:
+            self._throttle_allowance -= sent
+            if self._throttle_allowance < 1 and self._server is not None:
+                self._server._throttled(self)
+        self._send_buffer.consume(sent)
+        if self._latency is not None:
+            self._latency.sent(self._send_buffer)
+        self._send_pending = bool(len(self._send_buffer))
             
             
+    def _file_chunks(self, chunks):
+        """
+        Prepare queued chunks that include FileChunks for writing.  Returns
+        a lone FileChunk to go out with os.sendfile(), or the chunks to
+        write up to the next one.  Transports that cannot use sendfile()
+        write FileChunks from memory.
+        """
+        sendfile = (HAVE_SENDFILE and self._tls is None and self._websocket is None and
+                    self._recorder is None and self._throttle is None)
+        for index, chunk in enumerate(chunks):
+            if chunk.__class__ is FileChunk:
+                if not sendfile:
+                    chunks[index] = chunk.view()
+                elif index:
+                    return chunks[:index]
+                else:
+                    return chunk
+        return chunks
+
+
+    def _sendfile(self, chunk):
+        """
+        Write a FileChunk straight from its file.
+        """
+        try:
+            sent = os.sendfile(self._fileno, chunk.file.fileno(), chunk.offset, len(chunk))
+            if not sent:
+                # The file shrank on disk, send the contents read earlier.
+                sent = self._socket.send(chunk.view())
+        except BlockingIOError:
+            return
+        except OSError:
+            self._connected = False
+            return False
+        self._packets_sent += 1
+        self._bytes_sent += sent
+        self._send_buffer.consume(sent)
+        if self._latency is not None:
+            self._latency.sent(self._send_buffer)
+        self._send_pending = bool(len(self._send_buffer))
+
+
     def _recv(self):
         """
         Called my TelnetServer to recieve data from the client.
         """
         try:
-            #Encode recieved bytes in ansi
-            data = str(self._socket.recv(2048), "cp1252")
+            if self._tls is TLS_FOLLOWS:
+                raw = self._recv_until_tls()
+            else:
+                raw = self._socket.recv(2048)
+                if self._tls is TLS_ACTIVE and self._websocket is None and self._socket.pending():
+                    # Rest of a TLS record that select() cannot see.
+                    raw += self._socket.recv(self._socket.pending())
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
         except socket.error as err:
-            logging.error("RECIEVE socket error '{}:{}' from {}".format(err[0], err[1], self.addrport()))
+            log.error("RECIEVE socket error '%s:%s'", err.errno, err.strerror, extra=self._log_extra)
             raise ConnectionLost()        
         
         
-        if not len(data):
-            logging.debug("No data received.  Connection lost.")
+        if not len(raw):
+            log.debug("No data received.  Connection lost.", extra=self._log_extra)
             raise ConnectionLost()
+        self._bytes_received += len(raw)
+        if self._recorder is not None:
+            self._recorder.recv(raw)
+        #Encode recieved bytes in ansi
+        data = str(raw, "cp1252")
+        self._last_heard = time.time()
         
         # Workaround for clients that send CR as "\r0" (carrage return plus a null)
         if data == "{}{}".format(chr(13), chr(0)):
@@ -657,12 +2847,20 @@ class TelnetProtocol(object):
             
         for byte in data:
             self._iac_sniffer(byte)
+        if self._latency is not None and self._echo_buffer:
+            self._latency.echoPending()
+        if self._observers and self._telnet_echo and self._echo_buffer:
+            # Observers see the echo ahead of the replies to it.
+            self._queue_echo()
              
-        if self.inCharacterMode():
+        if self.inCharacterMode() or self._line_editor is not None:
             if self._recv_buffer:
-                self._cmd_list.append(self._recv_buffer)
+                if self._key_decoder is None:
+                    self._key_decoder = KeyDecoder()
+                self._queue_keys(self._key_decoder.feed(self._recv_buffer))
                 self._recv_buffer = ''
-                self._cmd_ready = True
+                if self._character_mode:
+                    self._last_message = self._last_heard
         else:
             while True:
                 mark = self._recv_buffer.find('\n')
@@ -670,20 +2868,54 @@ class TelnetProtocol(object):
                     break
                 cmd = self._recv_buffer[:mark].strip()
                 cmd = cmd + '\n\r'
-                self._cmd_list.append(cmd)
-                self._cmd_ready = True
+                self._queue_command(cmd)
+                self._last_message = self._last_heard
                 self._recv_buffer = self._recv_buffer[mark+1:]
+        if self._latency is not None and self._echo_buffer:
+            # Echo from the line editor.
+            self._latency.echoPending()
                 
                 
                 
     
+    def _recv_until_tls(self):
+        """
+        Read plaintext while STARTTLS is under way, stopping right after the
+        client's FOLLOWS so its TLS ClientHello stays in the socket.
+        """
+        data = self._socket.recv(2048, socket.MSG_PEEK)
+        end = data.find(_STARTTLS_FOLLOWS)
+        if end != -1:
+            return self._socket.recv(end + len(_STARTTLS_FOLLOWS))
+        if not data:
+            return self._socket.recv(1)
+        # Leave a FOLLOWS that may be split across reads in the socket.
+        keep = 0
+        for size in range(len(_STARTTLS_FOLLOWS) - 1, 0, -1):
+            if data.endswith(_STARTTLS_FOLLOWS[:size]):
+                keep = size
+                break
+        if keep == len(data):
+            raise BlockingIOError()
+        return self._socket.recv(len(data) - keep)
+
+
 # Private telnet negotiation functions
 
+    def _request_starttls(self):
+        """
+        Offer to switch the connection to TLS (STARTTLS, telnet option 46).
+        """
+        log.debug("Requesting start TLS.", extra=self._log_extra)
+        self._iac_do(START_TLS)
+        self._note_reply_pending(START_TLS, True)
+
+
     def _request_do_sga(self):
         """
         Request do Suppress Go-Ahead Option (SGA) RFC-858.
         """
-        logging.debug("Requesting suppress go-ahead.")
+        log.debug("Requesting suppress go-ahead.", extra=self._log_extra)
         self._iac_do(SGA)
         self._note_reply_pending(SGA, True)
         
@@ -692,7 +2924,7 @@ class TelnetProtocol(object):
         """
         Request WILL echo to echo client's text.  RFC-857
         """
-        logging.debug("Requesting will echo.")
+        log.debug("Requesting will echo.", extra=self._log_extra)
         self._iac_will(ECHO)
         self._note_reply_pending(ECHO, True)
         self._telnet_echo = True
@@ -702,7 +2934,7 @@ class TelnetProtocol(object):
         """
         Request WON'T echo to not echo client's text.  RC-857
         """
-        logging.debug("Requesting won't echo.")
+        log.debug("Requesting won't echo.", extra=self._log_extra)
         self._iac_wont(ECHO)
         self._note_reply_pending(ECHO, True)
         self._telnet_echo = False        
@@ -712,7 +2944,7 @@ class TelnetProtocol(object):
         """
         Request disable echo for passwords protection.
         """
-        logging.debug("Requesting to disable echo for passwords")
+        log.debug("Requesting to disable echo for passwords", extra=self._log_extra)
         self._iac_will(ECHO)
         self._note_reply_pending(ECHO, True)
         
@@ -721,7 +2953,8 @@ class TelnetProtocol(object):
         """
         Request echo on since we aren't entering a password at this time.
         """
-        logging.debug("Request to enable echo since not entering a password at this time.".format(self.address))
+        log.debug("Request to enable echo since not entering a password at this time.",
+                  extra=self._log_extra)
         self._iac_wont(ECHO)
         self._note_reply_pending(ECHO, True)        
         
@@ -760,9 +2993,14 @@ class TelnetProtocol(object):
         ## Filter out non-printing characters
         #if (byte >= ' ' and byte <= '~') or byte == '\n':
              
+        if self._line_editor is not None and not self._character_mode:
+            # The line editor does its own echo and editing.
+            self._recv_buffer += byte
+            return
         if self._telnet_echo:
             self._echo_byte(byte)
-        if chr(8) is byte or chr(127) is byte:
+        # Character mode passes backspace and delete on as keys.
+        if not self._character_mode and (chr(8) is byte or chr(127) is byte):
             if self._recv_buffer is not chr(13) or len(self._recv_buffer) is not 0:
                 self._recv_buffer = self._recv_buffer[:-1]
                 return
@@ -871,7 +3109,7 @@ class TelnetProtocol(object):
         """
         Handle incoming Telnet commands that are two bytes long.
         """
-        logging.debug("Got two byte cmd '{}'".format(ord(cmd)))
+        log.debug("Got two byte cmd '%d'", ord(cmd), extra=self._log_extra)
 
         if cmd == SB:
             ## Begin capturing a sub-negotiation string
@@ -908,7 +3146,7 @@ class TelnetProtocol(object):
             pass
 
         else:
-            logging.warning("Send an invalid 2 byte command")
+            log.warning("Send an invalid 2 byte command", extra=self._log_extra)
 
         self._telnet_got_iac = False
         self._telnet_got_cmd = None
@@ -918,7 +3156,7 @@ class TelnetProtocol(object):
         Handle incoming Telnet commmands that are three bytes long.
         """
         cmd = self._telnet_got_cmd
-        logging.debug("Got three byte cmd {}:{}".format(ord(cmd), ord(option)))
+        log.debug("Got three byte cmd %d:%d", ord(cmd), ord(option), extra=self._log_extra)
 
         ## Incoming DO's and DONT's refer to the status of this end
         if cmd == DO:
@@ -987,19 +3225,31 @@ class TelnetProtocol(object):
                     #self._note_reply_pending(TTYPE, False)
                     self._note_remote_option(TTYPE, True)
                     ## Tell them to send their terminal type
-                    self.send("{}{}{}{}{}{}".format(IAC, SB, TTYPE, SEND, IAC, SE))
+                    self.send("{}{}{}{}{}{}".format(IAC, SB, TTYPE, SEND, IAC, SE), LANE_INTERACTIVE)
 
                 elif (self._check_remote_option(TTYPE) is False or
                         self._check_remote_option(TTYPE) is UNKNOWN):
                     self._note_remote_option(TTYPE, True)
                     self._iac_do(TTYPE)
             
+            elif option == TMARK:
+                ## Keepalive answered
+                self._note_reply_pending(TMARK, False)
+
+            elif option == START_TLS:
+                if self._check_reply_pending(START_TLS):
+                    self._note_reply_pending(START_TLS, False)
+                    self._note_remote_option(START_TLS, True)
+                    ## The client's FOLLOWS reply is followed by its ClientHello
+                    self.send("{}{}{}{}{}{}".format(IAC, SB, START_TLS, FOLLOWS, IAC, SE), LANE_INTERACTIVE)
+                    self._tls = TLS_FOLLOWS
+
             elif option == TSPEED:
                 if self._check_reply_pending(TSPEED):
                     self._note_reply_pending(TSPEED, False)
                     self._note_remote_option(TSPEED, True)
                     ## Tell them to send their terminal speed
-                    self.send("{}{}{}{}{}{}".format(IAC, SB, TSPEED, SEND, IAC, SE))
+                    self.send("{}{}{}{}{}{}".format(IAC, SB, TSPEED, SEND, IAC, SE), LANE_INTERACTIVE)
                     
                 elif (self._check_remote_option(TSPEED) is False or
                       self._check_remote_option(TSPEED) is UNKNOWN):
@@ -1022,9 +3272,9 @@ class TelnetProtocol(object):
                       self._check_remote_option(option) is UNKNOWN):
                     self._note_remote_option(option, False)
                     self._iac_dont(option)
-                self.terminal_speed = "Not Supported"
+                self._terminal_speed = "Not Supported"
 
-            elif option == SGA or option == TTYPE:
+            elif option == SGA or option == TTYPE or option == NAWS:
 
                 if self._check_reply_pending(option):
                     self._note_reply_pending(option, False)
@@ -1037,14 +3287,24 @@ class TelnetProtocol(object):
 
                 ## Should TTYPE be below this?
 
+            elif option == TMARK:
+                ## Keepalive answered
+                self._note_reply_pending(TMARK, False)
+
+            elif option == START_TLS:
+                self._note_reply_pending(START_TLS, False)
+                self._note_remote_option(START_TLS, False)
+
             else:
                 ## All other options = Default to ignoring
                 pass
         else:
-            logging.warning("Send an invalid 3 byte command")
+            log.warning("Send an invalid 3 byte command", extra=self._log_extra)
 
         self._telnet_got_iac = False
         self._telnet_got_cmd = None
+        if not self._auto_sensing_done:
+            self._check_auto_sense()
 
 
     def _sb_decoder(self):
@@ -1052,11 +3312,19 @@ class TelnetProtocol(object):
         Figures out what to do with a received sub-negotiation block.
         """
         bloc = self._telnet_sb_buffer
+        if bloc == START_TLS + FOLLOWS and self._tls is TLS_FOLLOWS:
+            self._telnet_sb_buffer = ''
+            if self._server is not None:
+                self._server._startTLS(self)
+            return
+
         if len(bloc) > 2:
 
             if bloc[0] == TTYPE and bloc[1] == IS:
                 self._terminal_type = bloc[2:]
                 self._note_reply_pending(TTYPE, False)
+                if self._server is not None and not self._protocol_negotiation:
+                    self._server._terminalTypeKnown(self)
                 #logging.debug("Terminal type = '{}'".format(self.terminal_type))
                 
             if bloc[0] == TSPEED and bloc[1] == IS:
@@ -1065,7 +3333,7 @@ class TelnetProtocol(object):
                 
             if bloc[0] == NAWS:
                 if len(bloc) != 5:
-                    logging.warning("Bad length on NAWS SB: " + str(len(bloc)))
+                    log.warning("Bad length on NAWS SB: %d", len(bloc), extra=self._log_extra)
                 else:
                     self._columns = (256 * ord(bloc[1])) + ord(bloc[2])
                     self._rows = (256 * ord(bloc[3])) + ord(bloc[4])
@@ -1073,6 +3341,12 @@ class TelnetProtocol(object):
                 #logging.info("Screen is {} x {}".format(self.columns, self.rows))
 
         self._telnet_sb_buffer = ''
+        if self._auto_sensing_done:
+            # Late reply on an early promoted session.
+            if bloc[:1] == TTYPE:
+                self._ansi = self._terminal_type in TERMINAL_TYPES
+        else:
+            self._check_auto_sense()
 
 
     #---[ State Juggling for Telnet Options ]----------------------------------
@@ -1082,67 +3356,70 @@ class TelnetProtocol(object):
 
     def _check_local_option(self, option):
         """Test the status of local negotiated Telnet options."""
-        if option not in self._telnet_opt_dict:
-            self._telnet_opt_dict[option] = TelnetOption()
-        return self._telnet_opt_dict[option].local_option
+        return _OPT_DECODE[self._telnet_opts[ord(option)] & OPT_LOCAL_MASK]
 
 
     def _note_local_option(self, option, state):
         """Record the status of local negotiated Telnet options."""
-        if option not in self._telnet_opt_dict:
-            self._telnet_opt_dict[option] = TelnetOption()
-        self._telnet_opt_dict[option].local_option = state
-        self._telnet_opt_dict[option].option_text = Telopts[option]
+        index = ord(option)
+        self._telnet_opts[index] = ((self._telnet_opts[index] & ~OPT_LOCAL_MASK) |
+                                    _OPT_ENCODE[state])
 
 
     def _check_remote_option(self, option):
         """Test the status of remote negotiated Telnet options."""
-        if option not in self._telnet_opt_dict:
-            self._telnet_opt_dict[option] = TelnetOption()
-        return self._telnet_opt_dict[option].remote_option
+        return _OPT_DECODE[(self._telnet_opts[ord(option)] & OPT_REMOTE_MASK) >> OPT_REMOTE_SHIFT]
 
 
     def _note_remote_option(self, option, state):
-        """Record the status of local negotiated Telnet options."""
-        if option not in self._telnet_opt_dict:
-            self._telnet_opt_dict[option] = TelnetOption()
-        self._telnet_opt_dict[option].remote_option = state
-        self._telnet_opt_dict[option].option_text = Telopts[option]
+        """Record the status of remote negotiated Telnet options."""
+        index = ord(option)
+        self._telnet_opts[index] = ((self._telnet_opts[index] & ~OPT_REMOTE_MASK) |
+                                    (_OPT_ENCODE[state] << OPT_REMOTE_SHIFT))
 
 
     def _check_reply_pending(self, option):
         """Test the status of requested Telnet options."""
-        if option not in self._telnet_opt_dict:
-            self._telnet_opt_dict[option] = TelnetOption()
-        return self._telnet_opt_dict[option].reply_pending
+        return bool(self._telnet_opts[ord(option)] & OPT_PENDING)
 
 
     def _note_reply_pending(self, option, state):
         """Record the status of requested Telnet options."""
-        if option not in self._telnet_opt_dict:
-            self._telnet_opt_dict[option] = TelnetOption()
-        self._telnet_opt_dict[option].reply_pending = state
+        index = ord(option)
+        if state:
+            self._telnet_opts[index] |= OPT_PENDING
+        else:
+            self._telnet_opts[index] &= ~OPT_PENDING
+
+
+    def _telnet_option(self, option):
+        """Return a TelnetOption snapshot of an option's state."""
+        opt = TelnetOption(option)
+        opt.local_option = self._check_local_option(option)
+        opt.remote_option = self._check_remote_option(option)
+        opt.reply_pending = self._check_reply_pending(option)
+        return opt
 
 
     #---[ Telnet Command Shortcuts ]-------------------------------------------
 
     def _iac_do(self, option):
         """Send a Telnet IAC "DO" sequence."""
-        self.send("{}{}{}".format(IAC, DO, option))
+        self.send("{}{}{}".format(IAC, DO, option), LANE_INTERACTIVE)
 
 
     def _iac_dont(self, option):
         """Send a Telnet IAC "DONT" sequence."""
-        self.send("{}{}{}".format(IAC, DONT, option))
+        self.send("{}{}{}".format(IAC, DONT, option), LANE_INTERACTIVE)
 
 
     def _iac_will(self, option):
         """Send a Telnet IAC "WILL" sequence."""
-        self.send("{}{}{}".format(IAC, WILL, option))
+        self.send("{}{}{}".format(IAC, WILL, option), LANE_INTERACTIVE)
 
 
     def _iac_wont(self, option):
         """Send a Telnet IAC "WONT" sequence."""
-        self.send("{}{}{}".format(IAC, WONT, option))
+        self.send("{}{}{}".format(IAC, WONT, option), LANE_INTERACTIVE)
 
         
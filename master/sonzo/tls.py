@@ -0,0 +1,30 @@
+import ssl
+
+
+#--[ TLS ]---------------------------------------------------------------------
+
+## Port for telnet over TLS (telnets)
+TLS_PORT = 992
+## Session tickets issued after each full TLS 1.3 handshake, so reconnecting
+## clients can resume instead of doing a full handshake
+SESSION_TICKETS = 2
+## Seconds a client gets to finish its TLS handshake
+TLS_HANDSHAKE_TIMEOUT = 10
+
+
+def server_context(certfile, keyfile=None, tickets=SESSION_TICKETS,
+                   minimum=ssl.TLSVersion.TLSv1_2):
+    """
+    Return an SSLContext for TelnetServer(ssl_context=...) or
+    TelnetServer.enableStartTLS(), with session ticket resumption enabled.
+
+    Ticket keys belong to the context, so resumption works for as long as
+    the process that created it keeps running.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = minimum
+    context.load_cert_chain(certfile, keyfile)
+    context.options &= ~ssl.OP_NO_TICKET
+    if hasattr(context, 'num_tickets'):
+        context.num_tickets = tickets
+    return context
@@ -0,0 +1,380 @@
+import base64
+import hashlib
+import socket
+import ssl
+import struct
+
+
+#--[ WebSocket ]---------------------------------------------------------------
+
+## Subprotocol for clients that speak telnet, IAC sequences and all, inside
+## binary frames.  Other clients get text frames with telnet commands
+## stripped.
+TELNET_SUBPROTOCOL = 'telnet'
+## Seconds a client gets to finish the HTTP upgrade
+WEBSOCKET_HANDSHAKE_TIMEOUT = 10
+## Largest upgrade request accepted
+MAX_REQUEST = 8192
+## Largest message accepted from a client
+MAX_MESSAGE = 1048576
+
+_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+_HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+IAC = 255
+SB = 250
+SE = 240
+
+
+def frame_header(opcode, size):
+    """
+    Return the header of an unmasked, final server frame.
+    """
+    first = 0x80 | opcode
+    if size < 126:
+        return struct.pack('!BB', first, size)
+    if size < 65536:
+        return struct.pack('!BBH', first, 126, size)
+    return struct.pack('!BBQ', first, 127, size)
+
+
+def unmask(data, mask):
+    """
+    Apply a client frame's masking key.
+    """
+    size = len(data)
+    if not size:
+        return b''
+    key = (mask * (size // 4 + 1))[:size]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')).to_bytes(size, 'big')
+
+
+class WebSocketError(ConnectionError):
+    """
+    Raised for a malformed upgrade request or frame.  The connection is
+    dropped like any other socket error.
+    """
+
+
+class WebSocketTransport(object):
+    """
+    Makes a WebSocket connection look like a stream socket to
+    TelnetProtocol.
+
+    recv() answers the HTTP upgrade and returns the payload of incoming data
+    frames.  Clients that asked for the telnet subprotocol exchange the
+    telnet stream in binary frames: send() and sendmsg() put a frame header
+    in front of the OutputQueue's chunks and write them with one sendmsg(),
+    so output is never copied.  A frame cut short by the socket is finished
+    with later writes before a new frame is started.
+
+    Other clients get each write as a text frame, with telnet commands
+    removed and cp1252 turned into UTF-8, and each text message they send is
+    taken as one line.
+
+    Every other attribute is looked up on the wrapped socket.
+    """
+    __slots__ = ('_sock', '_sendmsg', '_inbuf', '_out', '_header', '_owed',
+                 '_message', '_message_op', '_iac', 'telnet', 'open', 'closed',
+                 'on_open')
+
+    def __init__(self, sock):
+        """
+        Initialize transport.
+        """
+        self._sock = sock
+        self._sendmsg = _HAVE_SENDMSG and not isinstance(sock, ssl.SSLSocket)
+        self._inbuf = b''               # Bytes read but not yet decoded
+        self._out = b''                 # Handshake, control and text frame bytes not yet written
+        self._header = b''              # Unwritten part of the current binary frame header
+        self._owed = 0                  # Payload bytes the current binary frame still needs
+        self._message = []              # Fragments of an incoming message
+        self._message_op = None
+        self._iac = 0                   # Telnet command stripping state for text clients
+        self.telnet = False             # Negotiated the telnet subprotocol?
+        self.open = False               # Upgrade done?
+        self.closed = False             # Close frame seen?
+        self.on_open = None             # Called once the upgrade is done
+
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+    #---[ Input ]--------------------------------------------------------------
+
+    def recv(self, size, flags=0):
+        """
+        Return decoded payload bytes, b'' when the connection closed.
+        Raises BlockingIOError when nothing complete has arrived.
+        """
+        data = self._sock.recv(65536)
+        if not data:
+            return b''
+        self._inbuf += data
+        # TLS can hold decrypted bytes that select() does not report.
+        while isinstance(self._sock, ssl.SSLSocket) and self._sock.pending():
+            self._inbuf += self._sock.recv(self._sock.pending())
+
+        if not self.open:
+            self._upgrade()
+            if not self.open:
+                raise BlockingIOError()
+        payload = self._decode()
+        if self.closed and not payload:
+            return b''
+        if not payload:
+            raise BlockingIOError()
+        return payload
+
+
+    def _upgrade(self):
+        """
+        Answer the HTTP upgrade request once it has all arrived.
+        """
+        end = self._inbuf.find(b'\r\n\r\n')
+        if end == -1:
+            if len(self._inbuf) > MAX_REQUEST:
+                raise WebSocketError("Upgrade request too large.")
+            return
+        request = self._inbuf[:end].decode('latin-1').split('\r\n')
+        self._inbuf = self._inbuf[end + 4:]
+        headers = {}
+        for line in request[1:]:
+            name, sep, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        key = headers.get('sec-websocket-key')
+        if (not request[0].startswith('GET ') or key is None or
+                'websocket' not in headers.get('upgrade', '').lower()):
+            self._sock.send(b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n')
+            raise WebSocketError("Not a WebSocket upgrade request.")
+
+        accept = base64.b64encode(hashlib.sha1(key.encode('latin-1') + _GUID).digest())
+        response = [b'HTTP/1.1 101 Switching Protocols', b'Upgrade: websocket',
+                    b'Connection: Upgrade', b'Sec-WebSocket-Accept: ' + accept]
+        protocols = [name.strip() for name in headers.get('sec-websocket-protocol', '').split(',')]
+        if TELNET_SUBPROTOCOL in protocols:
+            self.telnet = True
+            response.append(b'Sec-WebSocket-Protocol: ' + TELNET_SUBPROTOCOL.encode())
+        self._out += b'\r\n'.join(response) + b'\r\n\r\n'
+        self.flush()
+        self.open = True
+        if self.on_open is not None:
+            self.on_open(self.telnet)
+
+
+    def _decode(self):
+        """
+        Decode every complete frame in the input buffer and return the data
+        payload.
+        """
+        payload = []
+        buf = self._inbuf
+        pos = 0
+        while len(buf) - pos >= 2:
+            first, second = buf[pos], buf[pos + 1]
+            opcode = first & 0x0F
+            size = second & 0x7F
+            head = 2
+            if size == 126:
+                if len(buf) - pos < 4:
+                    break
+                size = struct.unpack_from('!H', buf, pos + 2)[0]
+                head = 4
+            elif size == 127:
+                if len(buf) - pos < 10:
+                    break
+                size = struct.unpack_from('!Q', buf, pos + 2)[0]
+                head = 10
+            if size > MAX_MESSAGE:
+                raise WebSocketError("Frame too large.")
+            if not second & 0x80:
+                raise WebSocketError("Client frame not masked.")
+            if len(buf) - pos < head + 4 + size:
+                break
+            mask = buf[pos + head:pos + head + 4]
+            start = pos + head + 4
+            data = unmask(buf[start:start + size], mask)
+            pos = start + size
+
+            if opcode == OP_CLOSE:
+                self.closed = True
+                self._control(OP_CLOSE, data[:2])
+                break
+            if opcode == OP_PING:
+                self._control(OP_PONG, data)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode != OP_CONTINUATION:
+                self._message_op = opcode
+            if self.telnet or self._message_op == OP_BINARY:
+                # A byte stream, fragments can be passed on right away.
+                payload.append(data)
+                continue
+            self._message.append(data)
+            if first & 0x80:
+                payload.append(self._text_line(b''.join(self._message)))
+                self._message = []
+        self._inbuf = buf[pos:]
+        return b''.join(payload)
+
+
+    def _text_line(self, message):
+        """
+        Turn a text message into a cp1252 line for the telnet parser.
+        """
+        text = message.decode('utf-8', 'replace')
+        if not text.endswith('\n'):
+            text += '\r\n'
+        return text.encode('cp1252', 'replace').replace(b'\xff', b'\xff\xff')
+
+
+    def _control(self, opcode, data):
+        """
+        Queue a control frame, written between data frames.
+        """
+        self._out += frame_header(opcode, len(data)) + data
+        if not self._owed and not self._header:
+            self.flush()
+
+
+    #---[ Output ]-------------------------------------------------------------
+
+    def outputPending(self):
+        """
+        Are handshake, control or text frame bytes waiting to be written?
+        """
+        return bool(self._out) or bool(self._header)
+
+
+    def flush(self):
+        """
+        Write queued handshake, control and text frame bytes.  Returns True
+        once they are all out.
+        """
+        if self._out and not self._owed and not self._header:
+            try:
+                sent = self._sock.send(self._out)
+            except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                return False
+            self._out = self._out[sent:]
+        return not self._out
+
+
+    def send(self, data):
+        """
+        Write data as (part of) one frame and return how many payload bytes
+        were accepted.
+        """
+        return self.sendmsg([data])
+
+
+    def sendmsg(self, buffers):
+        """
+        Write buffers as (part of) one frame and return how many payload
+        bytes were accepted.
+        """
+        if not self.telnet:
+            return self._send_text(buffers)
+        if not self._owed and not self._header:
+            if not self.flush():
+                raise BlockingIOError()
+            size = 0
+            for data in buffers:
+                size += len(data)
+            self._header = frame_header(OP_BINARY, size)
+            self._owed = size
+        else:
+            buffers = self._cut(buffers, self._owed)
+
+        head = self._header
+        iov = [head] + buffers if head else buffers
+        if self._sendmsg:
+            sent = self._sock.sendmsg(iov)
+        else:
+            sent = self._sock.send(b''.join(iov))
+        if sent < len(head):
+            self._header = head[sent:]
+            return 0
+        self._header = b''
+        sent -= len(head)
+        self._owed -= sent
+        if not self._owed:
+            self.flush()
+        return sent
+
+
+    def _cut(self, buffers, size):
+        """
+        Return the first size bytes of buffers without copying.
+        """
+        cut = []
+        for data in buffers:
+            if len(data) >= size:
+                cut.append(memoryview(data)[:size])
+                break
+            cut.append(data)
+            size -= len(data)
+        return cut
+
+
+    def _send_text(self, buffers):
+        """
+        Write buffers as a text frame for a client that does not speak
+        telnet.  Everything is accepted; what the socket does not take is
+        held and written by later calls.
+        """
+        if not self.flush():
+            raise BlockingIOError()
+        size = 0
+        for data in buffers:
+            size += len(data)
+        text = self._strip_telnet(b''.join(buffers))
+        if text:
+            text = text.decode('cp1252', 'replace').encode('utf-8')
+            self._out = frame_header(OP_TEXT, len(text)) + text
+            self.flush()
+        return size
+
+
+    def _strip_telnet(self, data):
+        """
+        Remove telnet commands, which may be split across writes.
+        """
+        if IAC not in data and not self._iac:
+            return data
+        out = bytearray()
+        state = self._iac
+        for byte in data:
+            if state == 0:
+                if byte == IAC:
+                    state = 1
+                else:
+                    out.append(byte)
+            elif state == 1:            # After IAC
+                if byte == IAC:
+                    out.append(byte)
+                    state = 0
+                elif byte == SB:
+                    state = 3
+                elif 251 <= byte <= 254:
+                    state = 2
+                else:
+                    state = 0
+            elif state == 2:            # Option of WILL/WONT/DO/DONT
+                state = 0
+            elif state == 3:            # Inside SB
+                if byte == IAC:
+                    state = 4
+            elif state == 4:            # IAC inside SB
+                state = 0 if byte == SE else 3
+        self._iac = state
+        return bytes(out)
@@ -0,0 +1,91 @@
+import unittest
+
+from sonzo.channel import ChannelManager
+from sonzo.output import LANE_NORMAL, LANE_BULK
+
+
+class Client(object):
+    """
+    Stand-in client that records what is queued for it.
+    """
+
+    def __init__(self, ansi=True):
+        self._ansi = ansi
+        self.sent = []
+
+    def sendEncoded(self, data, lane=LANE_NORMAL, record=True):
+        self.sent.append((data, lane))
+
+
+class ChannelManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.channels = ChannelManager()
+        self.alice, self.bob = Client(), Client(ansi=False)
+
+    def test_join_and_leave(self):
+        self.channels.join(self.alice, 'chat')
+        self.channels.join(self.bob, 'chat')
+        self.channels.join(self.alice, 'ooc')
+        self.assertEqual(self.channels.members('chat'), [self.alice, self.bob])
+        self.assertEqual(self.channels.subscriptions(self.alice), ['chat', 'ooc'])
+        self.assertTrue(self.channels.isMember(self.bob, 'chat'))
+
+        self.channels.leave(self.bob, 'chat')
+        self.channels.leave(self.bob, 'chat')
+        self.assertFalse(self.channels.isMember(self.bob, 'chat'))
+        self.assertEqual(self.channels.subscriptions(self.bob), [])
+
+        self.channels.leave(self.alice, 'ooc')
+        self.assertEqual(self.channels.topics(), ['chat'])
+        self.assertEqual(self.channels.memberCount('ooc'), 0)
+
+    def test_leave_all(self):
+        self.channels.join(self.alice, 'chat')
+        self.channels.join(self.alice, 'ooc')
+        self.channels.join(self.bob, 'chat')
+        self.assertEqual(self.channels.leaveAll(self.alice), ['chat', 'ooc'])
+        self.assertEqual(self.channels.topics(), ['chat'])
+        self.assertEqual(self.channels.leaveAll(self.alice), [])
+
+    def test_publish_shares_one_payload(self):
+        carol = Client()
+        for client in (self.alice, self.bob, carol):
+            self.channels.join(client, 'chat')
+        count = self.channels.publish('chat', '\x1b[1mhi\x1b[0m\r\n', plain='hi\r\n',
+                                      exclude=carol, lane=LANE_BULK)
+        self.assertEqual(count, 2)
+        self.assertEqual(self.alice.sent, [(b'\x1b[1mhi\x1b[0m\r\n', LANE_BULK)])
+        self.assertEqual(self.bob.sent, [(b'hi\r\n', LANE_BULK)])
+        self.assertEqual(carol.sent, [])
+
+        other = Client()
+        self.channels.join(other, 'chat')
+        self.channels.publish('chat', 'again\r\n')
+        self.assertIs(self.alice.sent[-1][0], other.sent[-1][0])
+
+    def test_publish_to_empty_topic(self):
+        self.assertEqual(self.channels.publish('nobody', 'hello'), 0)
+        self.assertEqual(self.channels.topics(), [])
+
+    def test_scrollback_and_replay(self):
+        self.channels.setScrollback('chat', lines=2)
+        self.channels.publish('chat', 'one\r\n')
+        self.channels.publish('chat', '\x1b[1mtwo\x1b[0m\r\n', plain='two\r\n')
+        self.channels.publish('chat', 'three\r\n')
+        self.assertEqual(self.channels.scrollbackTopics(), ['chat'])
+        self.assertEqual(len(self.channels.scrollback('chat')), 2)
+
+        self.channels.replay('chat', self.alice)
+        self.channels.replay('chat', self.bob)
+        self.assertEqual(self.alice.sent, [(b'\x1b[1mtwo\x1b[0m\r\nthree\r\n', LANE_NORMAL)])
+        self.assertEqual(self.bob.sent, [(b'two\r\nthree\r\n', LANE_NORMAL)])
+
+        self.channels.setScrollback('chat', lines=0)
+        self.assertIsNone(self.channels.scrollback('chat'))
+        self.channels.replay('chat', self.alice)
+        self.assertEqual(len(self.alice.sent), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+
+from sonzo.command import CommandRouter
+
+
+def handler(name, calls):
+    def func(client, args):
+        calls.append((name, args.command, args.text))
+    return func
+
+
+class CommandRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.router = CommandRouter(default=lambda client, line: self.calls.append(('default', line)))
+
+    def register(self, name, **kwargs):
+        return self.router.register(name, handler(name, self.calls), **kwargs)
+
+    def test_abbreviation_picks_first_registered(self):
+        self.register('look')
+        self.register('list')
+        self.assertEqual(self.router.lookup('l').name, 'look')
+        self.assertEqual(self.router.lookup('li').name, 'list')
+        self.assertEqual(self.router.lookup('LOO').name, 'look')
+        self.assertIsNone(self.router.lookup('lx'))
+
+    def test_priority_and_exact_names_win(self):
+        self.register('say')
+        self.register('score', priority=1)
+        self.register('s')
+        self.assertEqual(self.router.lookup('sa').name, 'say')
+        self.assertEqual(self.router.lookup('sc').name, 'score')
+        self.assertEqual(self.router.lookup('s').name, 's')
+
+    def test_aliases_and_no_abbreviation(self):
+        self.register('look', aliases=('examine',))
+        self.register('quit', abbreviate=False)
+        self.assertEqual(self.router.lookup('ex').name, 'look')
+        self.assertIsNone(self.router.lookup('qui'))
+        self.assertEqual(self.router.lookup('quit').name, 'quit')
+
+    def test_dispatch_passes_arguments(self):
+        self.register('tell')
+        self.assertTrue(self.router.dispatch(None, 'te bob "hi there"\n'))
+        self.assertEqual(self.calls, [('tell', 'te', 'bob "hi there"')])
+        self.router.dispatch(None, 'dance')
+        self.assertEqual(self.calls[-1], ('default', 'dance'))
+        self.assertFalse(self.router.dispatch(None, '   '))
+
+    def test_reregistering_replaces_abbreviations(self):
+        self.register('look', aliases=('examine',))
+        self.register('list')
+        new = self.register('look', priority=-1)
+        self.assertEqual(self.router.lookup('l').name, 'list')
+        self.assertIs(self.router.lookup('look'), new)
+        self.assertIsNone(self.router.lookup('ex'))
+
+    def test_unregister_repairs_prefixes(self):
+        self.register('look')
+        self.register('list')
+        self.router.unregister('look')
+        self.assertEqual(self.router.lookup('l').name, 'list')
+        self.assertIsNone(self.router.lookup('lo'))
+        self.router.unregister('list')
+        self.assertIsNone(self.router.lookup('l'))
+        self.assertIsNone(self.router.unregister('list'))
+
+    def test_bare_punctuation_is_not_an_abbreviation(self):
+        self.register('/runlater')
+        self.register('/install')
+        self.register('~')
+        self.assertIsNone(self.router.lookup('/'))
+        self.assertEqual(self.router.lookup('/r').name, '/runlater')
+        self.assertEqual(self.router.lookup('~').name, '~')
+        self.router.dispatch(None, '/')
+        self.assertEqual(self.calls, [('default', '/')])
+
+    def test_complete(self):
+        self.register('look', aliases=('lo',))
+        self.register('list')
+        self.assertEqual(self.router.complete('l'), ['list', 'lo', 'look'])
+        self.assertEqual(self.router.complete('x'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
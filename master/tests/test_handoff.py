@@ -0,0 +1,120 @@
+import array
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from sonzo.handoff import (send_handoff, recv_handoff, encode_bytes, decode_bytes,
+                           HandoffError, HANDOFF_VERSION, _HEADER)
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+class HandoffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'handoff')
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(1)
+        self.errors = []
+
+    def tearDown(self):
+        self.listener.close()
+        shutil.rmtree(self.tmp)
+
+    def serve(self, func):
+        """
+        Run func(conn) on the next connection in a thread.
+        """
+        def run():
+            conn, addr = self.listener.accept()
+            try:
+                func(conn)
+            except Exception as err:
+                self.errors.append(err)
+            finally:
+                conn.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_round_trip_passes_state_and_fds(self):
+        pipes = [os.pipe() for _ in range(3)]
+        self.addCleanup(lambda: [os.close(fd) for pipe in pipes for fd in pipe])
+        state = {'clients': [{'buffer': encode_bytes(b'\xff\xfb\x01\x00')}]}
+        thread = self.serve(lambda conn: send_handoff(conn, state, [r for r, w in pipes]))
+        received, fds = recv_handoff(self.path)
+        thread.join()
+        self.assertEqual(self.errors, [])
+        self.assertEqual(received['version'], HANDOFF_VERSION)
+        self.assertEqual(decode_bytes(received['clients'][0]['buffer']), b'\xff\xfb\x01\x00')
+        self.assertEqual(len(fds), 3)
+        for fd, (read, write) in zip(fds, pipes):
+            os.write(write, b'x')
+            self.assertEqual(os.read(fd, 1), b'x')
+            os.close(fd)
+
+    def send_raw(self, state, fds):
+        """
+        Return a sender that sends state and fds as given, then hangs up.
+        """
+        def send(conn):
+            payload = json.dumps(state).encode('utf-8')
+            conn.sendall(_HEADER.pack(len(payload)) + payload)
+            if fds:
+                conn.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                       array.array('i', fds))])
+        return send
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "needs /proc")
+    def test_failed_receive_closes_fds(self):
+        read, write = os.pipe()
+        self.addCleanup(os.close, read)
+        self.addCleanup(os.close, write)
+        before = open_fds()
+        # Promises two descriptors but hangs up after the first.
+        state = {'version': HANDOFF_VERSION, 'fd_count': 2}
+        thread = self.serve(self.send_raw(state, [read]))
+        with self.assertRaises(HandoffError):
+            recv_handoff(self.path)
+        thread.join()
+        self.assertEqual(open_fds(), before)
+
+    def test_version_mismatch(self):
+        thread = self.serve(self.send_raw({'version': HANDOFF_VERSION + 1, 'fd_count': 0}, []))
+        with self.assertRaisesRegex(HandoffError, "not supported"):
+            recv_handoff(self.path)
+        thread.join()
+
+    def test_send_gives_up_at_the_deadline(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        start = time.monotonic()
+        with self.assertRaises(HandoffError):
+            send_handoff(ours, {}, [], timeout=0.2)
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_receive_gives_up_at_the_deadline(self):
+        done = threading.Event()
+        thread = self.serve(lambda conn: done.wait(5))
+        start = time.monotonic()
+        with mock.patch('sonzo.handoff.HANDOFF_TIMEOUT', 0.2):
+            with self.assertRaises(HandoffError):
+                recv_handoff(self.path)
+        done.set()
+        thread.join()
+        self.assertLess(time.monotonic() - start, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
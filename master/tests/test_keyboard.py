@@ -0,0 +1,99 @@
+import heapq
+import socket
+import time
+import unittest
+
+from sonzo import keyboard_map
+from sonzo.keyboard import KeyDecoder, ESC_TIMEOUT
+from sonzo.telnet import TelnetServer, TelnetProtocol
+
+ESC = keyboard_map.ESC
+
+
+class KeyDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = KeyDecoder()
+
+    def test_text_and_enter(self):
+        self.assertEqual(self.decoder.feed('look\r\n'), [(None, 'look'), ('ENTER', '\r')])
+        self.assertEqual(self.decoder.feed('a\rb'), [(None, 'a'), ('ENTER', '\r'), (None, 'b')])
+        # CR NUL is one enter as well.
+        self.assertEqual(self.decoder.feed('\r\0x'), [('ENTER', '\r'), (None, 'x')])
+
+    def test_control_keys(self):
+        self.assertEqual(self.decoder.feed('ab\x08\t'),
+                         [(None, 'ab'), ('BACKSPACE', '\x08'), ('TAB', '\t')])
+
+    def test_escape_sequences(self):
+        self.assertEqual(self.decoder.feed(keyboard_map.UPARROW + 'x' + keyboard_map.F1),
+                         [('UPARROW', keyboard_map.UPARROW), (None, 'x'),
+                          ('F1', keyboard_map.F1)])
+        self.assertEqual(self.decoder.feed(ESC + 'OA' + ESC + '[3~'),
+                         [('UPARROW', ESC + 'OA'), ('DELETE', ESC + '[3~')])
+
+    def test_sequence_split_across_reads(self):
+        self.assertEqual(self.decoder.feed('x' + ESC + '['), [(None, 'x')])
+        self.assertTrue(self.decoder.pending())
+        self.assertEqual(self.decoder.feed('1'), [])
+        self.assertEqual(self.decoder.feed('5~y'), [('F5', ESC + '[15~'), (None, 'y')])
+        self.assertFalse(self.decoder.pending())
+
+    def test_unknown_sequence_falls_back_to_text(self):
+        self.assertEqual(self.decoder.feed(ESC + '[Zq'), [('ESC', ESC), (None, '[Zq')])
+
+    def test_flush_lone_escape(self):
+        self.assertEqual(self.decoder.feed(ESC), [])
+        self.assertTrue(self.decoder.pending())
+        self.assertEqual(self.decoder.flush(), [('ESC', ESC)])
+        self.assertFalse(self.decoder.pending())
+        self.assertEqual(self.decoder.flush(), [])
+
+    def test_flush_partial_sequence(self):
+        self.decoder.feed(ESC + '[1')
+        self.assertEqual(self.decoder.flush(), [('ESC', ESC), (None, '[1')])
+
+
+class EscTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TelnetServer(port=0, address='127.0.0.1')
+        self.ours, self.theirs = socket.socketpair()
+        self.client = TelnetProtocol(self.ours, ('127.0.0.1', 1))
+        self.client._server = self.server
+        self.client._character_mode = True
+        self.client._key_decoder = KeyDecoder()
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+        for listener in self.server.listeners():
+            listener.socket.close()
+
+    def run_due(self):
+        calls = self.server._callLater
+        while calls and calls[0].runtime <= time.time():
+            heapq.heappop(calls).execute()
+
+    def test_lone_escape_times_out_into_a_key(self):
+        self.client._queue_keys(self.client._key_decoder.feed(ESC))
+        self.assertEqual(list(self.client._cmd_list), [])
+        self.assertIsNotNone(self.client._key_timer)
+        time.sleep(ESC_TIMEOUT * 2)
+        self.run_due()
+        self.assertEqual(list(self.client._cmd_list), [('ESC', ESC)])
+        self.assertIsNone(self.client._key_timer)
+
+    def test_completed_sequence_cancels_timeout(self):
+        self.client._queue_keys(self.client._key_decoder.feed(ESC))
+        self.assertIsNotNone(self.client._key_timer)
+        self.client._queue_keys(self.client._key_decoder.feed('[A'))
+        self.assertIsNone(self.client._key_timer)
+        self.assertEqual(list(self.client._cmd_list), [('UPARROW', keyboard_map.UPARROW)])
+        time.sleep(ESC_TIMEOUT * 2)
+        self.run_due()
+        self.assertEqual(len(self.client._cmd_list), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
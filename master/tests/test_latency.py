@@ -0,0 +1,104 @@
+import unittest
+
+from sonzo.latency import (LatencyHistogram, ConnectionLatency, bucket_index, bucket_bound,
+                           SUB_BITS)
+from sonzo.output import OutputQueue, LANE_INTERACTIVE, LANE_NORMAL
+
+
+class BucketTest(unittest.TestCase):
+
+    def test_small_values_are_exact(self):
+        for micros in range(2 << SUB_BITS):
+            self.assertEqual(bucket_index(micros), micros)
+            self.assertEqual(bucket_bound(micros), micros)
+        self.assertEqual(bucket_index(-5), 0)
+
+    def test_buckets_cover_every_value_in_order(self):
+        previous = 0
+        for micros in list(range(1, 70000)) + [10 ** 7, 10 ** 9, 2 ** 40 + 12345]:
+            index = bucket_index(micros)
+            self.assertGreaterEqual(index, previous)
+            previous = index
+            bound = bucket_bound(index)
+            self.assertGreaterEqual(bound, micros)
+            # Relative error stays within one sub bucket.
+            self.assertLessEqual(bound - micros, micros >> SUB_BITS)
+            if index:
+                self.assertLess(bucket_bound(index - 1), micros)
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for micros in range(1, 101):
+            histogram.record(micros / 1000.0)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.max, 0.1)
+        self.assertAlmostEqual(histogram.percentile(50), 0.05, delta=0.05 / 8)
+        self.assertAlmostEqual(histogram.percentile(90), 0.09, delta=0.09 / 8)
+        self.assertEqual(histogram.percentile(100), 0.1)
+        summary = histogram.summary()
+        self.assertAlmostEqual(summary['mean'], 0.0505)
+        self.assertEqual(sorted(summary), ['count', 'max', 'mean', 'p50', 'p90', 'p99', 'p99.9'])
+
+    def test_empty(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(99), 0.0)
+        self.assertEqual(histogram.summary()['mean'], 0.0)
+
+    def test_merge(self):
+        small, large = LatencyHistogram(), LatencyHistogram()
+        for _ in range(9):
+            small.record(0.001)
+        large.record(2.0)
+        merged = LatencyHistogram()
+        merged.merge(large)
+        merged.merge(small)
+        self.assertEqual(merged.count, 10)
+        self.assertEqual(merged.max, 2.0)
+        self.assertAlmostEqual(merged.total, 2.009)
+        self.assertAlmostEqual(merged.percentile(50), 0.001, delta=0.001 / 8)
+        self.assertEqual(merged.percentile(100), 2.0)
+        # Merging a shorter histogram keeps the longer one's counts.
+        large.merge(small)
+        self.assertEqual(large.summary(), merged.summary())
+
+
+class ConnectionLatencyTest(unittest.TestCase):
+
+    def test_output_is_timed_when_fully_written(self):
+        queue = OutputQueue()
+        latency = ConnectionLatency()
+        latency.reset(queue)
+        for data in (b'hello\r\n', b'world\r\n'):
+            queue.append(data, LANE_NORMAL)
+            latency.queued(LANE_NORMAL, len(data))
+        queue.consume(9)
+        latency.sent(queue)
+        self.assertEqual(latency.output.count, 1)
+        queue.consume(5)
+        latency.sent(queue)
+        self.assertEqual(latency.output.count, 2)
+
+    def test_echo_and_commands(self):
+        queue = OutputQueue()
+        latency = ConnectionLatency()
+        latency.reset(queue)
+        latency.echoPending()
+        queue.append(b'x', LANE_INTERACTIVE)
+        latency.echoQueued(1)
+        queue.consume(1)
+        latency.sent(queue)
+        self.assertEqual(latency.output.count, 1)
+
+        latency.commandQueued()
+        latency.commandQueued()
+        latency.commandDispatched(1)
+        latency.commandDispatched(0)
+        latency.commandDispatched(0)
+        self.assertEqual(latency.input.count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+
+from sonzo.lineedit import LineEditor, ESC, KILL_LINE
+
+
+class LineEditorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.editor = LineEditor()
+
+    def keys(self, *events):
+        """
+        Apply events and return the joined echo and the last finished line.
+        """
+        echo, done = '', None
+        for event in events:
+            text, line = self.editor.key(*event)
+            echo += text
+            if line is not None:
+                done = line
+        return echo, done
+
+    def test_typing_echoes_text(self):
+        self.assertEqual(self.keys((None, 'look')), ('look', None))
+        self.assertEqual(self.keys(('ENTER', '\r')), ('\r\n', 'look'))
+        self.assertEqual(self.editor.line(), '')
+
+    def test_insert_in_the_middle(self):
+        self.keys((None, 'lok'), ('LEFTARROW', ''))
+        echo, _ = self.keys((None, 'o'))
+        self.assertEqual(echo, 'ok\b')
+        self.assertEqual(self.editor.line(), 'look')
+
+    def test_backspace_and_delete(self):
+        self.keys((None, 'looks'))
+        self.assertEqual(self.keys(('BACKSPACE', '\b')), ('\b \b', None))
+        self.keys(('HOME', ''))
+        self.assertEqual(self.keys(('BACKSPACE', '\b')), ('', None))
+        self.assertEqual(self.keys(('DELETE', ESC + '[3~')), ('ook \b\b\b\b', None))
+        self.assertEqual(self.editor.line(), 'ook')
+        # DEL from the keyboard erases to the left like backspace.
+        self.keys(('END', ''), ('DELETE', chr(127)))
+        self.assertEqual(self.editor.line(), 'oo')
+
+    def test_cursor_moves_pick_the_shorter_echo(self):
+        self.keys((None, 'a' * 10))
+        self.assertEqual(self.keys(('LEFTARROW', ''))[0], '\b')
+        self.assertEqual(self.keys(('HOME', ''))[0], ESC + '[9D')
+        self.assertEqual(self.keys(('RIGHTARROW', ''))[0], 'a')
+        self.assertEqual(self.keys(('END', ''))[0], ESC + '[9C')
+
+    def test_kill_line_and_control_characters(self):
+        self.keys((None, 'hello'))
+        echo, _ = self.keys((None, KILL_LINE + 'hi\x07'))
+        self.assertEqual(echo, ESC + '[5D' + ESC + '[K' + 'hi')
+        self.assertEqual(self.editor.line(), 'hi')
+
+    def test_history_browsing(self):
+        self.keys((None, 'look'), ('ENTER', '\r'), (None, 'list'), ('ENTER', '\r'),
+                  (None, 'list'), ('ENTER', '\r'))
+        self.assertEqual(self.editor.history(), ['look', 'list'])
+        self.keys((None, 'dr'))
+        self.assertEqual(self.keys(('UPARROW', ''))[0], '\b\blist')
+        # Only the part that differs is redrawn.
+        self.assertEqual(self.keys(('UPARROW', ''))[0], '\b\b\book')
+        self.assertEqual(self.editor.line(), 'look')
+        self.assertEqual(self.keys(('UPARROW', ''))[0], '')
+        self.keys(('DOWNARROW', ''), ('DOWNARROW', ''))
+        self.assertEqual(self.editor.line(), 'dr')
+        self.assertEqual(self.keys(('ENTER', '\r'))[1], 'dr')
+        self.assertEqual(self.editor.history(), ['look', 'list', 'dr'])
+
+    def test_password_mode(self):
+        self.editor.password = True
+        self.assertEqual(self.keys((None, 'secret'))[0], '******')
+        self.assertEqual(self.keys(('ENTER', '\r'))[1], 'secret')
+        self.assertEqual(self.editor.history(), [])
+        self.assertEqual(self.keys(('UPARROW', ''))[0], '')
+
+    def test_history_is_bounded(self):
+        editor = LineEditor(history_size=2)
+        for word in ('a', 'b', 'c'):
+            editor.key(None, word)
+            editor.key('ENTER', '\r')
+        self.assertEqual(editor.history(), ['b', 'c'])
+
+    def test_complete(self):
+        self.editor.completer = lambda line: [word for word in ('look', 'list', 'lock')
+                                              if word.startswith(line)]
+        self.keys((None, 'lo'))
+        self.assertEqual(self.keys(('TAB', '\t'))[0], '\r\nlook  lock\r\nlo')
+        self.keys((None, 'o'))
+        self.assertEqual(self.keys(('TAB', '\t'))[0], 'k')
+        self.assertEqual(self.editor.line(), 'look')
+
+    def test_snapshot_and_restore(self):
+        self.keys((None, 'say'), ('ENTER', '\r'), (None, 'tell'), ('LEFTARROW', ''))
+        state = self.editor.snapshot()
+        editor = LineEditor()
+        editor.restore(*state)
+        self.assertEqual(editor.line(), 'tell')
+        self.assertEqual(editor.history(), ['say'])
+        editor.key(None, 'x')
+        self.assertEqual(editor.line(), 'telxl')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from sonzo.output import OutputQueue, LANE_INTERACTIVE, LANE_NORMAL, LANE_BULK
+
+
+def wire(queue, last_lane=LANE_BULK):
+    """
+    Return the bytes the next socket write would carry.
+    """
+    return b''.join(bytes(chunk) for chunk in queue.chunks(last_lane))
+
+
+class OutputQueueTest(unittest.TestCase):
+
+    def test_partly_written_chunk_finishes_first(self):
+        queue = OutputQueue()
+        queue.append(b'AAAAAAAAAA', LANE_BULK, coalesce=False)
+        queue.consume(5)
+        queue.append(b'PROMPT>', LANE_INTERACTIVE)
+        self.assertEqual(wire(queue), b'AAAAAPROMPT>')
+        # Held lanes do not hold back the rest of a partly written chunk.
+        self.assertEqual(wire(queue, LANE_INTERACTIVE), b'AAAAAPROMPT>')
+        queue.consume(3)
+        self.assertEqual(wire(queue), b'AAPROMPT>')
+        queue.consume(2)
+        self.assertIsNone(queue.partial)
+        self.assertEqual(wire(queue), b'PROMPT>')
+
+    def test_partly_written_normal_chunk_is_pending_while_held(self):
+        queue = OutputQueue()
+        queue.append(b'\x1b[1;35mhello', LANE_NORMAL)
+        queue.consume(3)
+        self.assertTrue(queue.pending(LANE_INTERACTIVE))
+        self.assertEqual(wire(queue, LANE_INTERACTIVE), b';35mhello')
+
+    def test_no_coalescing_onto_partly_written_chunk(self):
+        queue = OutputQueue()
+        queue.append(b'0123456789', LANE_BULK)
+        queue.consume(4)
+        queue.append(b'abc', LANE_BULK)
+        self.assertEqual(len(queue.laneChunks(LANE_BULK)), 2)
+        self.assertEqual(queue.shed(LANE_BULK), 3)
+        self.assertEqual(wire(queue), b'456789')
+
+    def test_bulk_trim_keeps_partly_written_chunk(self):
+        queue = OutputQueue(bulk_limit=20)
+        queue.append(b'x' * 10, LANE_BULK, coalesce=False)
+        queue.consume(1)
+        for _ in range(5):
+            queue.append(b'y' * 10, LANE_BULK, coalesce=False)
+        self.assertEqual(bytes(queue.laneChunks(LANE_BULK)[0]), b'x' * 9)
+        self.assertEqual(queue.partial, LANE_BULK)
+
+
+if __name__ == '__main__':
+    unittest.main()
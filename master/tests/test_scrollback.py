@@ -0,0 +1,102 @@
+import socket
+import unittest
+
+from sonzo.output import LANE_INTERACTIVE
+from sonzo.scrollback import Scrollback
+from sonzo.telnet import TelnetServer, TelnetProtocol, STATE_CONNECTED
+
+
+class Client(object):
+
+    def __init__(self, ansi=True):
+        self._ansi = ansi
+        self.sent = []
+
+    def sendEncoded(self, data, lane, record=True):
+        self.sent.append((data, record))
+
+
+class ScrollbackTest(unittest.TestCase):
+
+    def test_line_limit_drops_oldest(self):
+        history = Scrollback(max_lines=2)
+        for line in (b'one\r\n', b'two\r\n', b'three\r\n'):
+            history.append(line)
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history.render(), b'two\r\nthree\r\n')
+        self.assertEqual(history.size(), len(b'two\r\nthree\r\n'))
+
+    def test_byte_limit_counts_plain_variants(self):
+        history = Scrollback(max_lines=10, max_bytes=9)
+        history.append(b'abcd', b'ab')
+        self.assertEqual(history.size(), 6)
+        history.append(b'efgh')
+        self.assertEqual(history.items(), [(b'efgh', b'efgh')])
+        self.assertEqual(history.size(), 4)
+        # A line larger than the limit is not kept at all.
+        history.append(b'x' * 10)
+        self.assertEqual(len(history), 0)
+        self.assertEqual(history.size(), 0)
+
+    def test_render_and_replay(self):
+        history = Scrollback()
+        history.append(b'\x1b[1mhi\x1b[0m\r\n', b'hi\r\n')
+        history.append(b'bye\r\n')
+        self.assertEqual(history.render(ansi=False), b'hi\r\nbye\r\n')
+
+        client = Client(ansi=True)
+        history.replay(client)
+        self.assertEqual(client.sent, [(b'\x1b[1mhi\x1b[0m\r\nbye\r\n', False)])
+
+        history.clear()
+        history.replay(client)
+        self.assertEqual(len(client.sent), 1)
+        self.assertEqual(history.size(), 0)
+
+
+class SessionScrollbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TelnetServer(port=0, address='127.0.0.1', clientclass=TelnetProtocol)
+        self.server.setEarlyPromote()
+        self.server.configureSessions(scrollback=10)
+        self.server._timeout = 0.01
+        self.port = self.server.listeners()[0].socket.getsockname()[1]
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        for listener in self.server.listeners():
+            listener.socket.close()
+
+    def connect(self):
+        known = set(self.server._clients.values())
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        self.sockets.append(sock)
+        for _ in range(50):
+            self.server._poll()
+            new = [client for client in self.server._clients.values() if client not in known]
+            if new and new[0]._state is STATE_CONNECTED:
+                return sock, new[0]
+        self.fail("Client never connected.")
+
+    def test_scrollback_follows_the_session_key(self):
+        sock, client = self.connect()
+        client.setSessionKey('bob')
+        client.send("first\r\n")
+        client.sendEncoded(b'prompt> ', LANE_INTERACTIVE)
+        client.send("second\r\n")
+        sock.close()
+        for _ in range(10):
+            self.server._poll()
+        self.assertIn('bob', self.server._scrollbacks)
+
+        sock, client = self.connect()
+        client.setSessionKey('bob')
+        self.assertNotIn('bob', self.server._scrollbacks)
+        self.assertEqual(client._scrollback.render(), b'first\r\nsecond\r\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import socket
+import unittest
+
+from sonzo.session import SessionStore
+from sonzo.telnet import TelnetServer, TelnetProtocol, STATE_CONNECTED, STATE_DETACHED
+
+
+class HookClient(TelnetProtocol):
+    """
+    Client that records the session hooks it sees.
+    """
+    hooks = []
+
+    def onConnect(self):
+        self.hooks.append(('onConnect', self))
+
+    def onDisconnect(self):
+        self.hooks.append(('onDisconnect', self))
+
+    def onDetach(self):
+        self.hooks.append(('onDetach', self))
+
+    def onResume(self):
+        self.hooks.append(('onResume', self))
+
+
+class HookServer(TelnetServer):
+
+    def onDisconnect(self, client):
+        HookClient.hooks.append(('server.onDisconnect', client))
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        HookClient.hooks = []
+        self.server = HookServer(port=0, address='127.0.0.1', clientclass=HookClient)
+        self.server.setEarlyPromote()
+        self.server.configureSessions(resume_grace=60)
+        self.server._timeout = 0.01
+        self.port = self.server.listeners()[0].socket.getsockname()[1]
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        for listener in self.server.listeners():
+            listener.socket.close()
+
+    def connect(self):
+        """
+        Connect and return the server side client object.
+        """
+        known = set(self.server._clients.values())
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        self.sockets.append(sock)
+        for _ in range(50):
+            self.server._poll()
+            new = [client for client in self.server._clients.values() if client not in known]
+            if new and new[0]._state is STATE_CONNECTED:
+                return sock, new[0]
+        self.fail("Client never connected.")
+
+    def poll(self, count=10):
+        for _ in range(count):
+            self.server._poll()
+
+    def test_resume_runs_no_disconnect_hooks(self):
+        first_sock, first = self.connect()
+        self.assertIs(first.setSessionKey('bob'), first)
+        first_sock.close()
+        self.poll()
+        self.assertIs(first._state, STATE_DETACHED)
+
+        second_sock, second = self.connect()
+        self.server.channels.join(second, 'chat')
+        HookClient.hooks = []
+        session = second.setSessionKey('bob')
+        self.assertIs(session, first)
+        self.assertEqual(HookClient.hooks, [('onResume', first)])
+        self.assertIs(first._state, STATE_CONNECTED)
+        self.assertNotIn(second, self.server.channels.members('chat'))
+
+        # The resumed session still owns a live connection.
+        first.send("welcome back\r\n")
+        self.poll()
+        second_sock.settimeout(1)
+        self.assertIn(b'welcome back', second_sock.recv(4096))
+
+    def test_detaching_over_a_held_key_ends_the_older_session(self):
+        first_sock, first = self.connect()
+        second_sock, second = self.connect()
+        first.setSessionKey('bob')
+        second.setSessionKey('bob')
+        first_sock.close()
+        self.poll()
+        HookClient.hooks = []
+        second_sock.close()
+        self.poll()
+        self.assertIn(('onDisconnect', first), HookClient.hooks)
+        self.assertIn(('onDetach', second), HookClient.hooks)
+        self.assertEqual(self.server.sessions.sessions(), [second])
+
+
+class SessionStoreTest(unittest.TestCase):
+
+    def test_add_returns_displaced_client(self):
+        class Client(object):
+            def __init__(self, key):
+                self._session_key = key
+        store = SessionStore()
+        first, second = Client('bob'), Client('bob')
+        self.assertIsNone(store.add(first))
+        self.assertIsNone(store.add(first))
+        self.assertIs(store.add(second), first)
+        self.assertIs(store.take('bob'), second)
+        self.assertNotIn('bob', store)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import time
+import unittest
+
+from sonzo.task import TimingWheel
+
+
+class TimingWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimingWheel(resolution=1.0, size=8)
+        self.now = time.time()
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append(name)
+
+    def test_timer_runs_once_when_due(self):
+        self.wheel.schedule('a', 2, self.fire, 'a')
+        self.assertIn('a', self.wheel)
+        self.wheel.advance(self.now)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(self.now + 3)
+        self.assertEqual(self.fired, ['a'])
+        self.assertNotIn('a', self.wheel)
+        self.wheel.advance(self.now + 4)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_reschedule_replaces_timer(self):
+        self.wheel.schedule('a', 1, self.fire, 'first')
+        self.wheel.schedule('a', 5, self.fire, 'second')
+        self.assertEqual(len(self.wheel), 1)
+        self.wheel.advance(self.now + 3)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(self.now + 6)
+        self.assertEqual(self.fired, ['second'])
+
+    def test_cancel(self):
+        self.wheel.schedule('a', 1, self.fire, 'a')
+        self.wheel.cancel('a')
+        self.wheel.cancel('missing')
+        self.assertEqual(len(self.wheel), 0)
+        self.wheel.advance(self.now + 3)
+        self.assertEqual(self.fired, [])
+
+    def test_timer_beyond_one_lap_waits_for_its_tick(self):
+        self.wheel.schedule('far', 12, self.fire, 'far')
+        self.wheel.advance(self.now + 6)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(self.now + 13)
+        self.assertEqual(self.fired, ['far'])
+
+    def test_long_stall_runs_everything_due(self):
+        for delay in range(1, 6):
+            self.wheel.schedule(delay, delay, self.fire, delay)
+        self.wheel.advance(self.now + 100)
+        self.assertEqual(sorted(self.fired), [1, 2, 3, 4, 5])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_callback_can_cancel_and_reschedule(self):
+        def first():
+            self.fired.append('first')
+            self.wheel.cancel('second')
+            self.wheel.schedule('first', 10, self.fire, 'again')
+        self.wheel.schedule('first', 1, first)
+        self.wheel.schedule('second', 1, self.fire, 'second')
+        self.wheel.advance(self.now + 2)
+        self.assertEqual(self.fired, ['first'])
+        self.assertIn('first', self.wheel)
+        self.wheel.advance(self.now + 12)
+        self.assertEqual(self.fired, ['first', 'again'])
+
+
+if __name__ == '__main__':
+    unittest.main()
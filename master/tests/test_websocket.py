@@ -0,0 +1,156 @@
+import base64
+import hashlib
+import os
+import socket
+import struct
+import unittest
+
+from sonzo.websocket import (WebSocketTransport, WebSocketError, frame_header, unmask,
+                             OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING,
+                             OP_PONG, MAX_MESSAGE)
+
+
+def client_frame(opcode, payload, final=True, mask=b'\x12\x34\x56\x78'):
+    """
+    Return a masked frame as a browser would send it.
+    """
+    first = (0x80 if final else 0) | opcode
+    size = len(payload)
+    if size < 126:
+        header = struct.pack('!BB', first, 0x80 | size)
+    elif size < 65536:
+        header = struct.pack('!BBH', first, 0x80 | 126, size)
+    else:
+        header = struct.pack('!BBQ', first, 0x80 | 127, size)
+    return header + mask + unmask(payload, mask)
+
+
+def read_frame(data):
+    """
+    Split one unmasked server frame off data.  Returns (opcode, payload, rest).
+    """
+    opcode, size = data[0] & 0x0F, data[1] & 0x7F
+    head = 2
+    if size == 126:
+        size, head = struct.unpack_from('!H', data, 2)[0], 4
+    elif size == 127:
+        size, head = struct.unpack_from('!Q', data, 2)[0], 10
+    return opcode, data[head:head + size], data[head + size:]
+
+
+class FrameTest(unittest.TestCase):
+
+    def test_frame_header_sizes(self):
+        self.assertEqual(frame_header(OP_TEXT, 5), b'\x81\x05')
+        self.assertEqual(frame_header(OP_BINARY, 300), b'\x82\x7e\x01\x2c')
+        self.assertEqual(frame_header(OP_BINARY, 70000), b'\x82\x7f' + struct.pack('!Q', 70000))
+
+    def test_unmask_round_trips(self):
+        mask = b'\x01\x02\x03\x04'
+        for data in (b'', b'a', b'hello', bytes(range(256))):
+            masked = unmask(data, mask)
+            self.assertEqual(len(masked), len(data))
+            self.assertEqual(unmask(masked, mask), data)
+        self.assertEqual(unmask(b'\x00\x00\x00\x00\x00', mask), b'\x01\x02\x03\x04\x01')
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server_sock, self.client_sock = socket.socketpair()
+        self.server_sock.setblocking(False)
+        self.client_sock.settimeout(1)
+        self.transport = WebSocketTransport(self.server_sock)
+
+    def tearDown(self):
+        self.server_sock.close()
+        self.client_sock.close()
+
+    def upgrade(self, protocol=None):
+        key = base64.b64encode(os.urandom(16))
+        request = [b'GET /telnet HTTP/1.1', b'Host: localhost', b'Upgrade: websocket',
+                   b'Connection: Upgrade', b'Sec-WebSocket-Key: ' + key,
+                   b'Sec-WebSocket-Version: 13']
+        if protocol:
+            request.append(b'Sec-WebSocket-Protocol: ' + protocol)
+        self.client_sock.sendall(b'\r\n'.join(request) + b'\r\n\r\n')
+        with self.assertRaises(BlockingIOError):
+            self.transport.recv(4096)
+        response = self.client_sock.recv(4096)
+        accept = base64.b64encode(hashlib.sha1(
+            key + b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest())
+        self.assertTrue(response.startswith(b'HTTP/1.1 101 '))
+        self.assertIn(b'Sec-WebSocket-Accept: ' + accept, response)
+        self.assertTrue(self.transport.open)
+        return response
+
+    def feed(self, data):
+        self.client_sock.sendall(data)
+        return self.transport.recv(4096)
+
+    def test_rejects_plain_http(self):
+        self.client_sock.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        with self.assertRaises(WebSocketError):
+            self.transport.recv(4096)
+        self.assertTrue(self.client_sock.recv(4096).startswith(b'HTTP/1.1 400 '))
+
+    def test_telnet_subprotocol_binary_frames(self):
+        response = self.upgrade(b'telnet')
+        self.assertIn(b'Sec-WebSocket-Protocol: telnet', response)
+        self.assertTrue(self.transport.telnet)
+        self.assertEqual(self.feed(client_frame(OP_BINARY, b'\xff\xfb\x01look\r\n')),
+                         b'\xff\xfb\x01look\r\n')
+        self.assertEqual(self.transport.sendmsg([b'hello ', b'world']), 11)
+        opcode, payload, rest = read_frame(self.client_sock.recv(4096))
+        self.assertEqual((opcode, payload, rest), (OP_BINARY, b'hello world', b''))
+
+    def test_frame_split_across_reads(self):
+        self.upgrade(b'telnet')
+        frame = client_frame(OP_BINARY, b'x' * 300)
+        self.client_sock.sendall(frame[:3])
+        with self.assertRaises(BlockingIOError):
+            self.transport.recv(4096)
+        self.client_sock.sendall(frame[3:100])
+        with self.assertRaises(BlockingIOError):
+            self.transport.recv(4096)
+        self.assertEqual(self.feed(frame[100:]), b'x' * 300)
+
+    def test_text_messages_become_lines(self):
+        self.upgrade()
+        self.assertFalse(self.transport.telnet)
+        data = client_frame(OP_TEXT, 'café'.encode('utf-8'), final=False)
+        data += client_frame(OP_CONTINUATION, b' now')
+        self.assertEqual(self.feed(data), b'caf\xe9 now\r\n')
+
+        # Telnet commands are stripped from text output, even split across writes.
+        self.transport.send(b'hi\xff\xfb')
+        self.transport.send(b'\x01 caf\xe9')
+        first = read_frame(self.client_sock.recv(4096))
+        self.assertEqual(first[:2], (OP_TEXT, b'hi'))
+        second = read_frame(first[2] or self.client_sock.recv(4096))
+        self.assertEqual(second[:2], (OP_TEXT, ' café'.encode('utf-8')))
+
+    def test_ping_and_close(self):
+        self.upgrade(b'telnet')
+        with self.assertRaises(BlockingIOError):
+            self.feed(client_frame(OP_PING, b'beat'))
+        self.assertEqual(read_frame(self.client_sock.recv(4096)), (OP_PONG, b'beat', b''))
+        self.assertEqual(self.feed(client_frame(OP_CLOSE, struct.pack('!H', 1000) + b'bye')), b'')
+        self.assertTrue(self.transport.closed)
+        self.assertEqual(read_frame(self.client_sock.recv(4096)),
+                         (OP_CLOSE, struct.pack('!H', 1000), b''))
+
+    def test_rejects_unmasked_frames(self):
+        self.upgrade(b'telnet')
+        with self.assertRaises(WebSocketError):
+            self.feed(b'\x82\x02hi')
+
+    def test_rejects_oversized_frames(self):
+        self.upgrade(b'telnet')
+        header = struct.pack('!BBQ', 0x82, 0x80 | 127, MAX_MESSAGE + 1)
+        with self.assertRaises(WebSocketError):
+            self.feed(header)
+
+
+if __name__ == '__main__':
+    unittest.main()